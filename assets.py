@@ -0,0 +1,211 @@
+"""
+Process-wide registry of loaded models, so that every item built from the same STL file
+shares one parsed copy of its base geometry.
+"""
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from geometry import edge_keys, unpack_edges, cluster_vertices
+from stlreader import StlReader
+import meshcache
+
+LOD_ERROR = .0025  # Clustering cell size of the first simplified level, as a fraction of the model's size
+LOD_LEVELS = 4  # Most simplified levels built per model
+
+
+class MeshData:
+    """
+    The untransformed geometry of one model. Shared between items, so its arrays are read-only.
+
+    vertices:       (V, 3) welded unique vertices
+    tri_indices:    (T, 3) indices of each triangle's corners into vertices
+    edges:          (E, 2) unique undirected edges, as indices into vertices
+    normals:        (T, 3) facet normals stored in the file
+    lods:           list of (vertices, edges, error) levels of detail, from the full mesh (error 0)
+                    to the coarsest. error is the furthest any vertex can have moved, in model units
+
+    lods can be given the simplified levels (all but the first) when they were already built,
+    such as from a mesh cache; otherwise they are built from the mesh.
+    """
+
+    def __init__(self, vertices, tri_indices, edges, normals, duplicate_edges=0, lod_error=LOD_ERROR, lods=None):
+        self.vertices = vertices
+        self.tri_indices = tri_indices
+        self.edges = edges
+        self.normals = normals
+        self.duplicate_edges = duplicate_edges
+
+        for arr in (self.vertices, self.tri_indices, self.edges, self.normals):
+            arr.flags.writeable = False
+
+        if lods is None:
+            self.lods = self.build_lods(lod_error)
+        else:
+            self.lods = [(self.vertices, self.edges, 0.0)] + list(lods)
+
+    def build_lods(self, lod_error, max_levels=LOD_LEVELS):
+        """
+        Builds the chain of levels of detail by clustering vertices on ever coarser grids.
+        The first grid uses cells of lod_error times the model's bounding box diagonal, and each
+        grid after doubles it. Grids that remove less than a tenth of the edges are skipped.
+        A clustered vertex is the average of the vertices in its cell, so none of them moves further
+        than the cell's diagonal, which is stored as the level's error.
+        """
+        lods = [(self.vertices, self.edges, 0.0)]
+        if len(self.vertices) == 0:
+            return lods
+
+        diagonal = np.linalg.norm(self.vertices.max(axis=0) - self.vertices.min(axis=0))
+        cell_size = lod_error * diagonal
+        while len(lods) <= max_levels and 0 < cell_size < diagonal:
+            vertices, edges = cluster_vertices(self.vertices, self.edges, cell_size)
+            if len(edges) == 0:
+                break
+            if len(edges) <= .9 * len(lods[-1][1]):  # Otherwise too little change to be worth a level
+                vertices.flags.writeable = False
+                edges.flags.writeable = False
+                lods.append((vertices, edges, float(np.sqrt(3) * cell_size)))
+            cell_size *= 2
+        return lods
+
+    @classmethod
+    def from_stl(cls, file_name):
+        """
+        Parses an STL file into a new MeshData, a block of triangles at a time. Each block's edges are
+        found as soon as it is welded and merged into the sorted edges found so far, so the edges never
+        take much more memory than the final ones.
+        """
+        reader = StlReader(file_name)
+        keys = np.empty(0, dtype=np.int64)
+        all_edges = 0
+        for start, tri_indices in reader.welded_blocks():
+            block_keys, count = edge_keys(tri_indices)
+            all_edges += count
+            # Insert the block's edges that weren't seen yet where they belong in the sorted keys
+            pos = np.searchsorted(keys, block_keys)
+            found = pos < len(keys)
+            found[found] = keys[pos[found]] == block_keys[found]
+            new = ~found
+            keys = np.insert(keys, pos[new], block_keys[new])
+        edges = unpack_edges(keys, np.int32)
+        duplicate_edges = all_edges - len(keys)
+        del keys  # Freed before the levels of detail are built
+        return cls(reader.vertices, reader.tri_indices, edges, reader.normals, duplicate_edges)
+
+    @classmethod
+    def from_file(cls, file_name):
+        """
+        Loads an STL file, memory-mapping its binary cache if it is up to date.
+        Otherwise the STL is parsed and the cache is written for next time.
+        """
+        cached = meshcache.read_cache(file_name, LOD_ERROR, LOD_LEVELS)
+        if cached is not None:
+            return cls(cached['vertices'], cached['tri_indices'], cached['edges'], cached['normals'],
+                       cached['duplicate_edges'], lods=cached['lods'])
+
+        mesh_data = cls.from_stl(file_name)
+        meshcache.write_cache(file_name, mesh_data.vertices, mesh_data.tri_indices, mesh_data.edges,
+                              mesh_data.normals, mesh_data.duplicate_edges, LOD_ERROR, LOD_LEVELS, mesh_data.lods[1:])
+        return mesh_data
+
+    @property
+    def triangles(self):
+        """
+        The (T, 3, 3) corners of every triangle.
+        """
+        return self.vertices[self.tri_indices]
+
+    @property
+    def nbytes(self):
+        """
+        The memory held by the geometry arrays, in bytes.
+        """
+        lod_bytes = sum(vertices.nbytes + edges.nbytes for vertices, edges, error in self.lods[1:])
+        return lod_bytes + sum(arr.nbytes for arr in (self.vertices, self.tri_indices, self.edges, self.normals))
+
+
+class MeshRegistry:
+    """
+    Caches MeshData by file path and modification time, evicting the least recently used
+    models once the cached geometry grows past max_bytes.
+    Safe to use from several threads: different models load in parallel, and a thread asking for
+    a model another thread is already loading waits for that load instead of repeating it.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.meshes = OrderedDict()  # (path, mtime) -> MeshData, least recently used first
+        self.loading = {}  # (path, mtime) -> Event set once that model is loaded (or failed to)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, file_name):
+        """
+        Returns the shared MeshData for file_name, loading it if it is not cached or the file changed.
+        """
+        path = os.path.abspath(file_name)
+        key = (path, os.stat(path).st_mtime_ns)
+
+        while True:
+            with self.lock:
+                if key in self.meshes:
+                    self.hits += 1
+                    self.meshes.move_to_end(key)
+                    return self.meshes[key]
+                loaded = self.loading.get(key)
+                if loaded is None:
+                    # This thread loads the model; others asking for it wait on the event
+                    self.misses += 1
+                    self.loading[key] = threading.Event()
+                    break
+            loaded.wait()  # Then look again, loading it here if the other thread failed
+
+        try:
+            mesh_data = MeshData.from_file(path)
+            with self.lock:
+                # Drop the stale copy of a file that has changed on disk
+                for old_key in [old_key for old_key in self.meshes if old_key[0] == path]:
+                    del self.meshes[old_key]
+                    self.evictions += 1
+                self.meshes[key] = mesh_data
+                self.evict()
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+        return mesh_data
+
+    def evict(self):
+        """
+        Removes least recently used meshes until the cache fits in max_bytes. The newest mesh is always kept.
+        Called with the lock held.
+        """
+        while len(self.meshes) > 1 and self.nbytes > self.max_bytes:
+            self.meshes.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Empties the cache. Items keep the geometry they already hold.
+        """
+        with self.lock:
+            self.meshes.clear()
+
+    @property
+    def nbytes(self):
+        """
+        The memory held by all cached meshes, in bytes.
+        """
+        return sum(mesh_data.nbytes for mesh_data in self.meshes.values())
+
+    def stats(self):
+        """
+        Returns the cache counters as a dict.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'meshes': len(self.meshes), 'bytes': self.nbytes}
+
+
+registry = MeshRegistry()  # The registry shared by the whole process
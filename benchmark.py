@@ -0,0 +1,207 @@
+"""
+Headless end-to-end frame benchmark. Builds a fixed, seeded scene, flies the camera along a
+scripted path and reports frame time statistics as JSON. Needs no display, so it can run on CI.
+
+    python3 benchmark.py --cubes 20 --teapots 10 --cylinders 5 --frames 200 --output bench.json
+"""
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from math import sin, cos, atan2, asin, pi, sqrt
+import numpy as np
+
+from world import World
+from terrain import Terrain
+from controller import Scene, COLLISION_RADIUS
+from renderer import Renderer
+from camera import Camera
+from assets import registry
+from bvh import WorldBVH
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+
+def camera_path(frame, frames, center=(100, 100, 105), radius=160, height=40):
+    """
+    Returns the (pos, angle) of the camera at a frame of a deterministic orbit that keeps looking at center.
+    """
+    theta = 2 * pi * frame / frames
+    pos = [center[0] + radius * sin(theta), center[1] + height * sin(2 * theta), center[2] - radius * cos(theta)]
+
+    # Yaw and pitch that point the view direction of Renderer.view_matrix at the center
+    forward = [center[idx] - pos[idx] for idx in range(3)]
+    length = sqrt(sum(f**2 for f in forward))
+    angle = [atan2(forward[0], forward[2]), -asin(forward[1] / length), 0]
+    return pos, angle
+
+
+def peak_memory_kb():
+    """
+    Returns the peak resident memory of the process in kilobytes, or None where it can't be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # macOS reports bytes
+
+
+def latency(times_ms):
+    """
+    Summarizes a list of query times in milliseconds.
+    """
+    return {'median': float(np.median(times_ms)), 'mean': float(np.mean(times_ms)), 'max': float(np.max(times_ms))}
+
+
+def bvh_benchmark(world, frames):
+    """
+    Times building and refitting a WorldBVH of world, and the crosshair ray and a collision sphere
+    at every frame of the camera path. The spheres sit where the rays hit, so they touch something.
+    Then a camera walks a few steps towards each hit with collisions on, as holding a movement key
+    does, which probes several spheres per step when it is blocked and slides.
+    """
+    collision = WorldBVH(world)
+    start = time.perf_counter()
+    collision.update()
+    build_ms = (time.perf_counter() - start) * 1000
+    collision.motion_key = None  # As if every object had moved
+    start = time.perf_counter()
+    collision.update()
+    refit_ms = (time.perf_counter() - start) * 1000
+
+    def blocked(pos):
+        return collision.sphere_collides(pos, COLLISION_RADIUS)
+
+    camera, walker = Camera(), Camera()
+    ray_ms, sphere_ms, step_ms, hits = [], [], [], 0
+    for frame in range(frames):
+        camera.set_pose(*camera_path(frame, frames))
+        start = time.perf_counter()
+        hit = collision.pick(camera)
+        ray_ms.append((time.perf_counter() - start) * 1000)
+        hits += hit is not None
+        start = time.perf_counter()
+        collision.sphere_collides(camera.pos if hit is None else hit.point, COLLISION_RADIUS)
+        sphere_ms.append((time.perf_counter() - start) * 1000)
+        if hit is not None:
+            walker.set_pose(list(hit.point - collision.camera_ray(camera)[1] * 2 * COLLISION_RADIUS), camera.angle)
+            for step in range(4):
+                start = time.perf_counter()
+                walker.move((0, 0, 1), speed=COLLISION_RADIUS / 2, blocked=blocked)
+                step_ms.append((time.perf_counter() - start) * 1000)
+    return {'objects': len(collision.objects), 'build_ms': build_ms, 'refit_ms': refit_ms, 'ray_hits': hits,
+            'ray_ms': latency(ray_ms), 'sphere_ms': latency(sphere_ms),
+            'move_step_ms': latency(step_ms) if step_ms else None}
+
+
+def run_benchmark(cubes=10, teapots=5, cylinders=5, frames=100, window_size=(500, 500), seed=0, trace=None,
+                  tile_size=None, workers=1, terrain=False, instanced=False, mode='wireframe', capture=None,
+                  capture_format='png', backpressure='drop', adaptive_fps=None, min_scale=.5, snapshot=None,
+                  bvh=False):
+    """
+    Renders frames of a seeded scene offscreen and returns a dict of timing and memory results.
+    If trace is a file name, the per-stage timings of every frame are written to it as JSON or CSV.
+    A tile_size switches to tiled rasterization on the given number of workers, for comparison with the default.
+    With terrain, the ground is generated around the camera as it flies, on the render thread so runs are repeatable.
+    An instanced scene stores the same objects as instance batches instead of Items.
+    mode is the Renderer's drawing mode, 'wireframe' or 'solid'.
+    If capture is a directory, every frame is recorded into it in capture_format while rendering.
+    With adaptive_fps, the resolution scales between min_scale and 1 to hold that frame rate.
+    A snapshot file is loaded in place of the generated objects (the counts are then ignored), building
+    its items as they come into view.
+    With bvh, ray picking and collision queries are timed against the objects once the frames are drawn.
+    """
+    start = time.perf_counter()
+    world = World(terrain=Terrain(seed=seed, workers=0) if terrain else None)
+    if snapshot is not None:
+        world.load(snapshot)
+    else:
+        world.gen_scene({'cube.stl': cubes, 'teapot.stl': teapots, 'Cylinder.stl': cylinders}, seed=seed,
+                        instanced=instanced)
+    scene = Scene(window_size, world=world, headless=True)
+    if tile_size or mode != 'wireframe' or adaptive_fps:
+        scene.renderer = Renderer(scene.camera, window_size, profiler=scene.profiler, tile_size=tile_size, workers=workers,
+                                  mode=mode, adaptive_resolution=bool(adaptive_fps), min_scale=min_scale,
+                                  target_frame_time=1 / adaptive_fps if adaptive_fps else 1/60)
+    build_time = time.perf_counter() - start
+    if capture is not None:
+        scene.start_capture(capture, format=capture_format, backpressure=backpressure)
+
+    scene.profiler.frames = deque(maxlen=frames)  # Keep every frame for the trace
+    frame_times = []
+    for frame in range(frames):
+        scene.camera.set_pose(*camera_path(frame, frames))
+        scene.publish_camera()
+        frame_start = time.perf_counter()
+        scene.profiler.begin_frame()
+        scene.render_frame()
+        scene.profiler.end_frame()
+        frame_times.append(time.perf_counter() - frame_start)
+    capture_stats = scene.stop_capture()
+    if trace is not None:
+        scene.profiler.dump(trace)
+
+    frame_ms = np.array(frame_times) * 1000
+    return {'scene': {'cubes': cubes, 'teapots': teapots, 'cylinders': cylinders, 'seed': seed,
+                      'window_size': list(window_size), 'snapshot': snapshot, 'items': len(world.items),
+                      'items_pending': sum(len(batch) for batch in world.pending.values()),
+                      'instances': sum(len(batch) for batch in world.instances.values())},
+            'raster': {'tile_size': tile_size, 'workers': workers, 'mode': mode, 'adaptive_fps': adaptive_fps,
+                       'final_scale': scene.renderer.scale},
+            'terrain': world.terrain.stats() if terrain else None,
+            'capture': capture_stats,
+            'bvh': bvh_benchmark(world, frames) if bvh else None,
+            'frames': frames,
+            'build_time_s': build_time,
+            'frame_ms': {'mean': float(frame_ms.mean()), 'p50': float(np.percentile(frame_ms, 50)),
+                         'p95': float(np.percentile(frame_ms, 95)), 'p99': float(np.percentile(frame_ms, 99)),
+                         'min': float(frame_ms.min()), 'max': float(frame_ms.max())},
+            'throughput_fps': frames / sum(frame_times),
+            'peak_memory_kb': peak_memory_kb(),
+            'stages_ms': {name: stats['mean'] for name, stats in scene.profiler.summary()['stages'].items()},
+            'mesh_registry': registry.stats()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render a seeded scene offscreen and report frame times as JSON.')
+    parser.add_argument('--cubes', type=int, default=10)
+    parser.add_argument('--teapots', type=int, default=5)
+    parser.add_argument('--cylinders', type=int, default=5)
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--size', type=int, nargs=2, default=(500, 500), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--tile-size', type=int, help='rasterize in tiles of this many pixels')
+    parser.add_argument('--workers', type=int, default=1, help='threads rasterizing tiles')
+    parser.add_argument('--terrain', action='store_true', help='generate procedural terrain around the camera')
+    parser.add_argument('--instanced', action='store_true', help='store the objects as instance batches instead of items')
+    parser.add_argument('--solid', action='store_true', help='draw filled, shaded triangles instead of wireframes')
+    parser.add_argument('--snapshot', help='load the objects from this snapshot file instead of generating them')
+    parser.add_argument('--adaptive', type=float, metavar='FPS', help='scale the resolution to hold this frame rate')
+    parser.add_argument('--min-scale', type=float, default=.5, help='lowest resolution scale with --adaptive')
+    parser.add_argument('--capture', metavar='DIR', help='record every frame into this directory')
+    parser.add_argument('--capture-format', choices=('png', 'raw'), default='png',
+                        help='record a PNG sequence or one raw RGB24 stream')
+    parser.add_argument('--block', action='store_true', help='wait for the frame writers instead of dropping frames')
+    parser.add_argument('--bvh', action='store_true', help='also time ray picking and collision queries')
+    parser.add_argument('--trace', help='write per-stage timings of every frame to this .json or .csv file')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.cubes, args.teapots, args.cylinders, args.frames, tuple(args.size), args.seed,
+                            args.trace, args.tile_size, args.workers, args.terrain, args.instanced,
+                            'solid' if args.solid else 'wireframe', args.capture, args.capture_format,
+                            'block' if args.block else 'drop', args.adaptive, args.min_scale, args.snapshot,
+                            args.bvh)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,722 @@
+"""
+Bounding volume hierarchies for ray picking and collision tests against the objects in a world.
+
+A BVH is an implicit, complete tree over boxes: the boxes are sorted along a Morton curve through
+their centers and grouped into leaves of leaf_size, and every node's box is the union of its
+BRANCHING children's, so the whole tree is built (and refitted after boxes move) with a few array
+operations per level. Queries walk it a level at a time, testing every node still in play at once,
+so their cost is mostly the number of levels; a wide tree keeps that small. A single query against a
+small tree, the usual case for picking and collisions, would be mostly NumPy's fixed cost per call,
+so small trees are walked one node at a time in plain Python instead.
+
+WorldBVH is two levels of these: one tree per model over its triangles, in model space and shared
+by every item and instance of that model, and one over the objects' world space boxes, which only
+needs refitting when objects move. Rays and spheres are moved into each object's model space to
+be tested against its triangles, and the model trees of all the objects a query reaches are walked
+together as one Forest.
+"""
+from collections import namedtuple
+from math import sqrt
+import numpy as np
+import transforms
+
+LEAF_SIZE = 4  # Triangles per leaf of a model's tree
+OBJECT_LEAF_SIZE = 2  # Objects per leaf of the world's tree
+RAY_BATCH = 16  # Objects a ray is first tested against together, nearest first; later batches are bigger
+BRANCHING = 8  # Children per node
+MORTON_BITS = 10  # Bits per axis of the Morton codes
+CHILDREN = np.arange(BRANCHING)  # Offsets of a node's children from BRANCHING times its index
+SCALAR_BOXES = 2048  # Trees over at most this many boxes are also kept as Python lists and walked a node at a time
+PROBE_CACHE = 8  # Recent sphere queries a WorldBVH remembers the answers to
+
+# The nearest thing a ray hits: how far along the ray it is, the world space point, the Item (or
+# (InstanceBatch, index) pair) that was hit, the index of the triangle in its mesh and the unit
+# world space normal of that triangle, facing the ray
+RayHit = namedtuple('RayHit', ['distance', 'point', 'object', 'triangle', 'normal'])
+
+
+def spread_bits(values):
+    """
+    Spreads the low MORTON_BITS bits of each value out to every third bit, for interleaving.
+    """
+    values = values.astype(np.uint64) & np.uint64(0x3ff)
+    for shift, mask in ((16, 0x30000ff), (8, 0x300f00f), (4, 0x30c30c3), (2, 0x9249249)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def morton_codes(points):
+    """
+    Returns the Morton code of each of an (N, 3) array of points, quantized within their bounding box.
+    Points close together in space mostly get codes close together.
+    """
+    low, high = points.min(axis=0), points.max(axis=0)
+    size = np.where(high > low, high - low, 1)
+    cells = np.clip((points - low) / size * (2**MORTON_BITS - 1), 0, 2**MORTON_BITS - 1)
+    return (spread_bits(cells[:, 0]) << np.uint64(2)) | (spread_bits(cells[:, 1]) << np.uint64(1)) | spread_bits(cells[:, 2])
+
+
+class BVH:
+    """
+    A tree over N boxes given as (N, 3) arrays of min and max corners. Queries return the indices
+    of the boxes they touch; testing what is inside the boxes is up to the caller.
+    """
+
+    def __init__(self, mins, maxs, leaf_size=LEAF_SIZE):
+        mins = np.asarray(mins, dtype=float)
+        maxs = np.asarray(maxs, dtype=float)
+        self.count = len(mins)
+        self.leaf_size = leaf_size
+        leaves = max(1, -(-self.count // leaf_size))
+        self.depth = 1  # So the root always has children, which is where queries start
+        while BRANCHING**self.depth < leaves:
+            self.depth += 1
+        # Box indices in tree order; slots past the last box stay empty
+        self.order = np.argsort(morton_codes((mins + maxs) / 2), kind='stable') if self.count else np.empty(0, dtype=np.int64)
+        self.refit(mins, maxs)
+
+    def refit(self, mins, maxs):
+        """
+        Recomputes every node's box from new boxes, keeping the shape of the tree. The boxes must
+        be in the same order as when the tree was built. Moving boxes a long way leaves the tree
+        correct but slower to query than a new one.
+        """
+        # Empty slots are NaN boxes, which fail every comparison and which fmin and fmax skip
+        boxes = np.full((BRANCHING**self.depth * self.leaf_size, 2, 3), np.nan)
+        boxes[:self.count, 0] = np.asarray(mins, dtype=float)[self.order]
+        boxes[:self.count, 1] = np.asarray(maxs, dtype=float)[self.order]
+        self.boxes = boxes
+
+        # levels[d] holds the (BRANCHING**d, 2, 3) min and max corners of the nodes at depth d
+        level = self.union(boxes, self.leaf_size)
+        levels = [level]
+        while len(level) > 1:
+            level = self.union(level, BRANCHING)
+            levels.append(level)
+        self.levels = levels[::-1]
+        self.slot_offsets = np.arange(self.leaf_size)
+        # Every level below the root then the leaf slots, as lists of [x_min, y_min, z_min, x_max, y_max, z_max]
+        self.node_lists = self.order_list = None
+        if self.count <= SCALAR_BOXES:
+            self.node_lists = [level.reshape(-1, 6).tolist() for level in self.levels[1:]] + [boxes.reshape(-1, 6).tolist()]
+            self.order_list = self.order.tolist()
+
+    @staticmethod
+    def union(boxes, group):
+        """
+        Returns the boxes around each run of group boxes of a (N, 2, 3) array.
+        """
+        boxes = boxes.reshape(-1, group, 2, 3)
+        return np.stack((np.fmin.reduce(boxes[:, :, 0], axis=1), np.fmax.reduce(boxes[:, :, 1], axis=1)), axis=1)
+
+    def ray_query(self, origin, direction, max_distance=np.inf):
+        """
+        Returns the indices of the boxes a ray from origin along direction enters within max_distance
+        (in units of direction's length), and the distance at which it enters each.
+        """
+        origin = np.asarray(origin, dtype=float)
+        direction = np.asarray(direction, dtype=float)
+        # A huge finite slope along axes the ray doesn't move on avoids the NaNs of 0 * inf
+        inv_direction = 1 / np.where(direction == 0, 1e-300, direction)
+        if self.node_lists is not None:
+            origin_list, inv_list = origin.tolist(), inv_direction.tolist()
+            indices, near = self.scalar_walk(lambda boxes, indices: ray_box_list(boxes, indices, origin_list, inv_list,
+                                                                                 max_distance))
+            return np.array(indices, dtype=np.int64), np.array(near, dtype=float)
+        # Testing the root would cost as much as testing all its children, so start with them
+        nodes = np.zeros(1, dtype=np.int64)
+        for level in self.levels[1:]:
+            nodes = (BRANCHING * nodes[:, np.newaxis] + CHILDREN).ravel()
+            hit, near = ray_boxes(level[nodes], origin, inv_direction, max_distance)
+            nodes = nodes[hit]
+            if len(nodes) == 0:
+                return nodes, near[hit]
+
+        slots = (nodes[:, np.newaxis] * self.leaf_size + self.slot_offsets).ravel()
+        hit, near = ray_boxes(self.boxes[slots], origin, inv_direction, max_distance)
+        return self.order[slots[hit]], near[hit]
+
+    def box_query(self, box_min, box_max):
+        """
+        Returns the indices of the boxes that overlap the box from box_min to box_max.
+        """
+        box_min = np.asarray(box_min, dtype=float)
+        box_max = np.asarray(box_max, dtype=float)
+        if self.node_lists is not None:
+            low, high = box_min.tolist(), box_max.tolist()
+            return np.array(self.scalar_walk(lambda boxes, indices: overlaps_list(boxes, indices, low, high))[0],
+                            dtype=np.int64)
+        nodes = np.zeros(1, dtype=np.int64)
+        for level in self.levels[1:]:
+            nodes = (BRANCHING * nodes[:, np.newaxis] + CHILDREN).ravel()
+            nodes = nodes[overlaps(level[nodes], box_min, box_max)]
+            if len(nodes) == 0:
+                return nodes
+
+        slots = (nodes[:, np.newaxis] * self.leaf_size + self.slot_offsets).ravel()
+        return self.order[slots[overlaps(self.boxes[slots], box_min, box_max)]]
+
+    def scalar_walk(self, test):
+        """
+        Walks a small tree in plain Python, a level at a time like the NumPy walks. test(boxes, indices) is
+        given one of node_lists and the indices of the boxes in it still in play, and returns the indices
+        to keep and a value for each. Returns the indices of the boxes kept at the leaves and their values.
+        """
+        nodes = [0]
+        for level in self.node_lists[:-1]:
+            nodes = test(level, [child for node in nodes for child in range(BRANCHING * node, BRANCHING * node + BRANCHING)])[0]
+        slots, values = test(self.node_lists[-1], [slot for node in nodes
+                                                   for slot in range(node * self.leaf_size, (node + 1) * self.leaf_size)])
+        return [self.order_list[slot] for slot in slots], values
+
+
+def ray_boxes(boxes, origin, inv_direction, max_distance):
+    """
+    Slab test of one ray, or one ray per box given as (N, 1, 3) arrays, against (N, 2, 3) boxes. Returns whether each is hit within max_distance,
+    and the distance along the ray at which it is entered (0 if the ray starts inside).
+    """
+    t = (boxes - origin) * inv_direction
+    # Reductions over short axes are slow in NumPy, so the three slabs are combined by hand
+    low, high = np.minimum(t[:, 0], t[:, 1]), np.maximum(t[:, 0], t[:, 1])
+    near = np.maximum(np.maximum(np.maximum(low[:, 0], low[:, 1]), low[:, 2]), 0)
+    far = np.minimum(np.minimum(high[:, 0], high[:, 1]), high[:, 2])
+    return (near <= far) & (near <= max_distance), near
+
+
+def overlaps(boxes, box_min, box_max):
+    """
+    Returns whether each of (N, 2, 3) boxes overlaps the box from box_min to box_max, or from
+    the matching row of (N, 3) box_min and box_max.
+    """
+    inside = (boxes[:, 0] <= box_max) & (boxes[:, 1] >= box_min)
+    return inside[:, 0] & inside[:, 1] & inside[:, 2]
+
+
+def ray_box_list(boxes, indices, origin, inv_direction, max_distance):
+    """
+    ray_boxes in plain Python, for the boxes at indices of a list of node_lists boxes and the ray as lists.
+    Returns the indices of the boxes hit and the distance at which the ray enters each.
+    """
+    ox, oy, oz = origin
+    ix, iy, iz = inv_direction
+    hit, entries = [], []
+    for index in indices:
+        x0, y0, z0, x1, y1, z1 = boxes[index]
+        if x0 != x0:  # An empty slot
+            continue
+        # The three slabs unrolled, and comparisons instead of min and max, since this is the inner loop of a walk
+        t0, t1 = (x0 - ox) * ix, (x1 - ox) * ix
+        near, far = (t1, t0) if t0 > t1 else (t0, t1)
+        if near < 0.0:
+            near = 0.0
+        if far > max_distance:
+            far = max_distance
+        t0, t1 = (y0 - oy) * iy, (y1 - oy) * iy
+        if t0 > t1:
+            t0, t1 = t1, t0
+        if t0 > near:
+            near = t0
+        if t1 < far:
+            far = t1
+        t0, t1 = (z0 - oz) * iz, (z1 - oz) * iz
+        if t0 > t1:
+            t0, t1 = t1, t0
+        if t0 > near:
+            near = t0
+        if t1 < far:
+            far = t1
+        if near <= far:
+            hit.append(index)
+            entries.append(near)
+    return hit, entries
+
+
+def overlaps_list(boxes, indices, box_min, box_max):
+    """
+    overlaps in plain Python, for the boxes at indices of a list of node_lists boxes and lists of corners.
+    Returns the indices of the boxes that overlap, twice, as scalar_walk expects a value for each.
+    """
+    lx, ly, lz = box_min
+    hx, hy, hz = box_max
+    kept = []
+    for index in indices:
+        x0, y0, z0, x1, y1, z1 = boxes[index]
+        if x0 <= hx and x1 >= lx and y0 <= hy and y1 >= ly and z0 <= hz and z1 >= lz:
+            kept.append(index)
+    return kept, kept
+
+
+class Forest:
+    """
+    Several BVHs walked together, so a query against many trees (one per object a ray passes near,
+    each in its own model space) costs a few array operations per level instead of per tree.
+    The trees' levels are concatenated with their leaves lined up, so a shallower tree joins
+    the walk a few levels in. All the trees must have the same leaf_size.
+    """
+
+    def __init__(self, trees):
+        self.trees = trees
+        self.leaf_size = trees[0].leaf_size if trees else LEAF_SIZE
+        heights = np.array([len(tree.levels) - 1 for tree in trees], dtype=np.int64)  # Levels below the root
+        self.height = int(heights.max()) if len(trees) else 0
+        self.starts = self.height - heights  # Forest level of each tree's first level
+
+        # level_offsets[d, m] is where tree m's nodes start in forest level d
+        self.level_offsets = np.zeros((self.height, len(trees)), dtype=np.int64)
+        self.levels = []
+        for depth in range(self.height):
+            blocks, offset = [], 0
+            for idx, tree in enumerate(trees):
+                if depth >= self.starts[idx]:
+                    self.level_offsets[depth, idx] = offset
+                    blocks.append(tree.levels[1 + depth - self.starts[idx]])
+                    offset += len(blocks[-1])
+            self.levels.append(np.concatenate(blocks))
+
+        # Leaf slots, and the box each holds numbered across all the trees
+        self.slot_offsets = np.cumsum([0] + [len(tree.boxes) for tree in trees])[:-1]
+        self.box_offsets = np.cumsum([0] + [tree.count for tree in trees])
+        self.boxes = np.concatenate([tree.boxes for tree in trees]) if trees else np.empty((0, 2, 3))
+        self.order = np.full(len(self.boxes), -1, dtype=np.int64)  # Empty slots hold -1
+        for tree, slot_offset, box_offset in zip(trees, self.slot_offsets, self.box_offsets):
+            self.order[slot_offset:slot_offset + tree.count] = tree.order + box_offset
+        self.slot_range = np.arange(self.leaf_size)
+
+    def walk(self, trees, test):
+        """
+        Runs one query per entry of trees, an array of tree indices. test(boxes, queries) is given the
+        (P, 2, 3) boxes still in play and the index of the query each is for, and returns which to keep.
+        Returns the query index and the forest-wide box index of every box kept at the leaves.
+        """
+        starts = self.starts[trees]
+        pair_query = np.empty(0, dtype=np.int64)
+        pair_node = np.empty(0, dtype=np.int64)
+        for depth, level in enumerate(self.levels):
+            if len(pair_node):
+                tree = trees[pair_query]
+                local = pair_node - self.level_offsets[depth - 1, tree]
+                pair_node = (self.level_offsets[depth, tree][:, np.newaxis] + BRANCHING * local[:, np.newaxis] + CHILDREN).ravel()
+                pair_query = np.repeat(pair_query, BRANCHING)
+            starting = np.flatnonzero(starts == depth)
+            if len(starting):
+                # Queries join at the children of their tree's root
+                pair_query = np.concatenate((pair_query, np.repeat(starting, BRANCHING)))
+                pair_node = np.concatenate((pair_node, (self.level_offsets[depth, trees[starting]][:, np.newaxis] + CHILDREN).ravel()))
+            keep = test(level[pair_node], pair_query)
+            pair_query, pair_node = pair_query[keep], pair_node[keep]
+
+        tree = trees[pair_query]
+        local = pair_node - self.level_offsets[-1, tree] if self.height else pair_node
+        slots = (self.slot_offsets[tree][:, np.newaxis] + self.leaf_size * local[:, np.newaxis] + self.slot_range).ravel()
+        pair_query = np.repeat(pair_query, self.leaf_size)
+        keep = test(self.boxes[slots], pair_query)
+        return pair_query[keep], self.order[slots[keep]]
+
+
+def cross(a, b):
+    """
+    Cross products of two broadcastable (..., 3) arrays; much quicker than np.cross for the short arrays here.
+    """
+    a0, a1, a2 = a[..., 0], a[..., 1], a[..., 2]
+    b0, b1, b2 = b[..., 0], b[..., 1], b[..., 2]
+    return np.stack((a1 * b2 - a2 * b1, a2 * b0 - a0 * b2, a0 * b1 - a1 * b0), axis=-1)
+
+
+def ray_triangles(origin, direction, v0, v1, v2):
+    """
+    Intersects one ray, or one ray per triangle given as (N, 3) origins and directions, with (N, 3)
+    triangle corners, from either side (Moller-Trumbore).
+    Returns the distance along the ray to each triangle, inf where it misses.
+    """
+    edge1, edge2 = v1 - v0, v2 - v0
+    p = cross(direction, edge2)
+    det = np.einsum('ij,ij->i', edge1, p)
+    valid = np.abs(det) > 1e-12
+    inv_det = 1 / np.where(valid, det, 1)
+    s = origin - v0
+    u = np.einsum('ij,ij->i', s, p) * inv_det
+    q = cross(s, edge1)
+    v = (q * direction).sum(axis=1) * inv_det
+    t = np.einsum('ij,ij->i', edge2, q) * inv_det
+    hit = valid & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 1e-9)
+    return np.where(hit, t, np.inf)
+
+
+def ray_triangle(origin, direction, corners):
+    """
+    ray_triangles for a single triangle given as a list of its nine corner coordinates, and the ray as lists.
+    Returns the distance along the ray to the triangle, or None if it misses.
+    """
+    x0, y0, z0, x1, y1, z1, x2, y2, z2 = corners
+    e1x, e1y, e1z = x1 - x0, y1 - y0, z1 - z0
+    e2x, e2y, e2z = x2 - x0, y2 - y0, z2 - z0
+    dx, dy, dz = direction
+    px, py, pz = dy * e2z - dz * e2y, dz * e2x - dx * e2z, dx * e2y - dy * e2x
+    det = e1x * px + e1y * py + e1z * pz
+    if not abs(det) > 1e-12:
+        return None
+    inv_det = 1 / det
+    sx, sy, sz = origin[0] - x0, origin[1] - y0, origin[2] - z0
+    u = (sx * px + sy * py + sz * pz) * inv_det
+    if u < 0:
+        return None
+    qx, qy, qz = sy * e1z - sz * e1y, sz * e1x - sx * e1z, sx * e1y - sy * e1x
+    v = (qx * dx + qy * dy + qz * dz) * inv_det
+    if v < 0 or u + v > 1:
+        return None
+    t = (e2x * qx + e2y * qy + e2z * qz) * inv_det
+    return t if t > 1e-9 else None
+
+
+def segment_distances(point, start, end):
+    """
+    Returns the distance from a point to each of (N, 3) line segments.
+    """
+    segment = end - start
+    length2 = np.einsum('ij,ij->i', segment, segment)
+    t = np.clip(np.einsum('ij,ij->i', point - start, segment) / np.where(length2 > 0, length2, 1), 0, 1)
+    offset = start + segment * t[:, np.newaxis] - point
+    return np.sqrt(np.einsum('ij,ij->i', offset, offset))
+
+
+def point_triangle_distances(point, v0, v1, v2):
+    """
+    Returns the distance from a point to the nearest point of each of (N, 3) triangles.
+    """
+    # Barycentric coordinates of the point dropped onto each triangle's plane
+    edge1, edge2, offset = v1 - v0, v2 - v0, point - v0
+    d11, d12, d22 = np.einsum('ij,ij->i', edge1, edge1), np.einsum('ij,ij->i', edge1, edge2), np.einsum('ij,ij->i', edge2, edge2)
+    d1, d2 = np.einsum('ij,ij->i', offset, edge1), np.einsum('ij,ij->i', offset, edge2)
+    denominator = d11 * d22 - d12 * d12
+    valid = denominator > 1e-12 * d11 * d22  # Not collapsed to a line or point, give or take rounding
+    inv_denominator = 1 / np.where(valid, denominator, 1)
+    u = (d22 * d1 - d12 * d2) * inv_denominator
+    v = (d11 * d2 - d12 * d1) * inv_denominator
+    inside = valid & (u >= 0) & (v >= 0) & (u + v <= 1)
+    to_plane = offset - u[:, np.newaxis] * edge1 - v[:, np.newaxis] * edge2
+    plane_distance = np.sqrt(np.einsum('ij,ij->i', to_plane, to_plane))
+
+    # Otherwise the nearest point is on an edge; all three are measured in one go
+    edges = segment_distances(point, np.concatenate((v0, v1, v2)), np.concatenate((v1, v2, v0)))
+    return np.where(inside, plane_distance, edges.reshape(3, -1).min(axis=0))
+
+
+def segment_distance(point, start, end):
+    """
+    segment_distances in plain Python, for one segment with the point and ends as lists.
+    """
+    sx, sy, sz = end[0] - start[0], end[1] - start[1], end[2] - start[2]
+    ox, oy, oz = point[0] - start[0], point[1] - start[1], point[2] - start[2]
+    length2 = sx * sx + sy * sy + sz * sz
+    t = min(max((ox * sx + oy * sy + oz * sz) / length2, 0.0), 1.0) if length2 > 0 else 0.0
+    dx, dy, dz = ox - sx * t, oy - sy * t, oz - sz * t
+    return sqrt(dx * dx + dy * dy + dz * dz)
+
+
+def point_triangle_distance(point, corners):
+    """
+    point_triangle_distances in plain Python, for one triangle given as a list of its nine corner
+    coordinates and the point as a list.
+    """
+    v0, v1, v2 = corners[0:3], corners[3:6], corners[6:9]
+    ax, ay, az = v1[0] - v0[0], v1[1] - v0[1], v1[2] - v0[2]
+    bx, by, bz = v2[0] - v0[0], v2[1] - v0[1], v2[2] - v0[2]
+    ox, oy, oz = point[0] - v0[0], point[1] - v0[1], point[2] - v0[2]
+    d11, d12, d22 = ax * ax + ay * ay + az * az, ax * bx + ay * by + az * bz, bx * bx + by * by + bz * bz
+    d1, d2 = ox * ax + oy * ay + oz * az, ox * bx + oy * by + oz * bz
+    denominator = d11 * d22 - d12 * d12
+    if denominator > 1e-12 * d11 * d22:
+        u = (d22 * d1 - d12 * d2) / denominator
+        v = (d11 * d2 - d12 * d1) / denominator
+        if u >= 0 and v >= 0 and u + v <= 1:
+            dx, dy, dz = ox - u * ax - v * bx, oy - u * ay - v * by, oz - u * az - v * bz
+            return sqrt(dx * dx + dy * dy + dz * dz)
+    return min(segment_distance(point, v0, v1), segment_distance(point, v1, v2), segment_distance(point, v2, v0))
+
+
+class WorldBVH:
+    """
+    Ray and sphere queries against the Items and instances of a world. Call update before querying
+    after the world changed: added objects rebuild the tree over the objects, moved ones only refit it.
+    Terrain chunks are not included.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.mesh_trees = {}  # id of a MeshData -> (MeshData, BVH over its triangles)
+        self.objects = []  # Items and (InstanceBatch, index) pairs, in the order of the tree's boxes
+        self.tree = None
+        self.forest = Forest([])  # The trees of the objects' models, walked together
+        self.walk_small = False  # Whether every model tree is small enough to walk one object at a time instead
+        self.triangles = np.empty((0, 3, 3))  # Model space corners of the forest's triangles
+        self.mesh_ids = np.empty(0, dtype=np.int64)  # Each object's tree in the forest
+        self.shape_key = None  # Which objects the tree was built over
+        self.motion_key = None  # Where they were when it was last fitted
+        self.rebuilds = 0
+        self.refits = 0
+        # (center, radius) -> objects, for recent sphere queries; movement probes the same spots repeatedly
+        self.probe_cache = {}
+
+    def mesh_tree(self, mesh):
+        """
+        Returns the tree over a model's triangles, building it the first time.
+        """
+        entry = self.mesh_trees.get(id(mesh))
+        if entry is None or entry[0] is not mesh:
+            triangles = np.asarray(mesh.triangles, dtype=float)
+            entry = (mesh, BVH(triangles.min(axis=1), triangles.max(axis=1)))
+            self.mesh_trees[id(mesh)] = entry
+        return entry[1]
+
+    def update(self):
+        """
+        Brings the tree up to date with the world. Returns 'rebuilt', 'refit' or None if nothing changed.
+        """
+        items = [item for item in list(self.world.items) if hasattr(item, 'mesh')]
+        batches = [batch for batch in list(self.world.instances.values()) if len(batch)]
+        shape_key = (tuple(id(item) for item in items), tuple((id(batch), len(batch)) for batch in batches))
+        motion_key = (tuple(item.version for item in items), tuple(batch.version for batch in batches))
+        if shape_key == self.shape_key and motion_key == self.motion_key:
+            return None
+        self.probe_cache = {}
+
+        # Each object's mesh, model matrix and world box
+        meshes, matrices, mins, maxs = [], [], [], []
+        objects = list(items)
+        for item in items:
+            meshes.append(item.mesh)
+            matrices.append(item.get_transform_matrix(item.location, item.orientation, item.scale)[np.newaxis])
+            mins.append(item.aabb[np.newaxis, 0])
+            maxs.append(item.aabb[np.newaxis, 1])
+        for batch in batches:
+            meshes.extend([batch.mesh] * len(batch))
+            objects.extend((batch, idx) for idx in range(len(batch)))
+            matrices.append(batch.transform_matrices())
+            centers, radii, aabbs = batch.get_bounds()
+            mins.append(aabbs[:, 0])
+            maxs.append(aabbs[:, 1])
+
+        self.objects = objects
+        if objects:
+            self.matrices = np.concatenate(matrices)
+            self.inverses = np.linalg.inv(self.matrices)
+            mins, maxs = np.concatenate(mins), np.concatenate(maxs)
+        else:
+            self.matrices = self.inverses = np.empty((0, 4, 4))
+            mins = maxs = np.empty((0, 3))
+
+        changed = 'refit'
+        if shape_key == self.shape_key:
+            self.tree.refit(mins, maxs)
+            self.refits += 1
+        else:
+            self.build_forest(meshes)
+            self.tree = BVH(mins, maxs, OBJECT_LEAF_SIZE)
+            self.rebuilds += 1
+            changed = 'rebuilt'
+        self.shape_key, self.motion_key = shape_key, motion_key
+        # The top three rows of each matrix and its inverse, for queries walked in Python
+        self.matrix_rows = self.matrices[:, :3].tolist() if self.walk_small else None
+        self.inverse_rows = self.inverses[:, :3].tolist() if self.walk_small else None
+        return changed
+
+    def build_forest(self, meshes):
+        """
+        Puts the tree of every distinct model among the objects' meshes into the forest.
+        """
+        index = {}
+        self.mesh_ids = np.array([index.setdefault(id(mesh), len(index)) for mesh in meshes], dtype=np.int64)
+        distinct = list({id(mesh): mesh for mesh in meshes}.values())  # In the order they were numbered
+        self.meshes = distinct
+        self.forest = Forest([self.mesh_tree(mesh) for mesh in distinct])
+        self.walk_small = all(tree.node_lists is not None for tree in self.forest.trees)
+        self.triangles = (np.concatenate([np.asarray(mesh.triangles, dtype=float) for mesh in distinct])
+                          if distinct else np.empty((0, 3, 3)))
+        # The same as lists, for queries walked in Python
+        self.mesh_id_list = self.mesh_ids.tolist()
+        self.box_offset_list = self.forest.box_offsets.tolist()
+        self.triangle_lists = self.triangles.reshape(-1, 9).tolist() if self.walk_small else None
+
+    def raycast(self, origin, direction, max_distance=np.inf):
+        """
+        Returns the RayHit of the nearest triangle a ray from origin along direction hits within
+        max_distance, or None if it hits nothing. direction doesn't need to be normalized; distances are in world units.
+        """
+        if self.tree is None:
+            return None
+        origin = np.asarray(origin, dtype=float)
+        direction = np.asarray(direction, dtype=float)
+        direction = direction / np.linalg.norm(direction)
+
+        candidates, entry = self.tree.ray_query(origin, direction, max_distance)
+        order = np.argsort(entry)
+        candidates, entry = candidates[order], entry[order]
+        # Objects are tested nearest first until the next one starts beyond the nearest hit: in Python one
+        # at a time when the model trees are small, otherwise a batch at a time
+        best, hit = max_distance, None
+        if self.walk_small:
+            origin_list, direction_list = origin.tolist(), direction.tolist()
+            for obj, obj_entry in zip(candidates.tolist(), entry.tolist()):
+                if obj_entry >= best:
+                    break
+                object_hit = self.ray_object(obj, origin_list, direction_list, best)
+                if object_hit is not None:
+                    best, hit = object_hit[0], object_hit
+        else:
+            start, batch = 0, RAY_BATCH
+            while start < len(candidates) and entry[start] < best:
+                batch_hit = self.ray_objects(candidates[start:start + batch], origin, direction, best)
+                if batch_hit is not None:
+                    best, hit = batch_hit[0], batch_hit
+                start += batch
+                batch *= 4
+        if hit is None:
+            return None
+
+        distance, obj, triangle, corners = hit
+        matrix = self.matrices[obj]
+        world_triangle = corners.dot(matrix[:3, :3].T) + matrix[:3, 3]
+        normal = cross(world_triangle[1] - world_triangle[0], world_triangle[2] - world_triangle[0])
+        normal /= np.linalg.norm(normal)
+        if normal.dot(direction) > 0:
+            normal = -normal
+        return RayHit(float(distance), origin + direction * distance, self.objects[obj], triangle, normal)
+
+    def ray_objects(self, candidates, origin, direction, max_distance):
+        """
+        Intersects a ray with the triangles of the objects with the given indices. Returns the distance,
+        object index, triangle index and model space corners of the nearest hit within max_distance, or None.
+        """
+        # The ray in each object's model space, where distances along it are still in world units
+        inverses = self.inverses[candidates]
+        origins = np.einsum('kij,j->ki', inverses[:, :3, :3], origin) + inverses[:, :3, 3]
+        directions = np.einsum('kij,j->ki', inverses[:, :3, :3], direction)
+        inv_directions = 1 / np.where(directions == 0, 1e-300, directions)
+
+        def test(boxes, queries):
+            return ray_boxes(boxes, origins[queries, np.newaxis], inv_directions[queries, np.newaxis], max_distance)[0]
+
+        queries, tris = self.forest.walk(self.mesh_ids[candidates], test)
+        if len(tris) == 0:
+            return None
+        corners = self.triangles[tris]
+        t = ray_triangles(origins[queries], directions[queries], corners[:, 0], corners[:, 1], corners[:, 2])
+        nearest = np.argmin(t)
+        if not t[nearest] < max_distance:
+            return None
+        obj = candidates[queries[nearest]]
+        return t[nearest], obj, int(tris[nearest] - self.forest.box_offsets[self.mesh_ids[obj]]), corners[nearest]
+
+    def ray_object(self, obj, origin, direction, max_distance):
+        """
+        ray_objects for the single object with index obj, in plain Python for when walk_small is set.
+        origin and direction are lists.
+        """
+        rows = self.inverse_rows[obj]
+        model_origin = [row[0] * origin[0] + row[1] * origin[1] + row[2] * origin[2] + row[3] for row in rows]
+        model_direction = [row[0] * direction[0] + row[1] * direction[1] + row[2] * direction[2] for row in rows]
+        inv_direction = [1 / value if value != 0 else 1e300 for value in model_direction]
+        mesh_id = self.mesh_id_list[obj]
+        tris = self.forest.trees[mesh_id].scalar_walk(
+            lambda boxes, indices: ray_box_list(boxes, indices, model_origin, inv_direction, max_distance))[0]
+
+        offset = self.box_offset_list[mesh_id]
+        best, nearest = max_distance, None
+        for tri in tris:
+            t = ray_triangle(model_origin, model_direction, self.triangle_lists[offset + tri])
+            if t is not None and t < best:
+                best, nearest = t, tri
+        if nearest is None:
+            return None
+        return best, obj, nearest, self.triangles[offset + nearest]
+
+    def sphere_objects(self, center, radius):
+        """
+        Returns the objects with a triangle within radius of center.
+        Answers for the last few spheres are remembered until the world changes.
+        """
+        if self.tree is None:
+            return []
+        center = np.asarray(center, dtype=float)
+        key = (tuple(center.tolist()), radius)
+        objects = self.probe_cache.get(key)
+        if objects is None:
+            if len(self.probe_cache) >= PROBE_CACHE:
+                self.probe_cache = {}
+            objects = self.probe_cache[key] = self.find_sphere_objects(center, radius)
+        return list(objects)
+
+    def find_sphere_objects(self, center, radius):
+        """
+        Does the work of sphere_objects.
+        """
+        candidates = self.tree.box_query(center - radius, center + radius)
+        if len(candidates) == 0:
+            return []
+        if self.walk_small:
+            center = center.tolist()
+            return [self.objects[obj] for obj in candidates.tolist() if self.sphere_touches(obj, center, radius)]
+        # Object rotations aren't quite orthonormal, so in model space the sphere is an ellipsoid;
+        # find the triangles in the box around that, then measure the distances in world space
+        inverses = self.inverses[candidates]
+        centers = np.einsum('kij,j->ki', inverses[:, :3, :3], center) + inverses[:, :3, 3]
+        extents = radius * np.linalg.norm(inverses[:, :3, :3], axis=2)
+        lows, highs = centers - extents, centers + extents
+
+        def test(boxes, queries):
+            return overlaps(boxes, lows[queries], highs[queries])
+
+        queries, tris = self.forest.walk(self.mesh_ids[candidates], test)
+        if len(tris) == 0:
+            return []
+        matrices = self.matrices[candidates[queries]]
+        corners = np.einsum('pij,pkj->pki', matrices[:, :3, :3], self.triangles[tris]) + matrices[:, np.newaxis, :3, 3]
+        touching = queries[point_triangle_distances(center, corners[:, 0], corners[:, 1], corners[:, 2]) <= radius]
+        return [self.objects[obj] for obj in candidates[np.unique(touching)]]
+
+    def sphere_touches(self, obj, center, radius):
+        """
+        Returns whether a sphere touches a triangle of the object with index obj, in plain Python for
+        when walk_small is set. center is a list.
+        """
+        # As in find_sphere_objects, the triangles are found in model space and measured in world space
+        rows = self.inverse_rows[obj]
+        model_center = [row[0] * center[0] + row[1] * center[1] + row[2] * center[2] + row[3] for row in rows]
+        extents = [radius * sqrt(row[0] * row[0] + row[1] * row[1] + row[2] * row[2]) for row in rows]
+        low = [value - extent for value, extent in zip(model_center, extents)]
+        high = [value + extent for value, extent in zip(model_center, extents)]
+        mesh_id = self.mesh_id_list[obj]
+        tris = self.forest.trees[mesh_id].scalar_walk(lambda boxes, indices: overlaps_list(boxes, indices, low, high))[0]
+
+        rows = self.matrix_rows[obj]
+        offset = self.box_offset_list[mesh_id]
+        for tri in tris:
+            corners = self.triangle_lists[offset + tri]
+            world = [row[0] * corners[k] + row[1] * corners[k + 1] + row[2] * corners[k + 2] + row[3]
+                     for k in (0, 3, 6) for row in rows]
+            if point_triangle_distance(center, world) <= radius:
+                return True
+        return False
+
+    def sphere_collides(self, center, radius):
+        """
+        Returns whether a sphere touches any object's triangles.
+        """
+        return len(self.sphere_objects(center, radius)) > 0
+
+    def camera_ray(self, camera):
+        """
+        Returns the origin and unit direction of the ray through the center of the view of camera
+        (a Camera or CameraState), where the crosshair is drawn.
+        """
+        view = transforms.view_matrix(camera.pos, camera.angle)
+        # Points are row vectors and the rotation is orthonormal, so the view's z axis is its third column
+        direction = view[:3, 2]
+        return np.asarray(camera.pos, dtype=float), direction / np.linalg.norm(direction)
+
+    def pick(self, camera, max_distance=np.inf):
+        """
+        Returns the RayHit of what is under the crosshair of camera, or None.
+        """
+        origin, direction = self.camera_ray(camera)
+        return self.raycast(origin, direction, max_distance)
@@ -5,6 +5,10 @@ Represents the camera object, storing position/orientation information
 @Author: Adam Novotny
 """
 from math import sin, cos, pi
+from collections import namedtuple
+
+# An immutable copy of a camera's position, orientation and field of view
+CameraState = namedtuple('CameraState', ['pos', 'angle', 'fov', 'version'])
 
 
 class Camera:
@@ -15,22 +19,60 @@ class Camera:
         self.pos = init_pos
         self.angle = init_angle
         self.fov = init_fov
+        self.version = 0  # Bumped every time the camera moves or turns
 
     def __str__(self):
         return "Camera object at: {}, {}, {}. Angles: {}, {}, {}. Fov: {}".format(self.pos[0], self.pos[1], self.pos[2], self.angle[0], self.angle[1], self.angle[2], self.fov)
 
-    def move(self, movement, speed=0.0001):
+    def move(self, movement, speed=0.0001, blocked=None):
         """
         Moves the position of the camera object along the x and z axes (the axes of movement)
+        blocked is an optional function of a position returning whether the camera can't be there;
+        a blocked step slides along whichever of the x and z axes is still free.
+        Returns whether the camera moved.
         """
-        self.pos[0] += (movement[0]*speed*cos(self.angle[0]))+(movement[2]*speed*sin(self.angle[0]))
-        self.pos[2] += (movement[0]*speed*sin(-self.angle[0]))+(movement[2]*speed*cos(self.angle[0]))
+        if not speed or not any(movement):
+            return False
+        step = [(movement[0]*speed*cos(self.angle[0]))+(movement[2]*speed*sin(self.angle[0])), 0,
+                (movement[0]*speed*sin(-self.angle[0]))+(movement[2]*speed*cos(self.angle[0]))]
+        if blocked is not None and not blocked(self.pos):  # Never trap a camera that is already inside something
+            for x, z in ((step[0], step[2]), (step[0], 0), (0, step[2])):
+                pos = [self.pos[0] + x, self.pos[1], self.pos[2] + z]
+                if (x or z) and not blocked(pos):
+                    break
+            else:
+                return False
+        else:
+            pos = [self.pos[0] + step[0], self.pos[1], self.pos[2] + step[2]]
+        self.pos = pos
+        self.version += 1
+        return True
 
     def rotate(self, yaw, pitch, roll, sensitivity=.1):
         """
         Rotates the orientation matrix of the camera. Restricts y-axis orientation to (-pi/2, pi/2)
         """
+        if not sensitivity or not (yaw or pitch or roll):
+            return
         self.angle[0] += yaw*sensitivity
         # Restricts pitch rotation
         self.angle[1] = max(-pi/2, min(pi/2, self.angle[1] + pitch*sensitivity))
         self.angle[2] += roll*sensitivity
+        self.version += 1
+
+    def set_pose(self, pos=None, angle=None):
+        """
+        Places the camera at pos and/or points it at angle. Arguments left as None keep their current value.
+        """
+        if pos is not None:
+            self.pos = list(pos)
+        if angle is not None:
+            self.angle = list(angle)
+        self.version += 1
+
+    def snapshot(self):
+        """
+        Returns an immutable CameraState of the current position, orientation and fov,
+        which other threads can read while the camera keeps moving.
+        """
+        return CameraState(tuple(self.pos), tuple(self.angle), self.fov, self.version)
@@ -0,0 +1,166 @@
+"""
+Non-blocking frame capture. Each finished frame is copied into a slot of a preallocated ring of
+NumPy frames, which is all the render thread has to do; a pool of writer threads encodes the
+slots to disk and hands them back. When the writers fall behind and the ring is full, a frame
+is either dropped or the render thread waits for a free slot, depending on the backpressure setting.
+
+Frames are written either as a numbered PNG sequence or as one raw RGB24 video stream, which can
+be converted with e.g. ffmpeg -f rawvideo -pix_fmt rgb24 -s WIDTHxHEIGHT -i capture.rgb out.mp4
+"""
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from lazyimport import lazy_import
+
+pygame = lazy_import('pygame')
+
+
+def encode_png(frame, level=1):
+    """
+    Encodes an (H, W, 3) uint8 RGB array as PNG file bytes. zlib releases the GIL while it compresses,
+    so several frames can be encoded at once on different threads.
+    """
+    height, width = frame.shape[:2]
+    # Every row starts with a filter type byte, 0 for none
+    rows = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 0] = 0
+    rows[:, 1:] = frame.reshape(height, width * 3)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)  # 8 bit RGB, no interlacing
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows.tobytes(), level)) +
+            chunk(b'IEND', b''))
+
+
+class FrameCapture:
+    """
+    Records the frames drawn on a canvas of the given (width, height) size into directory.
+    format is 'png' for a numbered image sequence or 'raw' for a single RGB24 stream.
+    backpressure is 'drop' to skip frames while all ring_size slots are waiting to be written,
+    or 'block' to wait for one.
+    """
+
+    def __init__(self, size, directory='capture', format='png', ring_size=8, workers=2, backpressure='drop'):
+        if format not in ('png', 'raw'):
+            raise ValueError("format must be 'png' or 'raw', not {!r}".format(format))
+        if backpressure not in ('drop', 'block'):
+            raise ValueError("backpressure must be 'drop' or 'block', not {!r}".format(backpressure))
+        self.size = tuple(size)
+        self.directory = directory
+        self.format = format
+        self.backpressure = backpressure
+        os.makedirs(directory, exist_ok=True)
+
+        # Frames are copied in the [x, row] layout of pygame.surfarray and flipped to rows when written
+        self.ring = np.empty((ring_size,) + self.size + (3,), dtype=np.uint8)
+        self.free = queue.Queue()  # Indices of the slots that can be copied into
+        for slot in range(ring_size):
+            self.free.put(slot)
+        self.executor = ThreadPoolExecutor(workers)
+        self.stream = None
+        if format == 'raw':
+            self.stream = open(os.path.join(directory, 'capture.rgb'), 'wb')
+
+        self.lock = threading.Lock()  # Guards the counters the writers update
+        # Makes checking closed and submitting a frame one step, so close can't shut the writers down in between
+        self.state_lock = threading.Lock()
+        self.closed = False
+        self.frames = 0  # Frames offered to capture
+        self.captured = 0  # Frames copied into the ring
+        self.written = 0
+        self.dropped = 0
+        self.bytes_written = 0
+        self.copy_ms = 0.0  # Time the render thread spent copying frames
+        self.blocked_ms = 0.0  # Time the render thread spent waiting for a free slot
+        self.write_ms = 0.0  # Time the writers spent encoding and writing
+        self.start = time.perf_counter()
+
+    def capture(self, canvas):
+        """
+        Queues the current contents of canvas to be written. Returns False if the frame was dropped.
+        """
+        self.frames += 1
+        if self.closed:
+            return False
+        try:
+            slot = self.free.get_nowait()
+        except queue.Empty:
+            if self.backpressure == 'drop':
+                with self.lock:
+                    self.dropped += 1
+                return False
+            wait_start = time.perf_counter()
+            slot = self.free.get()
+            self.blocked_ms += (time.perf_counter() - wait_start) * 1000
+
+        copy_start = time.perf_counter()
+        pixels = pygame.surfarray.pixels3d(canvas)
+        np.copyto(self.ring[slot], pixels)
+        del pixels  # Unlocks the canvas
+        self.copy_ms += (time.perf_counter() - copy_start) * 1000
+
+        with self.state_lock:
+            if self.closed:  # Closed from another thread while this frame was being copied
+                self.free.put(slot)
+                return False
+            index = self.captured
+            self.captured += 1
+            self.executor.submit(self.write_frame, slot, index)
+        return True
+
+    def write_frame(self, slot, index):
+        """
+        Runs on a writer thread: writes a slot of the ring out as frame number index, then frees the slot.
+        """
+        write_start = time.perf_counter()
+        try:
+            frame = self.ring[slot].transpose(1, 0, 2)  # [x, row] to rows of pixels
+            if self.format == 'png':
+                data = encode_png(frame)
+                with open(os.path.join(self.directory, 'frame_{:06d}.png'.format(index)), 'wb') as f:
+                    f.write(data)
+            else:
+                data = np.ascontiguousarray(frame).tobytes()
+                # Each frame has a fixed place in the stream, so writers can finish in any order
+                os.pwrite(self.stream.fileno(), data, index * len(data))
+        except Exception as e:
+            print("Couldn't write frame {}: {}".format(index, e))
+            data = b''
+        finally:
+            self.free.put(slot)
+        with self.lock:
+            self.written += 1
+            self.bytes_written += len(data)
+            self.write_ms += (time.perf_counter() - write_start) * 1000
+
+    def stats(self):
+        """
+        Returns the capture counters and throughput as a dict.
+        """
+        elapsed = time.perf_counter() - self.start
+        with self.lock:
+            written, dropped, bytes_written, write_ms = self.written, self.dropped, self.bytes_written, self.write_ms
+        return {'frames': self.frames, 'captured': self.captured, 'written': written, 'dropped': dropped,
+                'pending': self.captured - written, 'elapsed_s': elapsed,
+                'written_fps': written / elapsed if elapsed else 0, 'written_mb_s': bytes_written / 2**20 / elapsed if elapsed else 0,
+                'copy_ms_mean': self.copy_ms / self.captured if self.captured else 0,
+                'write_ms_mean': write_ms / written if written else 0, 'blocked_ms': self.blocked_ms}
+
+    def close(self):
+        """
+        Stops capturing, waits for every captured frame to be written and returns the final stats.
+        Can be called from another thread than the one capturing.
+        """
+        with self.state_lock:
+            self.closed = True
+            self.executor.shutdown(wait=True)
+        if self.stream is not None:
+            self.stream.close()
+        return self.stats()
@@ -1,138 +1,290 @@
 """
 The main controller for our world. Initializes the world, camera, and renderer, and
 takes user input in order to control the camera's position in the world.
+
+Rendering runs on its own thread at a fixed frame rate. Input is handled on the thread that
+calls begin_scene, which sleeps in pygame.event.wait until something happens. The input side
+owns the Camera and publishes an immutable CameraState snapshot after every change; the render
+thread picks up the latest snapshot at the start of each frame, so neither side ever waits
+for the other.
 """
 
 
 from world import World
+from terrain import Terrain
 from camera import Camera
 from renderer import Renderer
 from item import Item
-import pygame
+from profiler import FrameProfiler
+from loader import AssetLoader
+from capture import FrameCapture
+from bvh import WorldBVH
+from lazyimport import lazy_import
 import threading
-import sys
+import time
+
+TRACE_FILE = 'frame_trace.json'  # Where F4 dumps the profiler's rolling window
+CAPTURE_DIR = 'capture'  # Where F5 records frames to
+MOVE_SPEED = 30  # Camera movement in world units per second
+MOUSE_SENSITIVITY = .001  # Camera rotation in radians per pixel of mouse movement
+COLLISION_RADIUS = 1.0  # How close the camera can get to an object's surface, in world units
+IDLE_TIMEOUT = 250  # Longest the input loop sleeps with nothing happening, in ms
+
+pygame = lazy_import('pygame')  # Only loaded once a scene is created
 
 
 class Scene:
-    def __init__(self, window_size=(1000, 1000)):
+    def __init__(self, window_size=(1000, 1000), world=None, headless=False, fps=60, input_rate=120, load_workers=4,
+                 adaptive_resolution=False, profile=True):
         """
         Initializes a new scene.  By default, puts one object in and sets up everything in the correct positions.
+        A headless scene renders into an offscreen surface and never opens a window.
+        fps is the target frame rate, and input_rate how often held movement keys are applied, independently of it.
+        The default objects load on load_workers background threads and appear as they finish.
+        With adaptive_resolution, the scene is drawn at a lower resolution whenever that is needed to keep up with fps.
+        profile switches the per-stage frame profiler on; without it, profiling costs nothing.
         """
         self.window_size = window_size
-        self.world = World()
-        self.world.gen_random_scene(1, 3)
+        self.loader = None
+        if world is None:
+            world = World(terrain=Terrain())
+            self.loader = AssetLoader(world, load_workers)
+            self.loader.load_specs(world.random_scene_specs(1, 3))
+        self.world = world
         # self.world.add_item([Item('teapot.stl', (0, 0, 0), (0, 0, 0), 1, color=(255, 255, 0))])
         # self.world.add_item([Item('cube.stl', (50, 10, 10), (0, 0, 0), 1, color=(255, 255, 0))])
         self.camera = Camera(init_pos=[0, 1, -10], init_angle=[0, 0, 0], init_fov=1.57)
-        self.renderer = Renderer(self.camera, window_size)
-        self.running = False
+        self.camera_state = self.camera.snapshot()  # What the renderer draws from
+        self.profiler = FrameProfiler(enabled=profile)
+        self.renderer = Renderer(self.camera, window_size, profiler=self.profiler, adaptive_resolution=adaptive_resolution,
+                                 target_frame_time=1 / fps)
+        self.fps = fps
+        self.input_rate = input_rate
+        self.stop_event = threading.Event()  # Set to shut both loops down
+        self.headless = headless
+        self.canvas = pygame.Surface(window_size) if headless else None
+        self.capture = None  # A FrameCapture recording every frame drawn, while set
+        self.collision = WorldBVH(self.world)  # Only used on the input thread
 
     def begin_scene(self):
         """
-        Begins the rendering and user input MVC loop.
+        Begins the rendering and user input MVC loop. Returns once the window is closed.
         """
-        thread_lock = threading.Lock()  # lock needed to ensure threading is happy
-        canvas = pygame.display.set_mode(self.window_size, 0, 32)
+        pygame.init()
+        self.canvas = pygame.display.set_mode(self.window_size, 0, 32)
         pygame.mouse.set_visible(False)
         # pygame.event.set_grab(True)  # Only uncomment this if you're SURE it won't break everything
-        render_thread = threading.Thread(target=self.render_cycle, args=(canvas, thread_lock,))
+        self.stop_event.clear()
+
+        render_thread = threading.Thread(target=self.render_cycle)
         render_thread.start()
+        try:
+            self.handle_user_input()
+        finally:
+            # On quit, gracefully exit
+            self.stop_event.set()
+            render_thread.join()
+            if self.world.terrain is not None:
+                self.world.terrain.close()
+            if self.loader is not None:
+                self.loader.close()
+            self.stop_capture()
+            pygame.quit()
 
-        input_thread = threading.Thread(target=self.handle_user_input, args=(thread_lock,))
-        input_thread.start()
+    def stop(self):
+        """
+        Asks the render and input loops to finish.
+        """
+        self.stop_event.set()
 
-    def render_cycle(self, canvas, lock):
+    def render_cycle(self):
         """
         handles the continuous cycle of rendering each frame.
         """
-        pygame.init()
         clock = pygame.time.Clock()
-        self.running = True
         try:
-            while self.running:
-                lock.acquire()  # Acquire lock, otherwise things get weird
-                self.renderer.draw_scene(self.world, canvas)
-                lock.release()
-                clock.tick(60)  # FPS
+            while not self.stop_event.is_set():
+                self.profiler.begin_frame()
+                self.render_frame()
+                self.profiler.end_frame()
+                clock.tick(self.fps)  # FPS
         except Exception as e:  # Avoid input grabbing issues by quitting on exception
             print(str(e))
-            sys.exit()
+            self.stop_event.set()
+
+    def render_frame(self):
+        """
+        Draws a single frame onto the scene's canvas from the latest camera snapshot, after adding
+        any objects that finished loading. Only a windowed scene updates the display.
+        """
+        if self.loader is not None:
+            self.loader.collect()
+            self.renderer.status = self.loader.status()
+        self.renderer.draw_scene(self.world, self.canvas, present=not self.headless, camera=self.camera_state)
+        capture = self.capture
+        if capture is not None:
+            with self.profiler.stage('capture'):
+                if not capture.capture(self.canvas):
+                    self.profiler.count('frames_dropped')
+
+    def start_capture(self, directory=CAPTURE_DIR, **kwargs):
+        """
+        Starts recording every frame drawn into directory. kwargs are passed on to FrameCapture.
+        """
+        self.stop_capture()
+        self.capture = FrameCapture(self.window_size, directory, **kwargs)
+        return self.capture
+
+    def stop_capture(self):
+        """
+        Stops recording, waits for the recorded frames to be written and returns the capture stats,
+        or None if nothing was being recorded.
+        """
+        capture, self.capture = self.capture, None
+        return capture.close() if capture is not None else None
 
-    def handle_user_input(self, lock):
+    def wait_until_loaded(self, timeout=None):
         """
-        Continually grabs input from the user, and performs movement/rotation. Also handles input grabbing/release.
+        Blocks until every object has loaded. Returns False if the timeout ran out first.
+        Objects are added to the world by the next frame drawn.
+        """
+        return self.loader is None or self.loader.all_done.wait(timeout)
+
+    def publish_camera(self):
+        """
+        Makes the current camera position and orientation visible to the renderer.
+        Replacing the snapshot is a single assignment, so no lock is needed.
+        """
+        self.camera_state = self.camera.snapshot()
+
+    def handle_user_input(self):
+        """
+        Waits for input from the user, and performs movement/rotation. Also handles input grabbing/release.
+        Sleeps until an event arrives, only waking at input_rate while a movement key is held.
         """
         event_keys = (pygame.K_w, pygame.K_s, pygame.K_d, pygame.K_a)
         keys_pressed = [0, 0, 0, 0]  # The pressed status of the keys
         on_screen = True
         is_grabbed = True
-        pygame.mouse.set_pos(500, 500)  # Avoids vew jumping on focus gain
+        center = (self.window_size[0] // 2, self.window_size[1] // 2)
+        pygame.mouse.set_pos(center)  # Avoids vew jumping on focus gain
+        last_update = time.perf_counter()
+
+        while not self.stop_event.is_set():
+            try:  # Exception handling so that we can let go of inputs if need be
 
-        while True:
-            if self.running:
-                try:  # Exception handling so that we can let go of inputs if need be
+                # Sleep until the next event, or the next movement step while a key is held
+                timeout = int(1000 / self.input_rate) if any(keys_pressed) else IDLE_TIMEOUT
+                event = pygame.event.wait(timeout)
+                events = pygame.event.get()
+                if event.type != pygame.NOEVENT:
+                    events.insert(0, event)
 
-                    # Gets updated input from movement keys
-                    events = pygame.event.get()
-                    down_keys = [event.key for event in events if event.type == pygame.KEYDOWN]
-                    up_keys = [event.key for event in events if event.type == pygame.KEYUP]
-                    for idx in range(4):
-                        keys_pressed[idx] += int(event_keys[idx] in down_keys) - int(event_keys[idx] in up_keys)
+                # Gets updated input from movement keys
+                down_keys = [event.key for event in events if event.type == pygame.KEYDOWN]
+                up_keys = [event.key for event in events if event.type == pygame.KEYUP]
+                for idx in range(4):
+                    keys_pressed[idx] += int(event_keys[idx] in down_keys) - int(event_keys[idx] in up_keys)
 
+                # Movement is scaled by real elapsed time, so it doesn't depend on how often we wake up
+                now = time.perf_counter()
+                elapsed = min(now - last_update, 2 / self.input_rate)
+                last_update = now
+
+                if is_grabbed:
                     mouse_x, mouse_y = pygame.mouse.get_pos()
-                    mouse_d = [mouse_x-500, 500-mouse_y]
+                    mouse_d = [mouse_x - center[0], center[1] - mouse_y]
+                    if any(mouse_d) or any(keys_pressed):
+                        self.update_camera(keys_pressed, mouse_d, elapsed)
+                    if any(mouse_d):
+                        pygame.mouse.set_pos(center)  # Reset mouse position
+
+                # This block handles updating of window focus
+                try:
+                    focus_status = [event for event in events if event.type == pygame.ACTIVEEVENT][0]
+                    if focus_status.gain == 1:
+                        on_screen = True  # If focus on window is regained
+                    else:
+                        is_grabbed = False
+                        on_screen = False
+                except IndexError:
+                    pass
 
-                    if is_grabbed:
-                        self.update_camera(keys_pressed, mouse_d, lock)
+                # If the screen is grabbed, update vars/move the mouse
+                if on_screen and pygame.mouse.get_pressed()[0] and not is_grabbed:
+                    is_grabbed = True
+                    pygame.event.set_grab(True)
+                    pygame.mouse.set_visible(False)
+                    pygame.mouse.set_pos(center)  # Avoids vew jumping on focus gain
 
-                    # This block handles updating of window focus
-                    try:
-                        focus_status = [event for event in events if event.type == pygame.ACTIVEEVENT][0]
-                        if focus_status.gain == 1:
-                            on_screen = True  # If focus on window is regained
-                        else:
+                for event in events:
+                    if event.type == pygame.KEYDOWN:
+                        if event.key == pygame.K_q:  # If Q is pressed, let go of inputs
+                            pygame.event.set_grab(False)
                             is_grabbed = False
-                            on_screen = False
-                    except IndexError:
-                        pass
-
-                    # If the screen is grabbed, update vars/move the mouse
-                    if on_screen and pygame.mouse.get_pressed()[0] and not is_grabbed:
-                        is_grabbed = True
-                        pygame.event.set_grab(True)
-                        pygame.mouse.set_visible(False)
-                        pygame.mouse.set_pos(500, 500)  # Avoids vew jumping on focus gain
-
-                    for event in events:
-                        if event.type == pygame.KEYDOWN:
-                            if event.key == pygame.K_q:  # If Q is pressed, let go of inputs
-                                pygame.event.set_grab(False)
-                                is_grabbed = False
-                                pygame.mouse.set_visible(True)
-
-                        if event.type == pygame.QUIT:
-                            self.running = False
-                            print("Quitting...")
-                            break
-                except Exception as e:
-                    print(str(e))
-                    sys.exit()
-
-        # On quit, gracefully exit
-        pygame.quit()
-        sys.exit()
-
-    def update_camera(self, keys, mouse_d, lock):
-        """
-        Handles the moving of the camera based on the user input.
-        """
-        lock.acquire()  # Acquire lock to make sure multithreading things don't get messed up
-        self.camera.rotate(mouse_d[0], -mouse_d[1], 0, sensitivity=.001)
-        self.camera.move((keys[2]-keys[3], 0, keys[0]-keys[1]), speed=0.001)
-        lock.release()
-        pygame.mouse.set_pos(500, 500)  # Reset mouse position
+                            pygame.mouse.set_visible(True)
+                        if event.key == pygame.K_F2:  # Switch between wireframe and solid drawing
+                            self.renderer.mode = 'solid' if self.renderer.mode == 'wireframe' else 'wireframe'
+                            self.renderer.invalidate()
+                        if event.key == pygame.K_F3:  # Toggle the frame stats overlay
+                            self.renderer.show_stats = not self.renderer.show_stats
+                        if event.key == pygame.K_F4:  # Save the recent frame timings
+                            self.profiler.dump(TRACE_FILE)
+                            print("Wrote frame trace to {}".format(TRACE_FILE))
+                        if event.key == pygame.K_F6:  # Toggle adaptive resolution, going back to full resolution when off
+                            self.renderer.adaptive_resolution = not self.renderer.adaptive_resolution
+                            if not self.renderer.adaptive_resolution:
+                                self.renderer.scale = self.renderer.max_scale
+                        if event.key == pygame.K_F5:  # Start or stop recording frames
+                            if self.capture is None:
+                                self.start_capture()
+                                print("Recording frames to {}".format(CAPTURE_DIR))
+                            else:
+                                stats = self.stop_capture()
+                                print("Wrote {written} frames, dropped {dropped}".format(**stats))
+
+                    if event.type == pygame.MOUSEBUTTONDOWN and event.button == 3 and is_grabbed:
+                        hit = self.pick()
+                        print("Nothing under the crosshair" if hit is None else
+                              "Looking at {} {:.1f} units away".format(hit.object, hit.distance))
+
+                    if event.type == pygame.VIDEOEXPOSE:  # The window has to be drawn again in full
+                        self.renderer.invalidate()
+
+                    if event.type == pygame.QUIT:
+                        print("Quitting...")
+                        self.stop_event.set()
+                        break
+            except Exception as e:
+                print(str(e))
+                self.stop_event.set()
+
+    def update_camera(self, keys, mouse_d, elapsed):
+        """
+        Handles the moving of the camera based on the user input, then publishes the new camera state.
+        elapsed is the time in seconds the movement keys have been held for since the last update.
+        """
+        self.camera.rotate(mouse_d[0], -mouse_d[1], 0, sensitivity=MOUSE_SENSITIVITY)
+        if any(keys):
+            self.collision.update()
+            self.camera.move((keys[2]-keys[3], 0, keys[0]-keys[1]), speed=MOVE_SPEED*elapsed,
+                             blocked=lambda pos: self.collision.sphere_collides(pos, COLLISION_RADIUS))
+        self.publish_camera()
+
+    def pick(self):
+        """
+        Returns the RayHit of the object under the crosshair, or None if there is nothing there.
+        """
+        self.collision.update()
+        return self.collision.pick(self.camera)
 
 
 if __name__ == "__main__":
-    new_scene = Scene()
+    import sys
+    if len(sys.argv) > 1:  # A snapshot file to view instead of the random objects
+        snapshot_world = World(terrain=Terrain())
+        snapshot_world.load(sys.argv[1])
+        new_scene = Scene(world=snapshot_world)
+    else:
+        new_scene = Scene()
     new_scene.begin_scene()
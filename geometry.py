@@ -0,0 +1,96 @@
+"""
+Mesh helpers shared by the items and the renderer. Everything in here works on whole
+NumPy arrays at once, so it is only ever run when a model is loaded.
+"""
+import numpy as np
+
+
+def edge_keys(tri_indices):
+    """
+    Returns the sorted unique edges of a (T, 3) array of triangle indices, each packed into one int64
+    as smaller index << 32 | larger index, and the number of edges before removing duplicates.
+    Packed edges sort in the same order as (smaller, larger) rows, but much faster.
+    """
+    tri_indices = np.asarray(tri_indices).astype(np.int64)
+    # Each triangle contributes the edges (0, 1), (1, 2) and (2, 0)
+    starts = tri_indices.ravel()
+    ends = np.roll(tri_indices, -1, axis=1).ravel()
+    keys = (np.minimum(starts, ends) << 32) | np.maximum(starts, ends)  # An edge and its reverse become the same key
+
+    # Triangles that collapsed to a line or point after welding give edges from a vertex to itself
+    keys = keys[starts != ends]
+    return unique_keys(keys), len(keys)
+
+
+def unique_keys(keys):
+    """
+    Returns the sorted unique values of a 1D integer array, sorting it in place.
+    Sorting and dropping repeats is much faster than np.unique on big arrays.
+    """
+    keys.sort()
+    unique = np.ones(len(keys), dtype=bool)
+    unique[1:] = keys[1:] != keys[:-1]
+    return keys[unique]
+
+
+def unpack_edges(keys, dtype=np.int64):
+    """
+    Turns packed edge keys back into an (E, 2) array of vertex indices.
+    Each column is written straight into the output, without full-size int64 temporaries.
+    """
+    edges = np.empty((len(keys), 2), dtype=dtype)
+    np.right_shift(keys, 32, out=edges[:, 0], casting='unsafe')
+    np.bitwise_and(keys, 0xffffffff, out=edges[:, 1], casting='unsafe')
+    return edges
+
+
+def cluster_vertices(vertices, edges, cell_size):
+    """
+    Simplifies a mesh by vertex clustering: every vertex in the same cell of a grid with the
+    given cell_size is merged into one at their average position.
+    Returns the new (V, 3) vertices and (E, 2) unique edges between them. Edges that collapse
+    into a single cell are dropped.
+    """
+    vertices = np.asarray(vertices)
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell_size).astype(np.int64)
+    # Each cell packed into one int64, in the same order as sorting the (x, y, z) rows
+    sizes = cells.max(axis=0) + 1 if len(cells) else np.ones(3, dtype=np.int64)
+    keys = (cells[:, 0] * sizes[1] + cells[:, 1]) * sizes[2] + cells[:, 2]
+    del cells  # On a big mesh every temporary is large, so each is dropped as soon as it is used
+
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    cluster = np.empty(len(keys), dtype=np.int32)
+    cluster[order] = np.cumsum(first) - 1
+    del keys, order, first
+    counts = np.bincount(cluster)
+
+    new_vertices = np.stack([np.bincount(cluster, weights=vertices[:, axis], minlength=len(counts))
+                             for axis in range(3)], axis=1) / counts[:, np.newaxis]
+
+    # The edges between clusters, packed into keys in place
+    starts, ends = cluster[edges[:, 0]], cluster[edges[:, 1]]
+    keys = np.minimum(starts, ends, dtype=np.int64)
+    np.maximum(starts, ends, out=ends)
+    del starts
+    keep = keys != ends
+    keys <<= 32
+    keys |= ends
+    del ends
+    new_edges = unpack_edges(unique_keys(keys[keep]), np.asarray(edges).dtype)
+    return new_vertices.astype(vertices.dtype), new_edges
+
+
+def rotation_matrices(orientations):
+    """
+    Returns the (N, 3, 3) rotation matrices for an (N, 3) array of x, y and z rotations in degrees,
+    each the same as the top left of Item.get_rotation_matrix.
+    """
+    theta = np.radians(np.asarray(orientations, dtype=float))
+    cx, cy, cz = np.cos(theta).T
+    sx, sy, sz = np.sin(theta).T
+    return np.stack([np.stack([cy*cz, -cy*sz, sy], axis=-1),
+                     np.stack([cx*sy+sx*sy*cz, cx*cz-sx*sy*sz, -sx*cy], axis=-1),
+                     np.stack([sx*sz-cx*sy*cz, sx*cz + cx*sy*sz, cx*cy], axis=-1)], axis=1)
@@ -0,0 +1,81 @@
+"""
+Startup time benchmark. Imports each entry point in a fresh interpreter under python -X importtime
+and reports the total import cost, the wall time of the whole process and the slowest modules as JSON.
+
+    python3 importbench.py --repeat 5 --output imports.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# Modules that are started on their own, and the light modules short-lived workers import
+ENTRY_POINTS = ['controller', 'benchmark', 'meshcache', 'renderer', 'transforms']
+
+
+def parse_importtime(output):
+    """
+    Parses the stderr of python -X importtime into a list of (module, self_us, cumulative_us) tuples.
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        modules.append((module.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def time_import(module, cwd=None):
+    """
+    Imports module in a fresh interpreter. Returns the wall time in milliseconds and the parsed import times.
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=cwd, capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError("Importing {} failed:\n{}".format(module, result.stderr))
+    return wall_ms, parse_importtime(result.stderr)
+
+
+def run_importbench(modules=ENTRY_POINTS, repeat=3, top=10):
+    """
+    Times importing each module repeat times and returns a dict of results per module, using the
+    fastest run of each (the others mostly measure a cold disk cache).
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in modules:
+        runs = [time_import(module, cwd) for run in range(repeat)]
+        wall_ms, imports = min(runs, key=lambda run: sum(self_us for name, self_us, cumulative in run[1]))
+        slowest = sorted(imports, key=lambda entry: entry[1], reverse=True)[:top]
+        names = set(name for name, self_us, cumulative in imports)
+        results[module] = {'import_ms': sum(self_us for name, self_us, cumulative in imports) / 1000,
+                           'process_ms': wall_ms,
+                           'modules': len(imports),
+                           'loads': {dep: dep in names for dep in ('numpy', 'pygame', 'stl')},
+                           'slowest_ms': {name: self_us / 1000 for name, self_us, cumulative in slowest}}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time importing each entry point with python -X importtime.')
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS, help='modules to import (default: the entry points)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per module, keeping the fastest')
+    parser.add_argument('--top', type=int, default=10, help='how many of the slowest modules to list')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    results = run_importbench(args.modules, args.repeat, args.top)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Instanced storage for large numbers of objects sharing a model. Instead of an Item per object,
+each holding its own transformed copy of the mesh, an InstanceBatch keeps the one shared mesh and
+contiguous arrays of every instance's position, orientation, scale and color. The renderer culls,
+picks levels of detail for and projects whole batches at once, straight from those arrays.
+"""
+import numpy as np
+from assets import registry
+from geometry import rotation_matrices
+
+
+class InstanceBatch:
+    """
+    Every instance of one model in the world.
+
+    positions:      (N, 3) world coordinates
+    orientations:   (N, 3) rotations about the x, y and z axes in degrees, as for an Item
+    scales:         (N,) uniform scale factors
+    colors:         (N, 3) uint8 RGB colors
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.mesh = registry.get(file_name)
+        self.positions = np.empty((0, 3))
+        self.orientations = np.empty((0, 3))
+        self.scales = np.empty(0)
+        self.colors = np.empty((0, 3), dtype=np.uint8)
+        self.lod_levels = np.empty(0, dtype=np.int8)  # The level of detail each instance was last drawn at
+        self.version = 0  # Bumped every time instances are added or changed
+
+        # Bounds of the untransformed mesh, which every instance's bounds are derived from
+        vertices = np.asarray(self.mesh.vertices, dtype=float)
+        if len(vertices):
+            self.local_center = (vertices.min(axis=0) + vertices.max(axis=0)) / 2
+            self.local_extent = (vertices.max(axis=0) - vertices.min(axis=0)) / 2
+            self.local_radius = float(np.sqrt(np.max(np.sum((vertices - self.local_center)**2, axis=1))))
+        else:
+            self.local_center, self.local_extent, self.local_radius = np.zeros(3), np.zeros(3), 0.0
+        self.bounds = None  # (centers, radii, aabbs) of every instance, recomputed after a change
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, positions, orientations=(0, 0, 0), scales=1, colors=(255, 0, 0)):
+        """
+        Appends instances. positions is an (N, 3) array, and the other arguments are arrays with
+        one row per instance or single values shared by all of them.
+        Returns the indices of the new instances.
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        count = len(positions)
+        start = len(self)
+        self.positions = np.concatenate((self.positions, positions))
+        self.orientations = np.concatenate((self.orientations, np.broadcast_to(np.asarray(orientations, dtype=float), (count, 3))))
+        self.scales = np.concatenate((self.scales, np.broadcast_to(np.asarray(scales, dtype=float), (count,))))
+        self.colors = np.concatenate((self.colors, np.broadcast_to(np.asarray(colors, dtype=np.uint8), (count, 3))))
+        self.lod_levels = np.concatenate((self.lod_levels, np.zeros(count, dtype=np.int8)))
+        self.changed()
+        return np.arange(start, start + count)
+
+    def remove(self, indices):
+        """
+        Removes the instances at indices. Later instances move down to fill the gaps.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        keep[indices] = False
+        self.positions = self.positions[keep]
+        self.orientations = self.orientations[keep]
+        self.scales = self.scales[keep]
+        self.colors = self.colors[keep]
+        self.lod_levels = self.lod_levels[keep]
+        self.changed()
+
+    def set_transforms(self, indices=slice(None), positions=None, orientations=None, scales=None, colors=None):
+        """
+        Moves, rotates, scales and/or recolors the instances at indices (by default all of them) in one array assignment.
+        Arguments left as None keep their current values.
+        """
+        if positions is not None:
+            self.positions[indices] = positions
+        if orientations is not None:
+            self.orientations[indices] = orientations
+        if scales is not None:
+            self.scales[indices] = scales
+        if colors is not None:
+            self.colors[indices] = colors
+        self.changed()
+
+    def changed(self):
+        """
+        Marks the instance arrays as modified. Call after writing to them directly.
+        """
+        self.bounds = None
+        self.version += 1
+
+    def transform_matrices(self, indices=slice(None)):
+        """
+        Returns the (N, 4, 4) matrices that scale, rotate and translate each instance, as Item.get_transform_matrix does.
+        """
+        rotations = rotation_matrices(self.orientations[indices])
+        matrices = np.zeros((len(rotations), 4, 4))
+        matrices[:, :3, :3] = rotations * self.scales[indices][:, np.newaxis, np.newaxis]
+        matrices[:, :3, 3] = self.positions[indices]
+        matrices[:, 3, 3] = 1
+        return matrices
+
+    def get_bounds(self):
+        """
+        Returns the world space bounding sphere centers (N, 3), radii (N,) and boxes (N, 2, 3) of
+        every instance, laid out like the bounds of an Item. They are derived from the bounds of
+        the untransformed mesh, without transforming any vertices.
+        """
+        if self.bounds is None:
+            linear = rotation_matrices(self.orientations) * self.scales[:, np.newaxis, np.newaxis]
+            centers = np.einsum('nij,j->ni', linear, self.local_center) + self.positions
+            # Half the size of the box around the rotated box along each axis
+            extents = np.einsum('nij,j->ni', np.abs(linear), self.local_extent)
+            radii = self.local_radius * np.abs(self.scales)
+            self.bounds = (centers, radii, np.stack((centers - extents, centers + extents), axis=1))
+        return self.bounds
+
+    def lod_error(self, levels, indices=slice(None)):
+        """
+        Returns how far, in world units, each instance's vertices can be from the full mesh at the given levels.
+        """
+        errors = np.array([error for vertices, edges, error in self.mesh.lods])
+        return errors[levels] * self.scales[indices]
+
+    def world_vertices(self, index, level=0):
+        """
+        Returns the world space vertices of one instance at a level of detail, for code that needs them explicitly.
+        """
+        vertices = np.asarray(self.mesh.lods[level][0], dtype=float)
+        matrix = self.transform_matrices([index])[0]
+        return vertices.dot(matrix[:3, :3].T) + matrix[:3, 3]
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the per-instance arrays. The mesh is shared through the registry.
+        """
+        return sum(arr.nbytes for arr in (self.positions, self.orientations, self.scales, self.colors, self.lod_levels))
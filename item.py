@@ -1,6 +1,6 @@
 import numpy as np
-from math import sin, cos, pi
-from stl import mesh
+import transforms
+from assets import registry
 
 
 class Item():
@@ -9,83 +9,149 @@ class Item():
         """
         Initializes a new item with the coordinates, orientation, scale, and color specified
         """
-        # Imports an STL file and extracts the points from it
-        self.vecs = self.model_to_points(file_name)
+        # Gets the base geometry of the STL file, shared with every other item using the same file
+        self.file_name = file_name
+        self.mesh = self.model_to_points(file_name)
+        self.vertices = self.mesh.vertices
+        self.edges = self.mesh.edges
 
-        # Get the rotation matrix using the rotations about the x, y, and z axes
-        self.world_points = self.get_transformed_points(self.vecs, world_coords, orientation, scale)
-        self.lines = self.get_object_lines()  # Convert triangles to lines
         self.color = color  # Set the color of the object
         self.location = world_coords  # The canonical location of the object
+        self.orientation = orientation
+        self.scale = scale
+
+        # Get the rotation matrix using the rotations about the x, y, and z axes
+        self.world_vertices = self.get_transformed_points(self.vertices, world_coords, orientation, scale)
+        self.update_bounds()
+        self.world_normals = None  # Transformed facet normals, computed when first needed
+
+        self.version = 0  # Bumped every time the item is transformed
+        self.lod_level = 0  # The level of detail the renderer last drew the item at
+        self.lod_vertices = {0: self.world_vertices}  # Transformed vertices of each level, filled in when first drawn
 
     def __str__(self):
         return "Position in world: ({}, {}, {})".format(self.location[0], self.location[1], self.location[2])
 
+    @property
+    def lines(self):
+        """
+        The edges of the object as an (E, 2, 3) array of world coordinate endpoints.
+        """
+        return self.get_object_lines()
+
     def get_object_lines(self):
         """
-        Collapses the triangles of the imported STL into a list of lines.
+        Returns the edges of the object as an (E, 2, 3) array of world coordinate endpoints.
         """
-        all_lines = []
-        for tri in self.world_points:
-            for idx, vert in enumerate(tri):
-                line = [vert]
-                line.append(tri[(idx+1) % 3])
-                all_lines.append(line)
+        return self.world_vertices[self.edges]
 
-        seen = set()
-        uniq = []
-        for x in all_lines:
-            if str(x[::-1]) not in seen:
-                # print(x)
-                uniq.append(x)
-            seen.add(str(x))
+    def set_transform(self, world_coords=None, orientation=None, scale=None):
+        """
+        Moves, rotates and/or scales the item in place, re-transforming the shared base geometry.
+        Arguments left as None keep their current value.
+        """
+        if world_coords is not None:
+            self.location = world_coords
+        if orientation is not None:
+            self.orientation = orientation
+        if scale is not None:
+            self.scale = scale
+        self.world_vertices = self.get_transformed_points(self.vertices, self.location, self.orientation, self.scale)
+        self.update_bounds()
+        self.world_normals = None
+        self.lod_vertices = {0: self.world_vertices}
+        self.version += 1
 
-        return uniq
+    def get_world_normals(self):
+        """
+        Returns the (T, 3) unit facet normals of the object in world coordinates, from the normals stored in the STL file.
+        """
+        if self.world_normals is None:
+            linear = self.get_transform_matrix(self.location, self.orientation, self.scale)[:3, :3]
+            # Normals transform by the inverse transpose, which keeps them perpendicular to the faces
+            normals = np.asarray(self.mesh.normals, dtype=float).dot(np.linalg.inv(linear))
+            length = np.linalg.norm(normals, axis=1, keepdims=True)
+            self.world_normals = normals / np.where(length > 0, length, 1)
+        return self.world_normals
+
+    @property
+    def lod_levels(self):
+        """
+        The number of levels of detail the item can be drawn at.
+        """
+        return len(self.mesh.lods)
+
+    def get_lod(self, level):
+        """
+        Returns the world space vertices and the edges of a level of detail of the item.
+        """
+        if level not in self.lod_vertices:
+            self.lod_vertices[level] = self.get_transformed_points(self.mesh.lods[level][0], self.location,
+                                                                   self.orientation, self.scale)
+        return self.lod_vertices[level], self.mesh.lods[level][1]
+
+    def lod_error(self, level):
+        """
+        Returns how far, in world units, the vertices of a level of detail can be from the full mesh.
+        """
+        return self.mesh.lods[level][2] * self.scale
+
+    def update_bounds(self):
+        """
+        Recomputes the world space bounding volumes of the item from its transformed vertices.
+        aabb is a (2, 3) array of the min and max corners, and the bounding sphere is centered on
+        the middle of the aabb.
+        """
+        if len(self.world_vertices) == 0:
+            self.aabb = np.zeros((2, 3))
+            self.bounding_center = np.zeros(3)
+            self.bounding_radius = 0.0
+            return
+        self.aabb = np.array([self.world_vertices.min(axis=0), self.world_vertices.max(axis=0)])
+        self.bounding_center = self.aabb.mean(axis=0)
+        self.bounding_radius = np.sqrt(np.max(np.sum((self.world_vertices - self.bounding_center)**2, axis=1)))
 
     def model_to_points(self, file_name):
         """
-        Returns a list of triangles, each of which is composed of 3D points, based on a file_name
+        Returns the shared MeshData (triangles, welded vertices and edges) for a file_name
         """
-        obj_mesh = mesh.Mesh.from_file(file_name)
-        return obj_mesh.vectors
+        return registry.get(file_name)
 
     def get_transformed_points(self, points, coords, orientation, scale):
         """
-        Returns the points of the object as translated by coords and rotated by orientation
+        Returns the points of the object as translated by coords and rotated by orientation.
+        points can be any array of shape (..., 3), e.g. (V, 3) vertices or (T, 3, 3) triangles,
+        and the result is a contiguous array of the same shape
+        """
+        transform = self.get_transform_matrix(coords, orientation, scale)
+        points = np.asarray(points, dtype=float)
+
+        # Homogeneous (N, 4) points times the transposed matrix, all in one multiply
+        homogeneous = np.empty((points.size // 3, 4))
+        homogeneous[:, :3] = points.reshape(-1, 3)
+        homogeneous[:, 3] = 1
+        return np.ascontiguousarray(homogeneous.dot(transform.T)[:, :3]).reshape(points.shape)
+
+    def get_transform_matrix(self, coords, orientation, scale):
+        """
+        Returns the 4x4 matrix that scales, then rotates, then translates the object.
         """
-        # Combines the translation and rotation matrices
-        transform = self.get_translation_matrix(coords).dot(self.get_rotation_matrix(orientation).dot(self.get_scale_matrix(scale)))
-        new_points = np.zeros(points.shape)  # The matrix of transformed points
-        new_points = [np.array([transform.dot(np.append(point, [1])) for point in triangle]) for triangle in points]
-        return new_points
+        return transforms.transform_matrix(coords, orientation, scale)
 
     def get_scale_matrix(self, scale):
         """
         Returns a scaling matrix for the points of the object.
         """
-        ident = np.identity(4)
-        for x in range(3):
-            ident[x, x] = scale
-        return ident
+        return transforms.scale_matrix(scale)
 
     def get_translation_matrix(self, world_coords):
         """
         Returns a 4x4 translation matrix to transform the points.
         """
-        transform = np.identity(4)  # Generate the identity matrix
-        coords = np.array(world_coords)
-        transform[0:3, 3] = coords  # Fill the values of the transformation matrix
-        return transform
+        return transforms.translation_matrix(world_coords)
 
     def get_rotation_matrix(self, orient):
         """
         Returns a rotation matrix for a given theta about the x, y, and z axes
         """
-        x, y, z = orient
-        cosd = lambda theta: cos(theta*(pi/180))  # Lambdas will make this easier
-        sind = lambda theta: sin(theta*(pi/180))
-        # Returns the rotation matrix
-        return np.array([[cosd(y)*cosd(z), -cosd(y)*sind(z), sind(y), 0],
-                        [cosd(x)*sind(y)+sind(x)*sind(y)*cosd(z), cosd(x)*cosd(z)-sind(x)*sind(y)*sind(z), -sind(x)*cosd(y), 0],
-                        [sind(x)*sind(z)-cosd(x)*sind(y)*cosd(z), sind(x)*cosd(z) + cosd(x)*sind(y)*sind(z), cosd(x)*cosd(y), 0],
-                        [0, 0, 0, 1]])
+        return transforms.rotation_matrix(orient)
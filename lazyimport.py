@@ -0,0 +1,36 @@
+"""
+Deferred imports for heavy optional dependencies. lazy_import returns a module object straight
+away, but only executes the module the first time one of its attributes is used, so code that
+never touches it (like a headless worker that only needs the matrix math) never pays for it.
+"""
+import sys
+import importlib.util
+
+
+class MissingModule:
+    """
+    Stands in for a module that isn't installed, raising ImportError as soon as it is used.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        raise ImportError("No module named '{}', which is needed to use {}.{}".format(self.name, self.name, attr))
+
+
+def lazy_import(name):
+    """
+    Returns the module name, loading it when first used. Already imported modules are returned as they are.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return MissingModule(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
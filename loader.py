@@ -0,0 +1,130 @@
+"""
+Background loading of the objects in a world. Items are built (their STL parsed through the mesh
+registry and transformed) on a pool of worker threads, so the window and render loop can start
+straight away. Finished items wait in a queue until the render thread moves them into the World
+with collect, so the world's item list is only ever changed by the thread drawing it.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from item import Item
+
+
+class AssetLoader:
+    """
+    Builds Items on worker threads and hands them over to a World.
+    Different models load in parallel; items of a model that is already loading wait for it
+    in the registry rather than parsing it again.
+    """
+
+    def __init__(self, world, workers=4):
+        self.world = world
+        self.executor = ThreadPoolExecutor(workers)
+        self.finished = queue.Queue()  # Items built by the workers, waiting to be added to the world
+        self.lock = threading.Lock()  # Guards the counters below
+        self.submitted = 0
+        self.loaded = 0
+        self.failed = 0
+        self.all_done = threading.Event()  # Set whenever nothing is left to load
+        self.all_done.set()
+
+    def load_item(self, file_name, world_coords, orientation, scale, color=(255, 0, 0)):
+        """
+        Starts building an Item in the background. It appears in the world at the first collect after it's done.
+        """
+        with self.lock:
+            self.submitted += 1
+            self.all_done.clear()
+        self.executor.submit(self.build_item, file_name, world_coords, orientation, scale, color)
+
+    def load_specs(self, specs):
+        """
+        Starts loading a list of (file_name, world_coords, orientation, scale, color) tuples, as
+        returned by World.random_scene_specs. The first item of each model is queued before the
+        rest, so that all the models start parsing at once.
+        """
+        specs = list(specs)
+        first = {}
+        for idx, spec in enumerate(specs):
+            first.setdefault(spec[0], idx)
+        first = set(first.values())
+        order = sorted(range(len(specs)), key=lambda idx: idx not in first)
+        for idx in order:
+            self.load_item(*specs[idx])
+
+    def build_item(self, file_name, world_coords, orientation, scale, color):
+        """
+        Runs on a worker thread: builds the item and queues it for the world.
+        """
+        try:
+            self.finished.put(Item(file_name, world_coords, orientation, scale, color=color))
+            succeeded = True
+        except Exception as e:
+            print("Couldn't load {}: {}".format(file_name, e))
+            succeeded = False
+        with self.lock:
+            if succeeded:
+                self.loaded += 1
+            else:
+                self.failed += 1
+            if self.loaded + self.failed == self.submitted:
+                self.all_done.set()
+
+    def collect(self, max_items=None):
+        """
+        Moves finished items into the world, at most max_items of them. Call from the thread that draws the world.
+        Returns the number of items added.
+        """
+        added = 0
+        while max_items is None or added < max_items:
+            try:
+                item = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            self.world.add_item(item)
+            added += 1
+        return added
+
+    @property
+    def progress(self):
+        """
+        The fraction of submitted items that have finished loading (or failed to), 1.0 when there is nothing to do.
+        """
+        with self.lock:
+            return (self.loaded + self.failed) / self.submitted if self.submitted else 1.0
+
+    @property
+    def pending(self):
+        """
+        The number of items still being built or waiting to be collected.
+        """
+        with self.lock:
+            return self.submitted - self.failed - self.loaded + self.finished.qsize()
+
+    def status(self):
+        """
+        Returns a short description of the loading progress, or None once everything is in the world.
+        """
+        with self.lock:
+            done, total = self.loaded + self.failed, self.submitted
+        if done == total and self.finished.empty():
+            return None
+        return "Loading {}/{}".format(done, total)
+
+    def wait(self, timeout=None):
+        """
+        Blocks until everything submitted has finished loading, then collects it into the world.
+        Only collect from the thread that draws the world; with a render thread running, let it
+        collect instead and just wait on all_done.
+        Returns False if the timeout ran out first.
+        """
+        if not self.all_done.wait(timeout):
+            return False
+        self.collect()
+        return True
+
+    def close(self):
+        """
+        Stops the workers, abandoning items that haven't started loading.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
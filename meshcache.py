@@ -0,0 +1,200 @@
+"""
+Compact binary cache of preprocessed STL geometry, written next to the source file.
+
+A cache file is a fixed-size header followed by the geometry arrays, each starting on a
+16 byte boundary so they can be memory-mapped straight into NumPy without any parsing:
+
+    header          HEADER_DTYPE
+    vertices        float32 (V, 3)  welded unique vertices
+    tri_indices     int32   (T, 3)  triangle corners as indices into vertices
+    edges           int32   (E, 2)  unique undirected edges as indices into vertices
+    normals         float32 (T, 3)  facet normals
+    lods            LOD_DTYPE (L,)  size and error of each simplified level of detail
+    then for each of those levels:
+        vertices    float32 (V, 3)  clustered vertices
+        edges       int32   (E, 2)  edges between them
+
+The header records the size and modification time of the source STL and the settings its levels
+of detail were built with, so a cache is ignored as soon as its source or those settings change.
+
+Run as a script to pre-bake every STL file in a directory:
+    python3 meshcache.py models/ [--force]
+"""
+import os
+import sys
+import argparse
+import numpy as np
+
+MAGIC = b'IPMCACHE'
+VERSION = 3
+SUFFIX = '.mcache'
+ALIGN = 16
+
+HEADER_DTYPE = np.dtype([('magic', 'S8'),
+                         ('version', '<u4'),
+                         ('duplicate_edges', '<u4'),
+                         ('source_size', '<u8'),
+                         ('source_mtime_ns', '<i8'),
+                         ('n_vertices', '<u4'),
+                         ('n_triangles', '<u4'),
+                         ('n_edges', '<u4'),
+                         ('n_lods', '<u4'),
+                         ('bounds', '<f4', (2, 3)),
+                         ('lod_error', '<f8'),
+                         ('lod_levels', '<u4')])
+
+# One simplified level of detail, as built by MeshData.build_lods
+LOD_DTYPE = np.dtype([('n_vertices', '<u4'),
+                      ('n_edges', '<u4'),
+                      ('error', '<f8')])
+
+# Name, dtype and row width of each array, in file order
+SECTIONS = (('vertices', '<f4', 3, 'n_vertices'),
+            ('tri_indices', '<i4', 3, 'n_triangles'),
+            ('edges', '<i4', 2, 'n_edges'),
+            ('normals', '<f4', 3, 'n_triangles'))
+
+
+def cache_path(file_name):
+    """
+    Returns the path of the cache file for an STL file.
+    """
+    return file_name + SUFFIX
+
+
+def section_offsets(header, lod_table=()):
+    """
+    Returns a list of (name, dtype, shape, offset) for every array described by a header, up to
+    and including the 'lods' table. The arrays of the levels it describes follow if lod_table is given.
+    """
+    sections = [(name, dtype, (int(header[count_field]), width)) for name, dtype, width, count_field in SECTIONS]
+    sections.append(('lods', LOD_DTYPE, (int(header['n_lods']),)))
+    for level, lod in enumerate(lod_table):
+        sections.append(('lod{}_vertices'.format(level), '<f4', (int(lod['n_vertices']), 3)))
+        sections.append(('lod{}_edges'.format(level), '<i4', (int(lod['n_edges']), 2)))
+
+    offsets = []
+    offset = HEADER_DTYPE.itemsize
+    for name, dtype, shape in sections:
+        offset = -(-offset // ALIGN) * ALIGN
+        offsets.append((name, np.dtype(dtype), shape, offset))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return offsets
+
+
+def read_cache(file_name, lod_error, lod_levels):
+    """
+    Memory-maps the cache of an STL file. Returns a dict of arrays (plus 'duplicate_edges', 'bounds'
+    and 'lods', a list of (vertices, edges, error) levels), or None if there is no cache or it is out of date.
+    A cache whose levels of detail were built with another lod_error or lod_levels is out of date.
+    """
+    path = cache_path(file_name)
+    try:
+        source = os.stat(file_name)
+        header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+    except (OSError, ValueError):
+        return None
+
+    if (len(header) != 1 or header['magic'][0] != MAGIC or header['version'][0] != VERSION or
+            header['source_size'][0] != source.st_size or header['source_mtime_ns'][0] != source.st_mtime_ns or
+            header['lod_error'][0] != lod_error or header['lod_levels'][0] != lod_levels):
+        return None
+    header = header[0]
+
+    name, dtype, shape, offset = section_offsets(header)[-1]
+    lod_table = np.fromfile(path, dtype=LOD_DTYPE, count=shape[0], offset=offset)
+    if len(lod_table) != shape[0]:
+        return None
+
+    arrays = {'duplicate_edges': int(header['duplicate_edges']), 'bounds': np.array(header['bounds'])}
+    for name, dtype, shape, offset in section_offsets(header, lod_table):
+        if shape[0] == 0:  # np.memmap refuses empty maps
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+    arrays['lods'] = [(arrays.pop('lod{}_vertices'.format(level)), arrays.pop('lod{}_edges'.format(level)), float(lod['error']))
+                      for level, lod in enumerate(lod_table)]
+    return arrays
+
+
+def write_cache(file_name, vertices, tri_indices, edges, normals, duplicate_edges, lod_error, lod_levels, lods=()):
+    """
+    Writes the cache of an STL file, with its simplified levels of detail as (vertices, edges, error), built
+    with the given lod_error and lod_levels. The file is written under a temporary name and moved into
+    place, so readers never see a partial cache. Returns the path written, or None if the
+    directory is not writable.
+    """
+    source = os.stat(file_name)
+    lod_table = np.array([(len(lod_vertices), len(lod_edges), error) for lod_vertices, lod_edges, error in lods],
+                         dtype=LOD_DTYPE)
+    arrays = {'vertices': vertices, 'tri_indices': tri_indices, 'edges': edges, 'normals': normals, 'lods': lod_table}
+    for level, (lod_vertices, lod_edges, error) in enumerate(lods):
+        arrays['lod{}_vertices'.format(level)] = lod_vertices
+        arrays['lod{}_edges'.format(level)] = lod_edges
+
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['duplicate_edges'] = duplicate_edges
+    header['source_size'] = source.st_size
+    header['source_mtime_ns'] = source.st_mtime_ns
+    header['n_vertices'] = len(vertices)
+    header['n_triangles'] = len(tri_indices)
+    header['n_edges'] = len(edges)
+    header['n_lods'] = len(lod_table)
+    header['lod_error'] = lod_error
+    header['lod_levels'] = lod_levels
+    if len(vertices) > 0:
+        header['bounds'] = (np.min(vertices, axis=0), np.max(vertices, axis=0))
+
+    path = cache_path(file_name)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(header.tobytes())
+            for name, dtype, shape, offset in section_offsets(header[0], lod_table):
+                f.write(b'\x00' * (offset - f.tell()))
+                f.write(np.ascontiguousarray(arrays[name], dtype=dtype).reshape(shape).tobytes())
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    return path
+
+
+def bake_directory(directory, force=False):
+    """
+    Writes an up to date cache for every STL file under directory. Returns the list of caches written.
+    """
+    from assets import MeshData, LOD_ERROR, LOD_LEVELS  # Only needed for baking
+
+    written = []
+    for root, dirs, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.lower().endswith('.stl'):
+                continue
+            file_name = os.path.join(root, name)
+            if not force and read_cache(file_name, LOD_ERROR, LOD_LEVELS) is not None:
+                continue
+            mesh_data = MeshData.from_stl(file_name)
+            path = write_cache(file_name, mesh_data.vertices, mesh_data.tri_indices, mesh_data.edges,
+                               mesh_data.normals, mesh_data.duplicate_edges, LOD_ERROR, LOD_LEVELS, mesh_data.lods[1:])
+            if path is not None:
+                written.append(path)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-bake binary mesh caches for every STL file in a directory.')
+    parser.add_argument('directories', nargs='+', help='directories to search for STL files')
+    parser.add_argument('--force', action='store_true', help='rewrite caches that are already up to date')
+    args = parser.parse_args(argv)
+
+    for directory in args.directories:
+        for path in bake_directory(directory, force=args.force):
+            print('Wrote {}'.format(path))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
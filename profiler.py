@@ -0,0 +1,179 @@
+"""
+Low overhead per-stage frame timing. The renderer and controller wrap each stage of a frame in
+profiler.stage(name), and the profiler keeps a rolling window of the last frames' timings and
+counters, which can be drawn as an overlay or dumped to a JSON/CSV trace.
+"""
+import csv
+import json
+import threading
+import time
+from collections import deque
+
+
+class Stage:
+    """
+    Times one stage of a frame, adding the elapsed time to the profiler's current frame.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = (time.perf_counter_ns() - self.start) / 1e6
+        stages = self.profiler.stages
+        stages[self.name] = stages.get(self.name, 0) + elapsed
+
+
+class NullStage:
+    """
+    Stands in for Stage when profiling is switched off, doing nothing at all.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class FrameProfiler:
+    """
+    Collects per-stage timings (in milliseconds) and counters for each frame, keeping the last window frames.
+    """
+
+    def __init__(self, enabled=True, window=120):
+        self.enabled = enabled
+        self.frames = deque(maxlen=window)  # Dicts of finished frames, oldest first
+        self.frames_lock = threading.Lock()  # Held while a frame is added or the window copied
+        self.frame_count = 0
+        self.stages = {}  # Stage timings of the frame in progress
+        self.counts = {}  # Counters of the frame in progress
+        self.frame_start = None
+        self.font = None  # Loaded the first time the overlay is drawn
+
+    def stage(self, name):
+        """
+        Returns a context manager that times the code inside it as the named stage.
+        """
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def count(self, name, amount=1):
+        """
+        Adds amount to a counter of the frame in progress.
+        """
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def begin_frame(self):
+        """
+        Starts timing a new frame.
+        """
+        self.stages = {}
+        self.counts = {}
+        self.frame_start = time.perf_counter_ns() if self.enabled else None
+
+    def end_frame(self):
+        """
+        Finishes the frame in progress and adds it to the rolling window.
+        """
+        if not self.enabled or self.frame_start is None:
+            return
+        frame = {'frame': self.frame_count,
+                 'total': (time.perf_counter_ns() - self.frame_start) / 1e6,
+                 'stages': self.stages,
+                 'counts': self.counts}
+        with self.frames_lock:
+            self.frames.append(frame)
+        self.frame_count += 1
+        self.frame_start = None
+
+    def window_frames(self):
+        """
+        Returns a copy of the frames in the rolling window, safe to read while the render thread adds more.
+        """
+        with self.frames_lock:
+            return list(self.frames)
+
+    def summary(self, frames=None):
+        """
+        Returns the mean and max of every stage timing and counter over the rolling window (or the given
+        list of frames), as {'total': {'mean': ..., 'max': ...}, 'stages': {name: {...}}, 'counts': {name: {...}}}.
+        """
+        def stats(values):
+            return {'mean': sum(values) / len(frames), 'max': max(values)}
+
+        if frames is None:
+            frames = self.window_frames()
+        if not frames:
+            return {'total': {'mean': 0, 'max': 0}, 'stages': {}, 'counts': {}}
+        summary = {'total': stats([frame['total'] for frame in frames]), 'stages': {}, 'counts': {}}
+        for key in ('stages', 'counts'):
+            names = []
+            for frame in frames:
+                names.extend(name for name in frame[key] if name not in names)
+            summary[key] = {name: stats([frame[key].get(name, 0) for frame in frames]) for name in names}
+        return summary
+
+    def dump_json(self, file_name):
+        """
+        Writes every frame in the window to a JSON trace file.
+        """
+        frames = self.window_frames()
+        with open(file_name, 'w') as f:
+            json.dump({'frames': frames, 'summary': self.summary(frames)}, f, indent=2)
+
+    def dump_csv(self, file_name):
+        """
+        Writes every frame in the window to a CSV trace file, one row per frame and one column per stage or counter.
+        """
+        frames = self.window_frames()
+        stage_names, count_names = [], []
+        for frame in frames:
+            stage_names.extend(name for name in frame['stages'] if name not in stage_names)
+            count_names.extend(name for name in frame['counts'] if name not in count_names)
+
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame', 'total_ms'] + [name + '_ms' for name in stage_names] + count_names)
+            for frame in frames:
+                writer.writerow([frame['frame'], frame['total']] +
+                                [frame['stages'].get(name, 0) for name in stage_names] +
+                                [frame['counts'].get(name, 0) for name in count_names])
+
+    def dump(self, file_name):
+        """
+        Writes a trace file, as CSV if file_name ends in .csv and JSON otherwise.
+        """
+        if file_name.lower().endswith('.csv'):
+            self.dump_csv(file_name)
+        else:
+            self.dump_json(file_name)
+
+    def draw_overlay(self, canvas, color=(0, 0, 0)):
+        """
+        Draws the rolling window means of every stage and counter in the top left corner of canvas.
+        """
+        import pygame  # Only needed when the overlay is shown
+        if not pygame.font.get_init():
+            pygame.font.init()
+        if self.font is None:
+            self.font = pygame.font.SysFont('monospace', 14)
+
+        summary = self.summary()
+        total = summary['total']['mean']
+        lines = ['frame {:7.2f} ms  ({:5.1f} fps)'.format(total, 1000 / total if total else 0)]
+        lines += ['{:<12} {:7.2f} ms'.format(name, stats['mean']) for name, stats in summary['stages'].items()]
+        lines += ['{:<12} {:10.0f}'.format(name, stats['mean']) for name, stats in summary['counts'].items()]
+
+        for idx, line in enumerate(lines):
+            canvas.blit(self.font.render(line, True, color), (5, 5 + idx * 16))
@@ -0,0 +1,358 @@
+"""
+Array based line and triangle rasterization. Instead of walking each line in Python, every pixel
+of every line in a frame is generated at once with NumPy and written to the pixel buffer with a
+single scatter assignment. Triangles are filled the same way, a group of triangles at a time.
+
+Lines are given in canvas coordinates (x right, y up, as produced by Renderer.norm_to_canvas_coord)
+and written into a pixel array indexed [x, row], like pygame.surfarray.pixels3d, where
+row = height - y just as in Renderer.draw_point_canvas.
+"""
+import numpy as np
+
+
+def clip_to_rect(points0, points1, rect):
+    """
+    Clips 2D line segments to a rectangle (x_min, y_min, x_max, y_max) with Liang-Barsky.
+    points0 and points1 are (N, 2+) arrays, any extra columns (such as z) are interpolated too.
+    Returns the clipped endpoints and a mask of the segments that are at least partly inside.
+    """
+    x_min, y_min, x_max, y_max = rect
+    delta = points1 - points0
+    t0 = np.zeros(len(points0))
+    t1 = np.ones(len(points0))
+    keep = np.ones(len(points0), dtype=bool)
+
+    # Each boundary as (p, q): the segment is inside where t*p <= q
+    for p, q in ((-delta[:, 0], points0[:, 0] - x_min), (delta[:, 0], x_max - points0[:, 0]),
+                 (-delta[:, 1], points0[:, 1] - y_min), (delta[:, 1], y_max - points0[:, 1])):
+        parallel = p == 0
+        keep &= ~(parallel & (q < 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = q / p
+        t0 = np.where(~parallel & (p < 0), np.maximum(t0, t), t0)
+        t1 = np.where(~parallel & (p > 0), np.minimum(t1, t), t1)
+
+    keep &= t0 <= t1
+    return points0 + t0[:, np.newaxis] * delta, points0 + t1[:, np.newaxis] * delta, keep
+
+
+def line_steps(points0, points1):
+    """
+    Returns how many one pixel steps each line takes along its longer axis.
+    """
+    return np.ceil(np.max(np.abs(points1[:, :2] - points0[:, :2]), axis=1)).astype(np.int64)
+
+
+def line_pixels(points0, points1, k_first=None, k_last=None):
+    """
+    Generates the pixels covered by line segments, stepping one pixel at a time along the longer axis.
+    Sample k of a line sits at k / steps along it; k_first and k_last optionally limit each line
+    to a range of its samples, which come out exactly as they would from the whole line.
+    Returns integer x and y arrays, the interpolated z of every pixel and the index of its line.
+    """
+    delta = points1 - points0
+    steps = line_steps(points0, points1)
+    if k_first is None:
+        k_first, k_last = np.zeros_like(steps), steps
+    counts = np.maximum(k_last - k_first + 1, 0)
+
+    line_idx = np.repeat(np.arange(len(points0)), counts)
+    starts = np.cumsum(counts) - counts
+    k = np.arange(counts.sum()) - np.repeat(starts - k_first, counts)
+    t = k / np.maximum(steps, 1)[line_idx]
+
+    pixels = points0[line_idx] + t[:, np.newaxis] * delta[line_idx]
+    return np.floor(pixels[:, 0]).astype(np.int64), np.floor(pixels[:, 1]).astype(np.int64), pixels[:, 2], line_idx
+
+
+def sample_range(points0, points1, rect, height, size=1):
+    """
+    Returns the first and last sample (as in line_pixels) of each line that can land in a rect
+    (x_min, row_min, x_max, row_max) of the pixel array, once grown to size. The range is
+    conservative by a sample at each end; lines that miss the rect get k_first > k_last.
+    """
+    x_min, row_min, x_max, row_max = rect
+    steps = line_steps(points0, points1)
+    k_first = np.zeros(len(points0))
+    k_last = steps.astype(float)
+    miss = np.zeros(len(points0), dtype=bool)
+
+    # Canvas y of the rows, remembering row = height - floor(y) and that points grow right and down
+    for axis, low, high in ((0, x_min - size + 1, x_max), (1, height - row_max + 1, height - row_min + size)):
+        start = points0[:, axis]
+        delta = points1[:, axis] - start
+        flat = delta == 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            k_low = (low - start) * steps / delta
+            k_high = (high - start) * steps / delta
+        k_first = np.where(flat, k_first, np.maximum(k_first, np.minimum(k_low, k_high)))
+        k_last = np.where(flat, k_last, np.minimum(k_last, np.maximum(k_low, k_high)))
+        # A line that doesn't move along this axis is either always or never in range
+        miss |= flat & ((start < low) | (start >= high))
+
+    k_first = np.maximum(np.floor(k_first) - 1, 0).astype(np.int64)
+    k_last = np.minimum(np.ceil(k_last) + 1, steps).astype(np.int64)
+    k_last[miss] = -1
+    return k_first, k_last
+
+
+def expand_points(x, row, size):
+    """
+    Grows each pixel into a size x size square extending right and down, like Renderer.draw_point_canvas.
+    Returns the new x and row arrays and the index of the pixel each one came from.
+    """
+    if size == 1:
+        return x, row, np.arange(len(x))
+    di, dj = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+    source = np.repeat(np.arange(len(x)), size * size)
+    return x[source] + np.tile(di.ravel(), len(x)), row[source] + np.tile(dj.ravel(), len(x)), source
+
+
+def depth_test(x, row, z, depth):
+    """
+    Resolves pixels that land on the same spot and tests them against a depth buffer indexed [x, row].
+    Keeps the nearest (smallest z) pixel at each spot; when several tie, they all pass and the
+    last one given ends up on top. Writes the passing depths into the buffer and returns the
+    indices of the pixels that passed.
+    """
+    depth_flat = depth.reshape(-1)  # A view, so the buffer is updated in place
+    flat = x * depth.shape[1] + row
+    z = z.astype(depth.dtype)
+
+    nearer = np.flatnonzero(z < depth_flat[flat])
+    np.minimum.at(depth_flat, flat[nearer], z[nearer])
+    return nearer[z[nearer] == depth_flat[flat[nearer]]]
+
+
+def scatter(pixels, x, row, z, colors, depth=None, rect=None):
+    """
+    Writes pixels at [x, row] with their colors, discarding those outside rect (x_min, row_min,
+    x_max, row_max; by default the whole array) or, when a depth buffer is given, behind what
+    has already been drawn. Returns the number of pixels written.
+    """
+    x_min, row_min, x_max, row_max = rect if rect is not None else (0, 0) + pixels.shape[:2]
+    in_rect = (x >= x_min) & (x < x_max) & (row >= row_min) & (row < row_max)
+    x, row, z, colors = x[in_rect], row[in_rect], z[in_rect], colors[in_rect]
+
+    if depth is not None:
+        passed = depth_test(x, row, z, depth)
+        x, row, colors = x[passed], row[passed], colors[passed]
+
+    pixels[x, row] = colors
+    return len(x)
+
+
+def clip_to_canvas(points0_can, points1_can, colors, width, height):
+    """
+    Clips lines in canvas coordinates to the canvas, dropping the ones entirely off it.
+    Returns the clipped endpoints and the colors of the remaining lines as uint8.
+    """
+    points0, points1, keep = clip_to_rect(np.asarray(points0_can, dtype=float), np.asarray(points1_can, dtype=float),
+                                          (0, 0, width, height))
+    return points0[keep], points1[keep], np.asarray(colors, dtype=np.uint8)[keep]
+
+
+def rasterize(pixels, points0, points1, colors, size=1, depth=None, rect=None, k_first=None, k_last=None):
+    """
+    Rasterizes lines that are already clipped to the canvas, writing only pixels inside rect.
+    Returns the number of pixels written.
+    """
+    x, y, z, line_idx = line_pixels(points0, points1, k_first, k_last)
+    x, row, source = expand_points(x, pixels.shape[1] - y, size)
+    return scatter(pixels, x, row, z[source], colors[line_idx][source], depth, rect)
+
+
+def draw_lines(pixels, points0_can, points1_can, colors, size=1, depth=None, rect=None):
+    """
+    Draws line segments given in canvas coordinates into a pixel array.
+    points0_can and points1_can are (N, 3) arrays of endpoints, colors an (N, 3) array of RGB values.
+    When depth is given, it is a float depth buffer with the same [x, row] shape as pixels, and
+    each pixel is only drawn if its interpolated z is nearer than the buffer.
+    A rect (x_min, row_min, x_max, row_max) limits drawing to that part of the array, leaving
+    the pixels outside it exactly as they were.
+    Returns the number of pixels written.
+    """
+    if len(points0_can) == 0:
+        return 0
+    width, height = pixels.shape[:2]
+
+    # Only rasterize the part of each line that can land on the canvas
+    points0, points1, colors = clip_to_canvas(points0_can, points1_can, colors, width, height)
+    if rect is None:
+        return rasterize(pixels, points0, points1, colors, size, depth)
+
+    k_first, k_last = sample_range(points0, points1, rect, height, size)
+    hit = k_first <= k_last
+    if not np.any(hit):
+        return 0
+    return rasterize(pixels, points0[hit], points1[hit], colors[hit], size, depth, rect, k_first[hit], k_last[hit])
+
+
+def triangle_pixels(points0, points1, points2, rect, height):
+    """
+    Generates the pixels whose centers lie inside triangles given in canvas coordinates, limited
+    to a rect (x_min, row_min, x_max, row_max) of a pixel array height rows tall. Triangles can be
+    wound either way.
+    Each edge function is linear along a row of pixels, so instead of testing every pixel of a
+    triangle's bounding box, the three edge functions give the span of pixel centers inside the
+    triangle on each of its rows directly, and only those pixels are generated.
+    Returns integer x and row arrays, the z of every pixel interpolated across its triangle and the index of its triangle.
+    """
+    x_min, row_min, x_max, row_max = rect
+    corners = np.stack((points0, points1, points2), axis=1)
+
+    # Each edge (p, q) as a*x + b*y + c, positive on the inside whichever way the triangle is wound
+    p, q = corners, np.roll(corners, -1, axis=1)
+    a = p[:, :, 1] - q[:, :, 1]
+    b = q[:, :, 0] - p[:, :, 0]
+    c = -(a * p[:, :, 0] + b * p[:, :, 1])
+    area = a[:, 0] * corners[:, 2, 0] + b[:, 0] * corners[:, 2, 1] + c[:, 0]  # Twice the signed area
+    flip = np.where(area < 0, -1, 1)[:, np.newaxis]
+    a, b, c = a * flip, b * flip, c * flip
+    area = np.abs(area)
+
+    # z is a plane over the canvas: the edge functions, opposite each corner, weight its z
+    z_corner = corners[:, [2, 0, 1], 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_a, z_b, z_c = [np.sum(coef * z_corner, axis=1) / area for coef in (a, b, c)]
+
+    # Rows of pixel centers (Y + .5) each triangle covers, where row = height - Y as for lines
+    first_y = np.maximum(np.ceil(corners[:, :, 1].min(axis=1) - .5), height - row_max + 1).astype(np.int64)
+    last_y = np.minimum(np.floor(corners[:, :, 1].max(axis=1) - .5), height - row_min).astype(np.int64)
+    rows = np.where(area > 0, np.maximum(last_y - first_y + 1, 0), 0)
+    tri_idx = np.repeat(np.arange(len(corners)), rows)
+    y = first_y[tri_idx] + np.arange(rows.sum()) - np.repeat(np.cumsum(rows) - rows, rows)
+
+    # Span of x on each row where all three edge functions are >= 0
+    row_a, offset = a[tri_idx], b[tri_idx] * (y + .5)[:, np.newaxis] + c[tri_idx]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bound = -offset / row_a
+    low = np.max(np.where(row_a > 0, bound, -np.inf), axis=1)
+    high = np.min(np.where(row_a < 0, bound, np.inf), axis=1)
+    empty = np.any((row_a == 0) & (offset < 0), axis=1)
+    first_x = np.maximum(np.ceil(np.maximum(low, x_min - 1) - .5), x_min).astype(np.int64)
+    last_x = np.minimum(np.floor(np.minimum(high, x_max + 1) - .5), x_max - 1).astype(np.int64)
+    counts = np.where(empty, 0, np.maximum(last_x - first_x + 1, 0))
+
+    span_idx = np.repeat(np.arange(len(y)), counts)
+    x = first_x[span_idx] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    y = y[span_idx]
+    tri_idx = tri_idx[span_idx]
+    z = z_a[tri_idx] * (x + .5) + z_b[tri_idx] * (y + .5) + z_c[tri_idx]
+    return x, height - y, z, tri_idx
+
+
+def draw_triangles(pixels, points0_can, points1_can, points2_can, colors, depth=None, rect=None, max_pixels=2**20):
+    """
+    Fills triangles given in canvas coordinates into a pixel array, one color per triangle.
+    points0_can, points1_can and points2_can are (N, 3) arrays of corners, colors an (N, 3) array of RGB values.
+    Like draw_lines, pixels are depth tested against depth when it is given, and only drawn inside rect.
+    Triangles are rasterized in groups covering at most about max_pixels bounding box pixels,
+    so a frame of large triangles doesn't need one huge temporary array. With a depth buffer the
+    groups go front to back, so pixels hidden by an earlier group fail the depth test before
+    their colors are looked up.
+    Returns the number of pixels written.
+    """
+    if len(points0_can) == 0:
+        return 0
+    width, height = pixels.shape[:2]
+    rect = rect if rect is not None else (0, 0, width, height)
+    corners = np.stack([np.asarray(points, dtype=float) for points in (points0_can, points1_can, points2_can)], axis=1)
+    colors = np.asarray(colors, dtype=np.uint8)
+    if depth is not None:
+        order = np.argsort(corners[:, :, 2].min(axis=1), kind='stable')
+        corners, colors = corners[order], colors[order]
+
+    # Rough bounding box sizes, to split the triangles into groups of bounded work
+    size = np.clip(np.ptp(corners[:, :, 0], axis=1), 0, width) * np.clip(np.ptp(corners[:, :, 1], axis=1), 0, height)
+    group = np.floor(np.cumsum(size + 1) / max_pixels).astype(np.int64)
+    bounds = np.flatnonzero(np.diff(group)) + 1
+
+    written = 0
+    for start, end in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(group)]))):
+        x, row, z, tri_idx = triangle_pixels(corners[start:end, 0], corners[start:end, 1], corners[start:end, 2],
+                                             rect, height)
+        # Every pixel is already inside rect, so only the depth test is left
+        if depth is not None:
+            passed = depth_test(x, row, z, depth)
+            x, row, tri_idx = x[passed], row[passed], tri_idx[passed]
+        pixels[x, row] = colors[start:end][tri_idx]
+        written += len(x)
+    return written
+
+
+def canvas_tiles(width, height, tile_size):
+    """
+    Returns the (x_min, row_min, x_max, row_max) rects of square tiles covering a width x height pixel array.
+    """
+    return [(x, row, min(x + tile_size, width), min(row + tile_size, height))
+            for row in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+
+def tile_bins(points0, points1, size, height, tile_size, columns, rows):
+    """
+    Bins lines that are already clipped to the canvas into the tiles of a grid of columns x rows
+    tiles, numbered row by row like canvas_tiles. Every line goes into each tile its pixel bounding
+    box (grown to size, plus a pixel of slack) overlaps. Returns the line indices sorted by tile,
+    keeping their order within each tile, and where each tile's run of them starts and ends.
+    """
+    low = np.floor(np.minimum(points0[:, :2], points1[:, :2]))
+    high = np.floor(np.maximum(points0[:, :2], points1[:, :2]))
+    # Remembering row = height - floor(y), and that points grow right and down
+    first_col = np.clip((low[:, 0] - 1) // tile_size, 0, columns - 1).astype(np.int64)
+    last_col = np.clip((high[:, 0] + size) // tile_size, 0, columns - 1).astype(np.int64)
+    first_row = np.clip((height - high[:, 1] - 1) // tile_size, 0, rows - 1).astype(np.int64)
+    last_row = np.clip((height - low[:, 1] + size) // tile_size, 0, rows - 1).astype(np.int64)
+
+    widths = last_col - first_col + 1
+    counts = widths * (last_row - first_row + 1)
+    line_idx = np.repeat(np.arange(len(points0)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    tile = (first_row[line_idx] + k // widths[line_idx]) * columns + first_col[line_idx] + k % widths[line_idx]
+
+    order = np.argsort(tile, kind='stable')
+    bounds = np.searchsorted(tile[order], np.arange(columns * rows + 1))
+    return line_idx[order], bounds
+
+
+def draw_lines_tiled(pixels, points0_can, points1_can, colors, size=1, depth=None, tile_size=128, executor=None,
+                     rect=None):
+    """
+    Draws line segments like draw_lines, but splits the canvas into tiles and bins each line into
+    the tiles it crosses. Every tile only generates the samples of its own lines that can land in it
+    and writes only its own pixels, so tiles can be handed to an executor (such as a
+    concurrent.futures.ThreadPoolExecutor). The result is identical to draw_lines.
+    This is not faster than draw_lines: the per-tile work is dominated by the pixel scatter and
+    np.minimum.at depth test, which hold the GIL, so worker threads only add overhead.
+    With a rect, only the parts of the tiles inside it are drawn.
+    Returns the number of pixels written.
+    """
+    if len(points0_can) == 0:
+        return 0
+    width, height = pixels.shape[:2]
+    points0, points1, colors = clip_to_canvas(points0_can, points1_can, colors, width, height)
+    if len(points0) == 0:
+        return 0
+    columns, rows = -(-width // tile_size), -(-height // tile_size)
+    binned, bounds = tile_bins(points0, points1, size, height, tile_size, columns, rows)
+
+    def draw_tile(tile):
+        index, rect = tile
+        lines = binned[bounds[index]:bounds[index + 1]]
+        if len(lines) == 0:
+            return 0
+        tile0, tile1 = points0[lines], points1[lines]
+        k_first, k_last = sample_range(tile0, tile1, rect, height, size)
+        hit = k_first <= k_last
+        if not np.any(hit):
+            return 0
+        return rasterize(pixels, tile0[hit], tile1[hit], colors[lines[hit]], size, depth, rect, k_first[hit], k_last[hit])
+
+    tiles = list(enumerate(canvas_tiles(width, height, tile_size)))
+    if rect is not None:
+        tiles = [(index, (max(x_min, rect[0]), max(row_min, rect[1]), min(x_max, rect[2]), min(row_max, rect[3])))
+                 for index, (x_min, row_min, x_max, row_max) in tiles]
+        tiles = [(index, tile) for index, tile in tiles if tile[0] < tile[2] and tile[1] < tile[3]]
+    if executor is None:
+        return sum(map(draw_tile, tiles))
+    return sum(executor.map(draw_tile, tiles))
@@ -1,12 +1,15 @@
-from math import tan, sin, cos, atan
-from world import World
-import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import pygame
 from item import Item
-from camera import Camera
+import rasterizer
+import transforms
+from profiler import FrameProfiler
+from lazyimport import lazy_import
 
-sign = lambda x: math.copysign(1, x)
+pygame = lazy_import('pygame')  # Only loaded once something is drawn
+VIEW_EXTENT = .5  # norm_to_canvas_coord maps x and y from -VIEW_EXTENT to VIEW_EXTENT onto the canvas
 
 
 class Renderer:
@@ -21,41 +24,357 @@ class Renderer:
 
     """
 
-    def __init__(self, camera, window_size=(1000,1000)):
+    def __init__(self, camera, window_size=(1000,1000), batched=True, rasterizer='array', profiler=None,
+                 tile_size=None, workers=1, lod=True, reuse_frames=True, partial_redraw=False, mode='wireframe',
+                 adaptive_resolution=False, min_scale=.5, max_scale=1.0, target_frame_time=1/60):
         self.camera = camera
+        # 'wireframe' draws the edges of every item, 'solid' fills their front facing triangles with flat shading
+        self.mode = mode
+        self.light_direction = np.array([.3, .8, -.5]) / np.linalg.norm([.3, .8, -.5])  # Towards the light
+        self.ambient = .25  # Brightness of faces turned away from the light
+        # With a tile_size, the array rasterizer splits the canvas into tiles drawn by a pool of workers.
+        # Off by default: the tile kernels hold the GIL, so it is no faster than drawing the whole canvas
+        self.tile_size = tile_size
+        self.lod = lod  # Draws distant items with simplified meshes
+        self.lod_pixel_error = 2.0  # Largest on screen simplification error allowed, in pixels
+        self.lod_hysteresis = 1.25  # How far past the threshold an item goes before changing level
+        self.materialize_limit = 256  # Most items of a loaded snapshot built in one frame as they come into view
+        self.executor = ThreadPoolExecutor(workers) if tile_size and workers > 1 else None
+        self.profiler = profiler if profiler is not None else FrameProfiler(enabled=False)
+        self.show_stats = False  # Draws the profiler overlay on top of each frame
+        self.status = None  # A line of text, such as loading progress, drawn in the bottom left corner
+        self.font = None  # Loaded the first time status text is drawn
+        self.batched = batched  # False uses the per-line reference path (project_line)
+        self.rasterizer = rasterizer  # 'array' writes whole frames of lines at once, 'pixel' uses draw_line
         self.project_matrix = self.persp_proj_matrix(self.camera.fov, window_size[0]/window_size[1], 1, 300)
-
-    def draw_scene(self, world, canvas):
+        self.cull_stats = {'culled': 0, 'accepted': 0, 'intersecting': 0}  # Item counts from the last frame
+        self.depth_buffer = None  # Projected z of the nearest thing drawn at each pixel, indexed [x, row]
+        self.reuse_frames = reuse_frames  # Leaves the last frame up when nothing in it has changed
+        # Redraws only the screen area of items that moved, when the camera and the world's items haven't changed
+        self.partial_redraw = partial_redraw
+        self.frame_key = None  # What the frame on the canvas was drawn from
+        self.item_versions = {}  # Version of each item (by id) when the frame on the canvas was drawn
+        self.item_rects = {}  # Screen rect of each item (by id) in the frame on the canvas, None if off screen
+
+        # The scene is drawn at scale times the canvas resolution and stretched to fit it. With
+        # adaptive_resolution, the scale follows the recent frame times to hold target_frame_time (in seconds)
+        self.scale = max_scale
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.adaptive_resolution = adaptive_resolution
+        self.target_frame_time = target_frame_time
+        self.scale_step = .05  # Scales are rounded to this, so small timing changes don't resize the framebuffer
+        self.frame_times = deque(maxlen=10)  # Draw times of the last frames at the current scale
+        self.framebuffer = None  # Offscreen surface the scene is drawn on below full scale
+
+    def draw_scene(self, world, canvas, present=True, camera=None):
         """
-        Draws the frame and updates the display.
+        Draws the frame and, if present is set, updates the display.
+        Offscreen canvases are drawn with present=False.
+        camera can be a CameraState snapshot to draw from instead of the live camera.
+        Returns False if the frame already on the canvas was still up to date and nothing was drawn.
         """
 
+        profiler = self.profiler
+        if camera is None:
+            camera = self.camera
+        frame_start = time.perf_counter()
+        window = canvas
+        canvas = self.get_framebuffer(window)
+
+        # Load and drop terrain chunks around the camera
+        terrain_version = None
+        if world.terrain is not None:
+            with profiler.stage('terrain'):
+                world.terrain.update(camera.pos)
+            terrain_version = world.terrain.version
+
+        # Build the items of a loaded snapshot that have come into view
+        if world.pending:
+            with profiler.stage('materialize'):
+                self.materialize_visible(world, camera)
+        objects = world.get_objects()
+
+        # Nothing to do if the camera, the world and every item are the same as in the last frame.
+        # The overlay changes every frame, so it always forces a redraw
+        frame_key = (id(window), id(canvas), canvas.get_size(), camera.version, world.version, world.instances_version,
+                     terrain_version, self.show_stats, self.status)
+        if self.reuse_frames and not self.show_stats and frame_key == self.frame_key:
+            moved = [item for item in objects if self.item_versions.get(id(item)) != item.version]
+            if not moved:
+                profiler.count('frames_reused')
+                return False
+            if self.partial_redraw and self.batched and self.rasterizer == 'array':
+                if canvas is window:
+                    drawn = self.redraw_items(objects, world.instances.values(), canvas, moved, present, camera)
+                else:
+                    # The stretched frame is presented whole
+                    drawn = self.redraw_items(objects, world.instances.values(), canvas, moved, False, camera)
+                    if drawn:
+                        self.present_frame(canvas, window, present)
+                if drawn:
+                    self.update_scale(time.perf_counter() - frame_start)
+                return drawn
+
         # Reset canvas to white
-        background = (255, 255, 255)
-        canvas.fill(background)
+        with profiler.stage('clear'):
+            background = (255, 255, 255)
+            canvas.fill(background)
+            self.clear_depth(canvas)
 
-        view_matrix = self.view_matrix()
+        with profiler.stage('view_matrix'):
+            view_matrix = self.view_matrix(camera)
 
-        self.draw_ground(canvas)
+        with profiler.stage('ground'):
+            self.draw_ground(canvas, camera)
+
+        # Skip items that are entirely outside the view before touching their geometry
+        with profiler.stage('cull'):
+            items = self.cull_items(objects, view_matrix.dot(self.project_matrix))
+            instances = self.cull_instances(world.instances.values(), view_matrix.dot(self.project_matrix))
+        profiler.count('items_visible', len(items))
+        profiler.count('instances_visible', sum(len(indices) for batch, indices in instances))
 
         # Draw all lines in the world
-        for item in world.items:
-            for line in item.lines:
-                self.project_line(canvas, line[0], line[1], view_matrix, self.project_matrix, item.color)
+        if self.mode == 'solid':
+            self.draw_solid(canvas, items, view_matrix, camera, instances=instances)
+        elif self.batched:
+            self.draw_lines_batched(canvas, items, view_matrix, self.project_matrix, camera, instances=instances)
+        else:
+            with profiler.stage('draw_lines'):
+                for item in items:
+                    for line in item.lines:
+                        self.project_line(canvas, line[0], line[1], view_matrix, self.project_matrix, item.color)
+            # Instances have no per-line path
+            self.draw_lines_batched(canvas, [], view_matrix, self.project_matrix, camera, instances=instances)
 
         # Draw center point
         self.draw_point(canvas, (0,0, .01), (0, 200, 0))
-        pygame.display.flip()
+        # The canvas area at the current resolution; the pixels the rasterizer wrote are counted as pixels_written
+        profiler.count('canvas_pixels', canvas.get_width() * canvas.get_height())
+
+        self.present_frame(canvas, window, present)
+
+        self.frame_key = frame_key
+        self.item_versions = {id(item): item.version for item in objects}
+        if self.partial_redraw:
+            rects = self.screen_rects(objects, view_matrix.dot(self.project_matrix), canvas)
+            self.item_rects = {id(item): rect for item, rect in zip(objects, rects)}
+        self.update_scale(time.perf_counter() - frame_start)
+        return True
+
+
+    def present_frame(self, canvas, window, present=True):
+        """
+        Stretches a frame drawn on the framebuffer canvas to the window surface, if they differ, then
+        draws the overlay and status text over it at full resolution and, if present is set, updates the display.
+        """
+        if canvas is not window:
+            with self.profiler.stage('upscale'):
+                pygame.transform.scale(canvas, window.get_size(), window)
+
+        if self.show_stats:
+            with self.profiler.stage('overlay'):
+                self.profiler.draw_overlay(window)
+
+        if self.status:
+            self.draw_status(window, self.status)
+
+        if present:
+            with self.profiler.stage('flip'):
+                pygame.display.flip()
+
+
+    def get_framebuffer(self, window):
+        """
+        Returns the surface to draw the scene on: the window surface itself at full scale, otherwise
+        an offscreen surface of the scaled size in the same pixel format, reused while the size stays the same.
+        Both sides are scaled alike and the frame is stretched back over the whole window, so the
+        projection and norm_to_canvas_coord, which work in fractions of the canvas size, map every
+        point to the same place in the window at any scale.
+        """
+        width, height = window.get_size()
+        size = (max(1, int(round(width * self.scale))), max(1, int(round(height * self.scale))))
+        if size == (width, height):
+            return window
+        if self.framebuffer is None or self.framebuffer.get_size() != size:
+            self.framebuffer = pygame.Surface(size, 0, window)
+        return self.framebuffer
+
+
+    def update_scale(self, frame_time):
+        """
+        Adds the time a frame took to draw (in seconds) to the moving average, and with adaptive_resolution
+        picks a new scale from it once enough frames were drawn at the current one.
+        The pixel count goes with the square of the scale, so the scale changes by the square root of
+        how far the average is from target_frame_time.
+        """
+        self.frame_times.append(frame_time)
+        if not self.adaptive_resolution or len(self.frame_times) < self.frame_times.maxlen:
+            return
+        average = sum(self.frame_times) / len(self.frame_times)
+        scale = self.scale * (self.target_frame_time / average) ** .5
+        scale = round(round(min(max(scale, self.min_scale), self.max_scale) / self.scale_step) * self.scale_step, 6)
+        scale = min(max(scale, self.min_scale), self.max_scale)
+        if abs(scale - self.scale) > self.scale_step / 2:
+            self.scale = scale
+            self.frame_times.clear()  # Times at the old scale say little about the new one
+
+
+    def redraw_items(self, objects, batches, canvas, moved, present=True, camera=None):
+        """
+        Updates the frame on the canvas after the moved items (out of all the objects and instance
+        batches in the world) changed, without redrawing the rest of it.
+        Only the screen area the items covered before and after moving is cleared, and only the
+        items overlapping it are drawn again, clipped to it. The camera must not have changed
+        since the last full frame.
+        Returns False if the items stayed off screen, so nothing had to be drawn.
+        """
+        profiler = self.profiler
+        if camera is None:
+            camera = self.camera
+
+        with profiler.stage('view_matrix'):
+            view_matrix = self.view_matrix(camera)
+            view_project_matrix = view_matrix.dot(self.project_matrix)
+
+        # The dirty rect covers where the moved items were and where they are now
+        with profiler.stage('dirty_rect'):
+            rects = self.screen_rects(moved, view_project_matrix, canvas)
+            dirty = [self.item_rects.get(id(item)) for item in moved] + rects
+            for item, rect in zip(moved, rects):
+                self.item_versions[id(item)] = item.version
+                self.item_rects[id(item)] = rect
+            dirty = self.union_rect([rect for rect in dirty if rect is not None])
+        if dirty is None:
+            profiler.count('frames_reused')
+            return False
+        x_min, row_min, x_max, row_max = dirty
+        profiler.count('pixels_dirty', (x_max - x_min) * (row_max - row_min))
+
+        with profiler.stage('clear'):
+            canvas.set_clip(pygame.Rect(x_min, row_min, x_max - x_min, row_max - row_min))
+            canvas.fill((255, 255, 255))
+            self.draw_ground(canvas, camera)
+            canvas.set_clip(None)
+            self.depth_buffer[x_min:x_max, row_min:row_max] = np.inf
+
+        with profiler.stage('cull'):
+            items = [item for item in self.cull_items(objects, view_project_matrix)
+                     if self.overlaps(self.item_rects.get(id(item)), dirty)]
+            instances = self.cull_instances(batches, view_project_matrix)
+        profiler.count('items_visible', len(items))
+
+        if self.mode == 'solid':
+            self.draw_solid(canvas, items, view_matrix, camera, rect=dirty, instances=instances)
+        else:
+            self.draw_lines_batched(canvas, items, view_matrix, self.project_matrix, camera, rect=dirty,
+                                    instances=instances)
+
+        # Draw center point, which only lands on the canvas again if it was cleared
+        self.draw_point(canvas, (0,0, .01), (0, 200, 0))
+
+        if present:
+            with profiler.stage('flip'):
+                pygame.display.update(pygame.Rect(x_min, row_min, x_max - x_min, row_max - row_min))
+        return True
+
+
+    def draw_status(self, canvas, text, color=(0, 0, 0)):
+        """
+        Draws a line of text in the bottom left corner of canvas.
+        """
+        if not pygame.font.get_init():
+            pygame.font.init()
+        if self.font is None:
+            self.font = pygame.font.SysFont('monospace', 14)
+        canvas.blit(self.font.render(text, True, color), (5, canvas.get_height() - 21))
+
+
+    def invalidate(self):
+        """
+        Makes the next frame a full redraw, e.g. after something else has drawn over the window.
+        """
+        self.frame_key = None
+
+
+    def screen_rects(self, items, view_project_matrix, canvas):
+        """
+        Returns a conservative (x_min, row_min, x_max, row_max) pixel rect around each item, from its
+        projected bounding box, or None for items that are entirely off the canvas.
+        Items with a corner behind the camera get the whole canvas.
+        """
+        width, height = canvas.get_size()
+        if not items:
+            return []
+
+        # The 8 corners of every bounding box, (N, 8, 3)
+        aabbs = np.array([item.aabb for item in items])
+        corner_idx = np.array([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+        corners = aabbs[:, corner_idx, [0, 1, 2]]
+        points_h = self.to_clip_space(corners.reshape(-1, 3), view_project_matrix).reshape(len(items), 8, 4)
+
+        rects = []
+        for points in points_h:
+            if np.any(points[:, 3] <= 0):
+                rects.append((0, 0, width, height))
+                continue
+            points_can = self.norm_to_canvas_coords(canvas, points / points[:, 3:4])
+            # A pixel further on each side covers rounding in the rasterizer
+            x_min = max(int(np.floor(points_can[:, 0].min())) - 1, 0)
+            x_max = min(int(np.ceil(points_can[:, 0].max())) + 2, width)
+            row_min = max(height - int(np.ceil(points_can[:, 1].max())) - 1, 0)
+            row_max = min(height - int(np.floor(points_can[:, 1].min())) + 2, height)
+            rects.append((x_min, row_min, x_max, row_max) if x_min < x_max and row_min < row_max else None)
+        return rects
+
+
+    def union_rect(self, rects):
+        """
+        Returns the smallest rect containing all the given (x_min, row_min, x_max, row_max) rects, or None if there are none.
+        """
+        if not rects:
+            return None
+        rects = np.array(rects)
+        return (int(rects[:, 0].min()), int(rects[:, 1].min()), int(rects[:, 2].max()), int(rects[:, 3].max()))
+
+
+    def overlaps(self, rect0, rect1):
+        """
+        Returns whether two (x_min, row_min, x_max, row_max) rects overlap. A None rect overlaps nothing.
+        """
+        if rect0 is None or rect1 is None:
+            return False
+        return rect0[0] < rect1[2] and rect1[0] < rect0[2] and rect0[1] < rect1[3] and rect1[1] < rect0[3]
+
+
+    def clear_depth(self, canvas):
+        """
+        Resets the depth buffer to infinitely far away, only allocating it when the canvas size changes.
+        """
+        if self.depth_buffer is None or self.depth_buffer.shape != canvas.get_size():
+            self.depth_buffer = np.empty(canvas.get_size(), dtype=np.float32)
+        self.depth_buffer.fill(np.inf)
+
 
+    @property
+    def depth(self):
+        """
+        The depth buffer of the last frame, as a (width, height) float32 array of projected z values.
+        Pixels nothing was drawn on are inf.
+        """
+        return self.depth_buffer
 
 
-    def draw_ground(self, canvas):
+    def draw_ground(self, canvas, camera=None):
         """
         Draws the ground. A rectangle based on camera angle
         """
 
-        fov = self.camera.fov
-        cur_angle = (self.camera.angle[1]+(fov/2))/fov
+        if camera is None:
+            camera = self.camera
+        fov = camera.fov
+        cur_angle = (camera.angle[1]+(fov/2))/fov
         if cur_angle < 0:
             cur_angle = 0
         if cur_angle > 1:
@@ -64,6 +383,445 @@ class Renderer:
         pygame.draw.rect(canvas, (120,120,120), (0,canvas.get_height()-height,canvas.get_width(),canvas.get_height()), 0)
 
 
+    def frustum_planes(self, view_project_matrix):
+        """
+        Returns the six planes of the view frustum as a (6, 4) array in world coordinates.
+        A point p is inside a plane (a, b, c, d) when a*p[0] + b*p[1] + c*p[2] + d >= 0.
+        These are the same -VIEW_EXTENT*w <= x, y <= VIEW_EXTENT*w and 0 <= z <= w bounds as clip_distances.
+        """
+        # Points are row vectors, so the clip coordinates come from the columns of the matrix
+        cols = view_project_matrix.T
+        side = VIEW_EXTENT * cols[3]
+        planes = np.array([side + cols[0], side - cols[0],
+                           side + cols[1], side - cols[1],
+                           cols[2], cols[3] - cols[2]])
+
+        # Normalize so that plane distances are in world units, for comparing against sphere radii
+        return planes / np.linalg.norm(planes[:, :3], axis=1)[:, np.newaxis]
+
+
+    def classify_bounds(self, centers, radii, aabbs, planes):
+        """
+        Tests bounding spheres and boxes against frustum planes.
+        Returns an array holding 0 for each volume that is outside, 1 for one that is fully inside
+        and 2 for one that intersects the frustum boundary.
+        """
+        # Spheres first: (N, 6) signed distances from each center to each plane
+        dist = centers.dot(planes[:, :3].T) + planes[:, 3]
+        outside = np.any(dist < -radii[:, np.newaxis], axis=1)
+        inside = np.all(dist >= radii[:, np.newaxis], axis=1)
+
+        # Boxes refine the spheres that straddle a plane: test the box corners furthest along
+        # (p-vertex) and against (n-vertex) each plane normal
+        unsure = ~(outside | inside)
+        if np.any(unsure):
+            positive = planes[:, :3] >= 0
+            box_min = aabbs[unsure, 0][:, np.newaxis, :]
+            box_max = aabbs[unsure, 1][:, np.newaxis, :]
+            p_vertex = np.where(positive, box_max, box_min)
+            n_vertex = np.where(positive, box_min, box_max)
+            outside[unsure] = np.any(np.sum(p_vertex * planes[:, :3], axis=2) + planes[:, 3] < 0, axis=1)
+            inside[unsure] = np.all(np.sum(n_vertex * planes[:, :3], axis=2) + planes[:, 3] >= 0, axis=1)
+
+        return np.where(outside, 0, np.where(inside, 1, 2))
+
+
+    def cull_items(self, items, view_project_matrix):
+        """
+        Returns the items whose bounding volumes are at least partly inside the view frustum,
+        and records how many were culled, accepted and intersecting in cull_stats.
+        """
+        if not items:
+            self.cull_stats = {'culled': 0, 'accepted': 0, 'intersecting': 0}
+            return []
+
+        centers = np.array([item.bounding_center for item in items])
+        radii = np.array([item.bounding_radius for item in items])
+        aabbs = np.array([item.aabb for item in items])
+        status = self.classify_bounds(centers, radii, aabbs, self.frustum_planes(view_project_matrix))
+
+        counts = np.bincount(status, minlength=3)
+        self.cull_stats = {'culled': int(counts[0]), 'accepted': int(counts[1]), 'intersecting': int(counts[2])}
+        return [item for item, visible in zip(items, status) if visible]
+
+
+    def cull_instances(self, batches, view_project_matrix):
+        """
+        Culls every instance of every batch against the view frustum in one test per batch, adding
+        the counts to cull_stats. Returns (batch, indices) pairs of the instances at least partly in view.
+        """
+        planes = self.frustum_planes(view_project_matrix)
+        visible = []
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+            centers, radii, aabbs = batch.get_bounds()
+            status = self.classify_bounds(centers, radii, aabbs, planes)
+            counts = np.bincount(status, minlength=3)
+            for idx, name in enumerate(('culled', 'accepted', 'intersecting')):
+                self.cull_stats[name] += int(counts[idx])
+            indices = np.flatnonzero(status)
+            if len(indices):
+                visible.append((batch, indices))
+        return visible
+
+
+    def materialize_visible(self, world, camera=None):
+        """
+        Builds the world's pending snapshot items whose bounds are at least partly in view, up to
+        materialize_limit of them, so the rest of a big snapshot costs nothing until it is looked at.
+        Returns the number of items built.
+        """
+        view_project_matrix = self.view_matrix(camera).dot(self.project_matrix)
+        built = 0
+        for batch, indices in self.cull_instances(list(world.pending.values()), view_project_matrix):
+            indices = indices[:self.materialize_limit - built]
+            world.materialize(batch.file_name, indices)
+            built += len(indices)
+            if built == self.materialize_limit:
+                break
+        self.profiler.count('items_materialized', built)
+        return built
+
+
+    def select_lods(self, items, canvas, camera=None):
+        """
+        Picks a level of detail for each item from how large its simplification error would look
+        on screen, and returns the (world vertices, edges) to draw for each.
+        An item moves to a coarser level once that level's error is below lod_pixel_error / lod_hysteresis
+        pixels, and back to a finer one once its current error grows past lod_pixel_error * lod_hysteresis,
+        so items near a threshold don't flicker between levels.
+        """
+        if camera is None:
+            camera = self.camera
+        if not self.lod:
+            return [(item.world_vertices, item.edges) for item in items]
+
+        # Pixels on the canvas per world unit at a distance of 1, along the y axis
+        pixels_per_unit = self.project_matrix[1, 1] * canvas.get_height()
+        camera_pos = np.asarray(camera.pos, dtype=float)
+        geometry = []
+        edges_saved = 0
+        for item in items:
+            # Distance to the nearest point of the bounding sphere
+            distance = np.linalg.norm(item.bounding_center - camera_pos) - item.bounding_radius
+            level = item.lod_level
+            if distance <= 0:
+                level = 0
+            else:
+                error_px = lambda lod: item.lod_error(lod) * pixels_per_unit / distance
+                while level > 0 and error_px(level) > self.lod_pixel_error * self.lod_hysteresis:
+                    level -= 1
+                while (level + 1 < item.lod_levels and
+                       error_px(level + 1) <= self.lod_pixel_error / self.lod_hysteresis):
+                    level += 1
+            item.lod_level = level
+
+            vertices, edges = item.get_lod(level)
+            edges_saved += len(item.edges) - len(edges)
+            geometry.append((vertices, edges))
+
+        self.profiler.count('edges_saved', edges_saved)
+        return geometry
+
+
+    def select_instance_lods(self, batch, indices, canvas, camera=None):
+        """
+        Picks a level of detail for each of the given instances of a batch the way select_lods does
+        for items, for all of them at once, and returns the level of each.
+        """
+        if camera is None:
+            camera = self.camera
+        levels = batch.lod_levels[indices].astype(np.int64)
+        if not self.lod:
+            return np.zeros(len(indices), dtype=np.int64)
+
+        centers, radii, aabbs = batch.get_bounds()
+        pixels_per_unit = self.project_matrix[1, 1] * canvas.get_height()
+        distance = np.linalg.norm(centers[indices] - np.asarray(camera.pos, dtype=float), axis=1) - radii[indices]
+        near = distance <= 0
+        scale = np.where(near, 0, pixels_per_unit / np.where(near, 1, distance))
+        error_px = lambda lod: batch.lod_error(lod, indices) * scale
+
+        # The same walk as select_lods, one step per level for every instance at once
+        count = len(batch.mesh.lods)
+        for step in range(count):
+            levels = np.where((levels > 0) & (error_px(levels) > self.lod_pixel_error * self.lod_hysteresis), levels - 1, levels)
+        for step in range(count):
+            finer = np.minimum(levels + 1, count - 1)
+            levels = np.where((levels + 1 < count) & (error_px(finer) <= self.lod_pixel_error / self.lod_hysteresis), finer, levels)
+        levels[near] = 0
+
+        batch.lod_levels[indices] = levels
+        return levels
+
+
+    def project_instances(self, instances, view_project_matrix, canvas, camera=None):
+        """
+        Transforms the vertices of the given (batch, indices) instances straight to clip space.
+        Each instance's model matrix is folded into the view/projection matrix, so the shared mesh is
+        multiplied once per instance without ever being stored in world coordinates. Instances are
+        grouped by level of detail so each group is a single multiply.
+        Returns the (N, 4) clip coordinates, the (E, 2) edges into them and the (E, 3) color of each edge.
+        """
+        points_h, edges, edge_colors = [], [], []
+        offset = 0
+        edges_saved = 0
+        for batch, indices in instances:
+            levels = self.select_instance_lods(batch, indices, canvas, camera)
+            for level in np.unique(levels):
+                group = indices[levels == level]
+                vertices, level_edges, error = batch.mesh.lods[level]
+                if len(level_edges) == 0:
+                    continue
+                # Row vectors: clip = [v, 1] . model^T . view_project
+                mvp = np.matmul(batch.transform_matrices(group).transpose(0, 2, 1), view_project_matrix)
+                group_h = np.matmul(np.asarray(vertices, dtype=float), mvp[:, :3]) + mvp[:, np.newaxis, 3]
+                points_h.append(group_h.reshape(-1, 4))
+
+                starts = offset + np.arange(len(group)) * len(vertices)
+                edges.append((level_edges[np.newaxis] + starts[:, np.newaxis, np.newaxis]).reshape(-1, 2))
+                edge_colors.append(np.repeat(batch.colors[group], len(level_edges), axis=0))
+                offset += len(group) * len(vertices)
+                edges_saved += len(group) * (len(batch.mesh.edges) - len(level_edges))
+
+        self.profiler.count('edges_saved', edges_saved)
+        if not points_h:
+            return np.empty((0, 4)), np.empty((0, 2), dtype=np.int64), np.empty((0, 3), dtype=np.uint8)
+        return np.concatenate(points_h), np.concatenate(edges), np.concatenate(edge_colors)
+
+
+    def draw_lines_batched(self, canvas, items, view_matrix, project_matrix, camera=None, rect=None, instances=()):
+        """
+        Projects every line of the given items and instances at once and draws them.
+        The unique vertices of all items are gathered into one homogeneous array, multiplied by the
+        combined view/projection matrix, clipped, divided by w and mapped to the canvas as
+        whole-array operations, so a vertex shared by several edges is only projected once.
+        instances are (batch, indices) pairs, as returned by cull_instances, projected by project_instances.
+        Each item is drawn at the level of detail select_lods picks for it.
+        With a rect, the array rasterizer only draws inside that part of the canvas.
+        """
+        items = [item for item in items if len(item.edges) > 0]
+        if not items and not instances:
+            return
+
+        profiler = self.profiler
+        view_project_matrix = view_matrix.dot(project_matrix)
+
+        # Offset each item's edge indices into the combined vertex array
+        with profiler.stage('gather'):
+            geometry = self.select_lods(items, canvas, camera)
+            offsets = np.cumsum([0] + [len(vertices) for vertices, edges in geometry[:-1]])
+            points_w = np.concatenate([vertices for vertices, edges in geometry] + [np.empty((0, 3))])
+            edges = np.concatenate([edges + offset for (vertices, edges), offset in zip(geometry, offsets)] +
+                                   [np.empty((0, 2), dtype=np.int64)])
+            edge_colors = np.repeat(np.array([item.color for item in items], dtype=np.uint8).reshape(-1, 3),
+                                    [len(edges) for vertices, edges in geometry], axis=0)
+
+        with profiler.stage('project'):
+            points_h = self.to_clip_space(points_w, view_project_matrix)
+            if instances:
+                instance_h, instance_edges, instance_colors = self.project_instances(instances, view_project_matrix,
+                                                                                     canvas, camera)
+                edges = np.concatenate((edges, instance_edges + len(points_h)))
+                points_h = np.concatenate((points_h, instance_h))
+                edge_colors = np.concatenate((edge_colors, instance_colors))
+        profiler.count('vertices_projected', len(points_h))
+        profiler.count('lines_projected', len(edges))
+
+        # Clip every edge in homogeneous clip space, then divide and map only the survivors
+        with profiler.stage('clip'):
+            points0_h, points1_h, visible = self.clip_lines(points_h[edges[:, 0]], points_h[edges[:, 1]])
+            edge_colors = edge_colors[visible]
+            points0_can = self.norm_to_canvas_coords(canvas, self.perspective_divide(points0_h[visible]))
+            points1_can = self.norm_to_canvas_coords(canvas, self.perspective_divide(points1_h[visible]))
+        profiler.count('lines_clipped', len(edges) - len(points0_can))
+
+        with profiler.stage('rasterize'):
+            if self.rasterizer == 'array':
+                pixels = pygame.surfarray.pixels3d(canvas)
+                if self.tile_size:
+                    written = rasterizer.draw_lines_tiled(pixels, points0_can, points1_can, edge_colors,
+                                                          depth=self.depth_buffer, tile_size=self.tile_size,
+                                                          executor=self.executor, rect=rect)
+                else:
+                    written = rasterizer.draw_lines(pixels, points0_can, points1_can, edge_colors,
+                                                    depth=self.depth_buffer, rect=rect)
+                del pixels  # Unlocks the canvas
+                profiler.count('pixels_written', written)
+            else:
+                for idx in range(len(points0_can)):
+                    self.draw_line(canvas, points0_can[idx], points1_can[idx], tuple(edge_colors[idx]))
+
+
+    def draw_solid(self, canvas, items, view_matrix, camera=None, rect=None, instances=()):
+        """
+        Draws items and instances as filled triangles. Objects without triangles, like terrain chunks, are drawn as lines.
+        """
+        solid = [item for item in items if isinstance(item, Item)]
+        self.draw_triangles_batched(canvas, solid, view_matrix, self.project_matrix, camera, rect, instances)
+        self.draw_lines_batched(canvas, [item for item in items if not isinstance(item, Item)], view_matrix,
+                                self.project_matrix, camera, rect)
+
+
+    def gather_triangles(self, items, instances=()):
+        """
+        Collects the full detail triangles of items and (batch, indices) instances into shared arrays.
+        Returns the (V, 3) world vertices, (T, 3) triangle indices into them, (T, 3) unit world
+        normals and (T, 3) base colors.
+        """
+        vertices, triangles, normals, colors = [], [], [], []
+        offset = 0
+        for item in items:
+            vertices.append(item.world_vertices)
+            triangles.append(item.mesh.tri_indices + offset)
+            normals.append(item.get_world_normals())
+            colors.append(np.broadcast_to(np.asarray(item.color, dtype=float), (len(item.mesh.tri_indices), 3)))
+            offset += len(item.world_vertices)
+
+        for batch, indices in instances:
+            mesh = batch.mesh
+            matrices = batch.transform_matrices(indices)
+            linear = matrices[:, :3, :3]
+            vertices.append(np.matmul(np.asarray(mesh.vertices, dtype=float), linear.transpose(0, 2, 1)).reshape(-1, 3) +
+                            np.repeat(matrices[:, :3, 3], len(mesh.vertices), axis=0))
+            starts = offset + np.arange(len(indices)) * len(mesh.vertices)
+            triangles.append((mesh.tri_indices[np.newaxis] + starts[:, np.newaxis, np.newaxis]).reshape(-1, 3))
+            # Normals transform by the inverse transpose, as in Item.get_world_normals
+            instance_normals = np.matmul(np.asarray(mesh.normals, dtype=float), np.linalg.inv(linear)).reshape(-1, 3)
+            length = np.linalg.norm(instance_normals, axis=1, keepdims=True)
+            normals.append(instance_normals / np.where(length > 0, length, 1))
+            colors.append(np.repeat(batch.colors[indices].astype(float), len(mesh.tri_indices), axis=0))
+            offset += len(indices) * len(mesh.vertices)
+
+        if not triangles:
+            return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64), np.empty((0, 3)), np.empty((0, 3))
+        return np.concatenate(vertices), np.concatenate(triangles), np.concatenate(normals), np.concatenate(colors)
+
+
+    def draw_triangles_batched(self, canvas, items, view_matrix, project_matrix, camera=None, rect=None, instances=()):
+        """
+        Fills the triangles of the given items and instances with flat Lambert shading.
+        Triangles whose stored normal faces away from the camera are culled before anything is
+        projected, which removes about half of a closed mesh. The rest are projected as a whole
+        array, dropped if they are entirely outside the view volume, clipped against the near plane
+        and rasterized with edge functions against the depth buffer, so lines drawn in the same
+        frame are hidden correctly too.
+        """
+        if camera is None:
+            camera = self.camera
+        profiler = self.profiler
+
+        with profiler.stage('gather'):
+            vertices, triangles, normals, colors = self.gather_triangles(items, instances)
+        if len(triangles) == 0:
+            return
+
+        # A face is turned towards the camera when the camera is on the side its normal points to
+        with profiler.stage('backface'):
+            to_camera = np.asarray(camera.pos, dtype=float) - vertices[triangles[:, 0]]
+            facing = np.sum(normals * to_camera, axis=1) > 0
+            triangles, normals, colors = triangles[facing], normals[facing], colors[facing]
+        profiler.count('triangles_backfacing', len(facing) - len(triangles))
+
+        with profiler.stage('project'):
+            points_h = self.to_clip_space(vertices, view_matrix.dot(project_matrix))
+        profiler.count('vertices_projected', len(points_h))
+
+        # Same planes as clip_lines. Only the near plane needs real clipping: the rasterizer
+        # already stays on the canvas, and the far plane is left to the depth buffer
+        with profiler.stage('clip'):
+            outside = (self.clip_distances(points_h) < 0)[triangles]  # (T, 3, 6)
+            keep = ~np.any(np.all(outside, axis=1), axis=1)
+            triangles, normals, colors = triangles[keep], normals[keep], colors[keep]
+            points_h, triangles, source = self.clip_near(points_h, triangles)
+            normals, colors = normals[source], colors[source]
+            points_can = self.norm_to_canvas_coords(canvas, self.perspective_divide(points_h))
+        profiler.count('triangles_clipped', np.count_nonzero(~keep))
+
+        with profiler.stage('shade'):
+            intensity = self.ambient + (1 - self.ambient) * np.clip(normals.dot(self.light_direction), 0, 1)
+            colors = (colors * intensity[:, np.newaxis]).astype(np.uint8)
+
+        with profiler.stage('rasterize'):
+            pixels = pygame.surfarray.pixels3d(canvas)
+            written = rasterizer.draw_triangles(pixels, points_can[triangles[:, 0]], points_can[triangles[:, 1]],
+                                                points_can[triangles[:, 2]], colors, depth=self.depth_buffer, rect=rect)
+            del pixels  # Unlocks the canvas
+        profiler.count('triangles_drawn', len(triangles))
+        profiler.count('pixels_written', written)
+
+
+    def clip_near(self, points_h, triangles):
+        """
+        Clips triangles, given as (T, 3) indices into (N, 4) clip coordinates, against the near plane.
+        A triangle with one corner in front of it becomes a smaller triangle, and one with two
+        becomes a quad split into two triangles; the new corners are appended to the points.
+        Returns the points, the triangles in their original order and the index of the triangle each came from.
+        """
+        in_front = (self.clip_distances(points_h)[:, 4] >= 0)[triangles]  # (T, 3)
+        count = in_front.sum(axis=1)
+        whole = np.flatnonzero(count == 3)
+        new_points, new_triangles, source = [points_h], [triangles[whole]], [whole]
+        next_point = len(points_h)
+
+        for front in (1, 2):
+            idx = np.flatnonzero(count == front)
+            if len(idx) == 0:
+                continue
+            # Rotate each triangle, keeping its winding, so corner a is the one on its own side of the plane
+            alone = np.argmax(in_front[idx] if front == 1 else ~in_front[idx], axis=1)
+            corners = np.take_along_axis(triangles[idx], (alone[:, np.newaxis] + np.arange(3)) % 3, axis=1)
+            a, b, c = points_h[corners[:, 0]], points_h[corners[:, 1]], points_h[corners[:, 2]]
+            # Where the edges from a cross z = 0; a and the other corner are on opposite sides, so z differs
+            new_points.append(a + (a[:, 2] / (a[:, 2] - b[:, 2]))[:, np.newaxis] * (b - a))
+            new_points.append(a + (a[:, 2] / (a[:, 2] - c[:, 2]))[:, np.newaxis] * (c - a))
+            ab = next_point + np.arange(len(idx))
+            ac = ab + len(idx)
+            next_point += 2 * len(idx)
+
+            if front == 1:
+                new_triangles.append(np.stack((corners[:, 0], ab, ac), axis=1))
+                source.append(idx)
+            else:
+                new_triangles += [np.stack((ab, corners[:, 1], corners[:, 2]), axis=1),
+                                  np.stack((ab, corners[:, 2], ac), axis=1)]
+                source += [idx, idx]
+
+        # Triangles that tie in depth are resolved by drawing order, so keep it
+        source = np.concatenate(source)
+        order = np.argsort(source, kind='stable')
+        return np.concatenate(new_points), np.concatenate(new_triangles)[order].astype(triangles.dtype), source[order]
+
+
+    def to_clip_space(self, points_w, view_project_matrix):
+        """
+        Transforms an (N, 3) or (N, 4) array of points from world coordinates to homogeneous clip
+        coordinates, before the perspective divide.
+        """
+        points_w = np.asarray(points_w, dtype=float)
+        if points_w.shape[1] == 3:
+            # Same as appending w = 1, without copying the points
+            return points_w.dot(view_project_matrix[:3]) + view_project_matrix[3]
+        return points_w.dot(view_project_matrix)
+
+
+    def perspective_divide(self, points_h):
+        """
+        Divides an (N, 4) array of clip coordinates by w, leaving points with w == 0 untouched like project_point does.
+        """
+        w = points_h[:, 3:4]
+        return np.divide(points_h, w, out=points_h.copy(), where=(w != 0))
+
+
+    def project_points(self, points_w, view_project_matrix):
+        """
+        Projects an (N, 3) or (N, 4) array of points from world coordinates to projected coordinates.
+        Batched equivalent of project_point.
+        """
+        return self.perspective_divide(self.to_clip_space(points_w, view_project_matrix))
+
+
     def project_point(self, point_w, view_matrix, project_matrix, canvas):
         """
         Projects a point from world coordinates to projected coordinates.
@@ -89,61 +847,58 @@ class Renderer:
         Clips a point to the inside of the projection box.
         """
 
-        if -1 < point_p[0] < 1 and -1 < point_p[1] < 1 and -1 < point_p[2] < 1:
+        if -VIEW_EXTENT < point_p[0] < VIEW_EXTENT and -VIEW_EXTENT < point_p[1] < VIEW_EXTENT and 0 < point_p[2] < 1:
             return point_p
         else:
             return None
 
 
-    def clip_line(self, point0_p, point1_p):
+    def clip_distances(self, points_h):
         """
-        Clips a line to the inside of the projection box.
-        Note: Intersections are incomplete, resulting in lines with one or both
-        points off the canvas being displayed wrong. (Especially if one is
-        behind the camera)
+        Returns the (N, 6) signed distances of (N, 4) clip coordinates to the planes of the view volume,
+        in the order of frustum_planes. Inside is >= 0.
+        The canvas shows -VIEW_EXTENT <= x, y <= VIEW_EXTENT after the divide and the projection maps depth
+        to [0, 1], so the volume is -VIEW_EXTENT*w <= x, y <= VIEW_EXTENT*w and 0 <= z <= w, the box
+        clip_point tests after the divide, and z >= 0 is the near plane.
         """
+        signs = np.array([1, -1, 1, -1, 1, -1])
+        axes = np.array([0, 0, 1, 1, 2, 2])
+        w_weights = np.array([VIEW_EXTENT] * 4 + [0, 1])
+        return points_h[:, 3:4] * w_weights + signs * points_h[:, axes]
 
-        point0_clip = self.clip_point(point0_p)
-        point1_clip = self.clip_point(point1_p)
 
-        # If both points are inside
-        if (point0_clip is not None) and (point1_clip is not None):
-            return point0_p, point1_p
-
-        # If line is vertical
-        if point0_p[0] == point1_p[0]:
-            if -1 < point0_p[0] < 1:
-                if point0_clip is None:
-                    point0_p[1] = sign(point0_p[1])
-                if point1_clip is None:
-                    point1_p[1] = sign(point1_p[1])
-                return point0_p, point1_p
-
-        # If line is Horizontal
-        if point0_p[1] == point1_p[1]:
-            if -1 < point0_p[1] < 1:
-                if point0_clip is None:
-                    point0_p[0] = sign(point0_p[0])
-                if point1_clip is None:
-                    point1_p[0] = sign(point1_p[0])
-                return point0_p, point1_p
+    def clip_lines(self, points0_h, points1_h):
+        """
+        Clips lines to the view volume in homogeneous clip space, before the perspective divide.
+        points0_h and points1_h are (N, 4) arrays of clip coordinates. Clipping against the near
+        plane also removes everything behind the camera.
+        Returns the clipped endpoints and a mask of the lines that are at least partly visible.
+        """
+        # Signed distances of both endpoints to each of the six planes, (N, 6). Inside is >= 0
+        dist0 = self.clip_distances(points0_h)
+        dist1 = self.clip_distances(points1_h)
 
-        # Make point 0 leftmost
-        if point0_p[0] > point1_p[0]:
-            point_hold = point0_p
-            point0_p = point1_p
-            point1_p = point_hold
+        out0 = dist0 < 0
+        out1 = dist1 < 0
+        visible = ~np.any(out0 & out1, axis=1)  # Trivially reject lines with both ends outside one plane
+        crossing = visible & np.any(out0 | out1, axis=1)  # Trivially accepted lines need no work
 
-        # Find intercept
-        slope = (point1_p[1] - point0_p[1]) / (point1_p[0] - point0_p[0])
-        offset = point0_p[1] - slope*point0_p[0]
-        line = lambda x: slope*x + offset
+        clipped0 = points0_h.copy()
+        clipped1 = points1_h.copy()
+        if np.any(crossing):
+            d0, d1 = dist0[crossing], dist1[crossing]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = d0 / (d0 - d1)  # Where the line meets each plane
+            # Move each endpoint in to the furthest plane it is outside of
+            t0 = np.max(np.where(d0 < 0, t, 0), axis=1)
+            t1 = np.min(np.where(d1 < 0, t, 1), axis=1)
 
-        # Todo: Fix Z
-        if self.clip_point((-1, line(-1), 0),) is not None:
-            point0_p = (-1, line(-1), point0_p[2])
+            start, end = points0_h[crossing], points1_h[crossing]
+            clipped0[crossing] = start + t0[:, np.newaxis] * (end - start)
+            clipped1[crossing] = start + t1[:, np.newaxis] * (end - start)
+            visible[np.flatnonzero(crossing)[t0 > t1]] = False  # Passes outside a corner of the volume
 
-        return point0_p, point1_p
+        return clipped0, clipped1, visible
 
 
     def project_line(self, canvas, point0_w, point1_w, view_matrix, project_matrix, color):
@@ -160,13 +915,15 @@ class Renderer:
             print("Bad points given ({}, {})".format(point0_w, point1_w))
             return
 
-        point0_p = self.project_point(point0_w, view_matrix, project_matrix, canvas)
-        point1_p = self.project_point(point1_w, view_matrix, project_matrix, canvas)
-
-        point0_clip, point1_clip = self.clip_line(point0_p, point1_p)
+        # Clip in homogeneous coordinates, before the perspective divide
+        point0_h = np.dot(np.dot(point0_w, view_matrix), project_matrix)
+        point1_h = np.dot(np.dot(point1_w, view_matrix), project_matrix)
+        point0_clip, point1_clip, visible = self.clip_lines(point0_h[np.newaxis], point1_h[np.newaxis])
+        if not visible[0]:
+            return
 
-        point0_can = self.norm_to_canvas_coord(canvas, point0_clip)
-        point1_can = self.norm_to_canvas_coord(canvas, point1_clip)
+        point0_can = self.norm_to_canvas_coord(canvas, self.perspective_divide(point0_clip)[0])
+        point1_can = self.norm_to_canvas_coord(canvas, self.perspective_divide(point1_clip)[0])
 
         self.draw_line(canvas, point0_can, point1_can, color)
 
@@ -175,6 +932,19 @@ class Renderer:
         return((point_p[0] * canvas.get_width()) + canvas.get_width()/2, (point_p[1] * canvas.get_height()) + canvas.get_height()/2, point_p[2])
 
 
+    def norm_to_canvas_coords(self, canvas, points_p):
+        """
+        Converts an array of projected points (last axis x, y, z, ...) to canvas coordinates.
+        Batched equivalent of norm_to_canvas_coord.
+        """
+        width, height = canvas.get_width(), canvas.get_height()
+        points_can = np.empty(points_p.shape[:-1] + (3,))
+        points_can[..., 0] = points_p[..., 0] * width + width/2
+        points_can[..., 1] = points_p[..., 1] * height + height/2
+        points_can[..., 2] = points_p[..., 2]
+        return points_can
+
+
     def draw_point(self, canvas, point_p, color):
         """
         Draw a point given projected coordinates.
@@ -182,17 +952,26 @@ class Renderer:
 
         if self.clip_point(point_p) is not None:
             point_can = self.norm_to_canvas_coord(canvas, point_p)
-            canvas.set_at((int(point_can[0]), canvas.get_height() - int(point_can[1])), color)
+            self.draw_point_canvas(canvas, point_can, color)
 
 
     def draw_point_canvas(self, canvas, point_can, color, size=1):
         """
-        Draw a point given canvas coordinates.
+        Draw a point given canvas coordinates. The point is only drawn on pixels where it is nearer
+        than the depth buffer.
         """
 
+        if self.depth_buffer is None:
+            self.clear_depth(canvas)
+
+        width, height = canvas.get_width(), canvas.get_height()
         for i in range(size):
             for j in range(size):
-                canvas.set_at((int(point_can[0]) + i, canvas.get_height() - int(point_can[1]) + j), color)
+                x = int(point_can[0]) + i
+                row = height - int(point_can[1]) + j
+                if 0 <= x < width and 0 <= row < height and point_can[2] < self.depth_buffer[x, row]:
+                    self.depth_buffer[x, row] = point_can[2]
+                    canvas.set_at((x, row), color)
 
 
     def draw_line(self, canvas, point0_can, point1_can, color):
@@ -210,7 +989,7 @@ class Renderer:
         # Single Point
         if int(point0_can[0]) == int(point1_can[0]) and int(point0_can[1]) == int(point1_can[1]):
             # print("Single point at {} {} {}".format(x, y, z))
-            self.draw_point_canvas(canvas, (int(x), int(y), int(z)), color)
+            self.draw_point_canvas(canvas, (int(x), int(y), z), color)
             return
 
         # Vertical line
@@ -220,7 +999,7 @@ class Renderer:
 
             for y in range(int(point0_can[1]), int(point1_can[1])):
                 if z > .01:
-                    self.draw_point_canvas(canvas, (int(x), int(y), int(z)), color)
+                    self.draw_point_canvas(canvas, (int(x), int(y), z), color)
                 z += dz
             return
 
@@ -231,7 +1010,7 @@ class Renderer:
 
             for x in range(int(point0_can[0]), int(point1_can[0])):
                 if z > .01:
-                    self.draw_point_canvas(canvas, (int(x), int(y), int(z)), color)
+                    self.draw_point_canvas(canvas, (int(x), int(y), z), color)
                 z += dz
             return
 
@@ -244,7 +1023,7 @@ class Renderer:
             dz = (point1_can[2] - point0_can[2]) / (point1_can[0] - point0_can[0])
 
             for x in range(int(point0_can[0]), int(point1_can[0])):
-                self.draw_point_canvas(canvas, (int(x), int(y), int(z)), color)
+                self.draw_point_canvas(canvas, (int(x), int(y), z), color)
 
                 y += dy
                 z += dz
@@ -255,7 +1034,7 @@ class Renderer:
             dz = (point1_can[2] - point0_can[2]) / (point1_can[1] - point0_can[1])
 
             for y in range(int(point0_can[1]), int(point1_can[1])):
-                self.draw_point_canvas(canvas, (int(x), int(y), int(z)), color)
+                self.draw_point_canvas(canvas, (int(x), int(y), z), color)
                 x += dx
                 z += dz
 
@@ -265,46 +1044,14 @@ class Renderer:
         Returns a perspective projection matrix from the given parameters.
         This is a rectangular frustum, which remaps world coordinates into a cube between -1 and 1
         """
-        # Scale of x axis
-        a = aspect * (1 / tan(fov * .5))
-
-        # Scale of y axis
-        b = 1 / tan(fov * .5)
+        return transforms.persp_proj_matrix(fov, aspect, znear, zfar)
 
-        # Remaps z to [0,1], for z-index
-        c = zfar / (zfar - znear)
 
-        # Sets w to z
-        d = 1
-
-        # Moves z up to fit in znear
-        e = -(znear * zfar) / (zfar - znear)
-
-        return np.array([[a, 0, 0, 0],
-                         [0, b, 0, 0],
-                         [0, 0, c, d],
-                         [0, 0, e, 0]])
-
-
-    def view_matrix(self):
+    def view_matrix(self, camera=None):
         """
-        Returns a view matrix.
+        Returns a view matrix for camera (a Camera or CameraState), by default the renderer's camera.
         Transforms view coordinates to make the camera located at (0,0,0) and pointed in the positive z direction.
         """
-        sinYaw = sin(self.camera.angle[0])
-        cosYaw = cos(self.camera.angle[0])
-        sinPitch = sin(self.camera.angle[1])
-        cosPitch = cos(self.camera.angle[1])
-
-        # The axis vectors to point in the direction of the camera
-        xaxis = (cosYaw, 0, -sinYaw)
-        yaxis = (sinYaw * sinPitch, cosPitch, cosYaw * sinPitch)
-        zaxis = (sinYaw * cosPitch, -sinPitch, cosPitch * cosYaw)
-
-        # First 3 rows do rotation, the 4th row (which gets multiplied by 1) does translation
-        arr =  np.array([[xaxis[0],                     yaxis[0],                   zaxis[0],                0],
-                         [xaxis[1],                     yaxis[1],                   zaxis[1],                0],
-                         [xaxis[2],                     yaxis[2],                   zaxis[2],                0],
-                         [-np.dot(xaxis, self.camera.pos),   -np.dot(yaxis, self.camera.pos), -np.dot(zaxis, self.camera.pos), 1]])
-
-        return arr
+        if camera is None:
+            camera = self.camera
+        return transforms.view_matrix(camera.pos, camera.angle)
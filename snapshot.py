@@ -0,0 +1,151 @@
+"""
+Compact binary snapshots of the objects in a world, so a large scene can be restored without
+rebuilding it from its STL files. A snapshot is a fixed-size header, a table of the model file
+names and one contiguous array per object attribute, each starting on a 16 byte boundary so they
+can be memory-mapped straight into NumPy:
+
+    header          HEADER_DTYPE
+    model table     the model file names, utf-8, separated by NUL bytes
+    position        float64 (N, 3)  world coordinates
+    orientation     float64 (N, 3)  rotations about the x, y and z axes in degrees
+    scale           float64 (N,)    uniform scale factors
+    model           uint16  (N,)    index of each object's model in the table
+    color           uint8   (N, 3)  RGB colors
+    kind            uint8   (N,)    KIND_ITEM or KIND_INSTANCE
+
+Model file names are stored as they were given to the Item or InstanceBatch, so relative names
+are resolved against the working directory when the snapshot is loaded, as they were when saved.
+
+Run as a script to write a snapshot of a seeded scene without building it:
+    python3 snapshot.py scene.snap --cubes 5000 --teapots 5000
+"""
+import os
+import sys
+import argparse
+import numpy as np
+
+MAGIC = b'IPSCENE1'
+VERSION = 2
+ALIGN = 16
+
+KIND_ITEM = 0  # Restored as an Item, built when it first comes into view
+KIND_INSTANCE = 1  # Restored into the InstanceBatch of its model
+
+HEADER_DTYPE = np.dtype([('magic', 'S8'),
+                         ('version', '<u4'),
+                         ('n_models', '<u4'),
+                         ('n_objects', '<u8'),
+                         ('model_table_bytes', '<u8')])
+
+# Name, dtype and row width (None for one value per object) of each array, in file order
+SECTIONS = (('position', '<f8', 3),
+            ('orientation', '<f8', 3),
+            ('scale', '<f8', None),
+            ('model', '<u2', None),
+            ('color', 'u1', 3),
+            ('kind', 'u1', None))
+
+
+def section_offsets(header):
+    """
+    Returns a list of (name, dtype, shape, offset) for every array described by a header.
+    """
+    offsets = []
+    offset = HEADER_DTYPE.itemsize + int(header['model_table_bytes'])
+    count = int(header['n_objects'])
+    for name, dtype, width in SECTIONS:
+        offset = -(-offset // ALIGN) * ALIGN
+        shape = (count,) if width is None else (count, width)
+        offsets.append((name, np.dtype(dtype), shape, offset))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return offsets
+
+
+def read_snapshot(file_name):
+    """
+    Memory-maps a snapshot. Returns a dict of its arrays, plus 'models', the list of model file names.
+    Raises ValueError if the file is not a snapshot this version can read.
+    """
+    header = np.fromfile(file_name, dtype=HEADER_DTYPE, count=1)
+    if len(header) != 1 or header['magic'][0] != MAGIC or header['version'][0] != VERSION:
+        raise ValueError("{} is not a version {} scene snapshot".format(file_name, VERSION))
+    header = header[0]
+
+    with open(file_name, 'rb') as f:
+        f.seek(HEADER_DTYPE.itemsize)
+        table = f.read(int(header['model_table_bytes']))
+    snapshot = {'models': table.decode('utf-8').split('\0') if header['n_models'] else []}
+    for name, dtype, shape, offset in section_offsets(header):
+        if shape[0] == 0:  # np.memmap refuses empty maps
+            snapshot[name] = np.empty(shape, dtype=dtype)
+        else:
+            snapshot[name] = np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=shape)
+    return snapshot
+
+
+def write_snapshot(file_name, models, model, position, orientation, scale, color, kind):
+    """
+    Writes a snapshot of len(model) objects, where model holds indices into the list of model file names.
+    The file is written under a temporary name and moved into place, so readers never see a partial snapshot.
+    """
+    table = '\0'.join(models).encode('utf-8')
+    arrays = {'position': position, 'orientation': orientation, 'scale': scale, 'model': model,
+              'color': color, 'kind': kind}
+
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['n_models'] = len(models)
+    header['n_objects'] = len(model)
+    header['model_table_bytes'] = len(table)
+
+    tmp_path = '{}.{}.tmp'.format(file_name, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(header.tobytes())
+            f.write(table)
+            for name, dtype, shape, offset in section_offsets(header[0]):
+                f.write(b'\x00' * (offset - f.tell()))
+                f.write(np.ascontiguousarray(arrays[name], dtype=dtype).reshape(shape).tobytes())
+        os.replace(tmp_path, file_name)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_specs(file_name, specs, kind=KIND_ITEM):
+    """
+    Writes a snapshot of a list of (file_name, world_coords, orientation, scale, color) tuples,
+    as returned by World.scene_specs, without building any of them.
+    """
+    models = sorted(set(spec[0] for spec in specs))
+    index = {name: idx for idx, name in enumerate(models)}
+    write_snapshot(file_name, models,
+                   np.array([index[spec[0]] for spec in specs], dtype=np.uint16),
+                   np.array([spec[1] for spec in specs], dtype=float).reshape(-1, 3),
+                   np.array([spec[2] for spec in specs], dtype=float).reshape(-1, 3),
+                   np.array([spec[3] for spec in specs], dtype=float),
+                   np.array([spec[4] for spec in specs], dtype=np.uint8).reshape(-1, 3),
+                   np.full(len(specs), kind, dtype=np.uint8))
+
+
+def main(argv=None):
+    from world import World
+
+    parser = argparse.ArgumentParser(description='Write a snapshot of a seeded scene, as World.gen_scene would place it.')
+    parser.add_argument('output', help='snapshot file to write')
+    parser.add_argument('--cubes', type=int, default=0)
+    parser.add_argument('--teapots', type=int, default=0)
+    parser.add_argument('--cylinders', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--instanced', action='store_true', help='restore the objects as instance batches instead of items')
+    args = parser.parse_args(argv)
+
+    specs = World.scene_specs({'cube.stl': args.cubes, 'teapot.stl': args.teapots, 'Cylinder.stl': args.cylinders},
+                              args.seed)
+    write_specs(args.output, specs, KIND_INSTANCE if args.instanced else KIND_ITEM)
+    print("Wrote {} objects to {}".format(len(specs), args.output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,285 @@
+"""
+Streaming STL reader for meshes too big to parse in one go. Binary and ASCII files are read a
+block of triangles at a time into buffers that are reused for every block, and vertices are
+welded as the blocks arrive, straight into the output arrays. The only memory that grows with the
+file is the welded geometry itself (plus a sorted index of the vertices seen so far), instead of
+the several full-size copies made by parsing the whole file and welding afterwards.
+
+    reader = StlReader('scan.stl')
+    for start, triangles, normals in reader.blocks():   # raw triangles, while the file loads
+        ...
+    vertices, tri_indices, normals = StlReader('scan.stl').read()
+
+Run as a script to time reading a file and report its peak memory use:
+    python3 stlreader.py scan.stl
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+BLOCK_TRIANGLES = 2**16  # Triangles read per block
+ASCII_READ_BYTES = 2**20  # Text read per step of an ASCII file
+HEADER_BYTES = 80
+
+# One triangle of a binary STL
+RECORD_DTYPE = np.dtype([('normal', '<f4', (3,)), ('vectors', '<f4', (3, 3)), ('attributes', '<u2')])
+
+KEY_MIX = np.uint64(0x9E3779B97F4A7C15)  # Odd constant spreading the z bits over a vertex key
+
+# Words of an ASCII STL between the numbers, longest first so endloop goes before loop
+ASCII_KEYWORDS = (b'endfacet', b'endloop', b'facet', b'normal', b'outer', b'loop', b'vertex')
+
+
+def is_binary(file_name):
+    """
+    Returns whether an STL file is binary. Binary files can start with 'solid' too, so a file
+    only counts as ASCII if it does and its size doesn't match the triangle count of a binary header.
+    """
+    size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as f:
+        header = f.read(HEADER_BYTES + 4)
+    if not header.lstrip().startswith(b'solid') or len(header) < HEADER_BYTES + 4:
+        return True
+    count = int(np.frombuffer(header, dtype='<u4', count=1, offset=HEADER_BYTES)[0])
+    return size == HEADER_BYTES + 4 + count * RECORD_DTYPE.itemsize
+
+
+def vertex_keys(points):
+    """
+    Packs the 96 bits of each of an (N, 3) float32 array of points into a uint64 key that sorts fast.
+    Equal points get equal keys; different points almost never do, and callers check.
+    """
+    bits = points.view(np.uint32).astype(np.uint64)
+    return ((bits[:, 0] << np.uint64(32)) | bits[:, 1]) ^ (bits[:, 2] * KEY_MIX)
+
+
+class StlReader:
+    """
+    Reads the triangles of one STL file in blocks of block_size.
+    The number of triangles is known up front (an ASCII file is counted in a quick first pass),
+    so read can allocate its outputs at their final size.
+    """
+
+    def __init__(self, file_name, block_size=BLOCK_TRIANGLES):
+        self.file_name = file_name
+        self.block_size = block_size
+        self.binary = is_binary(file_name)
+        self.triangle_count = self.count_binary() if self.binary else self.count_ascii()
+
+        # Reused for every block; blocks() hands out views of them
+        self.block_triangles = np.empty((block_size, 3, 3), dtype=np.float32)
+        self.block_normals = np.empty((block_size, 3), dtype=np.float32)
+
+    def count_binary(self):
+        """
+        Returns the triangle count of a binary file, limited to the triangles actually in a truncated one.
+        """
+        with open(self.file_name, 'rb') as f:
+            f.seek(HEADER_BYTES)
+            count = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        stored = (os.path.getsize(self.file_name) - HEADER_BYTES - 4) // RECORD_DTYPE.itemsize
+        return min(count, stored)
+
+    def count_ascii(self):
+        """
+        Returns the number of facets in an ASCII file.
+        """
+        count = 0
+        tail = b''
+        with open(self.file_name, 'rb') as f:
+            while True:
+                data = f.read(ASCII_READ_BYTES)
+                if not data:
+                    return count
+                data = tail + data.lower()
+                count += data.count(b'endfacet')
+                # Keep the end of the data, in case a keyword is split between two reads,
+                # but not a whole one, or it would be counted twice
+                tail = data[-(len(b'endfacet') - 1):]
+
+    def blocks(self):
+        """
+        Yields (start, triangles, normals) for consecutive blocks of the file, where triangles is a
+        (n, 3, 3) and normals a (n, 3) float32 array and start the index of the block's first triangle.
+        The arrays are reused for the next block, so copy anything that has to outlive it.
+        """
+        if self.binary:
+            return self.binary_blocks()
+        return self.ascii_blocks()
+
+    def binary_blocks(self):
+        records = np.empty(self.block_size, dtype=RECORD_DTYPE)
+        raw = records.view(np.uint8)
+        with open(self.file_name, 'rb') as f:
+            f.seek(HEADER_BYTES + 4)
+            for start in range(0, self.triangle_count, self.block_size):
+                n = min(self.block_size, self.triangle_count - start)
+                if f.readinto(raw[:n * RECORD_DTYPE.itemsize]) != n * RECORD_DTYPE.itemsize:
+                    raise ValueError("{} ends in the middle of a triangle".format(self.file_name))
+                np.copyto(self.block_triangles[:n], records['vectors'][:n])
+                yield start, self.block_triangles[:n], self.update_normals(n)
+
+    def ascii_blocks(self):
+        filled = 0  # Triangles in the current block
+        start = 0
+        for values in self.ascii_values():
+            # Every facet is a normal followed by three vertices
+            facets = values.reshape(-1, 4, 3)
+            while len(facets):
+                n = min(len(facets), self.block_size - filled)
+                self.block_triangles[filled:filled + n] = facets[:n, 1:]
+                filled += n
+                facets = facets[n:]
+                if filled == self.block_size:
+                    yield start, self.block_triangles, self.update_normals(filled)
+                    start += filled
+                    filled = 0
+        if filled:
+            yield start, self.block_triangles[:filled], self.update_normals(filled)
+
+    def update_normals(self, n):
+        """
+        Computes the normals of the first n triangles of the block from their winding, like numpy-stl does,
+        since plenty of exporters leave the stored ones zero. They are not normalized.
+        """
+        triangles = self.block_triangles[:n]
+        self.block_normals[:n] = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        return self.block_normals[:n]
+
+    def ascii_values(self):
+        """
+        Yields float32 arrays of the numbers in successive runs of whole facets of an ASCII file.
+        """
+        rest = b''
+        first = True
+        with open(self.file_name, 'rb') as f:
+            while True:
+                data = f.read(ASCII_READ_BYTES)
+                text = rest + data.lower()
+                if first:
+                    text = text[text.find(b'\n') + 1:]  # Skip the solid line, whose name could hold anything
+                    first = False
+                end = text.rfind(b'endfacet')
+                if end < 0:
+                    if not data:
+                        return
+                    rest = text
+                    continue
+                end += len(b'endfacet')
+                text, rest = text[:end], text[end:]
+                for keyword in ASCII_KEYWORDS:
+                    text = text.replace(keyword, b' ')
+                values = np.fromstring(text, dtype=np.float32, sep=' ')
+                if len(values) % 12:
+                    raise ValueError("{} has a malformed facet".format(self.file_name))
+                yield values
+
+    def welded_blocks(self):
+        """
+        Like blocks, but welds each block into the vertices read so far. Yields (start, tri_indices)
+        for every block, where tri_indices is a (n, 3) int32 array of indices into self.vertices,
+        which then holds every vertex up to self.vertex_count.
+        Fills self.tri_indices and self.normals for the whole file as it goes, and trims
+        self.vertices to the welded vertices once the last block is done.
+        """
+        self.vertices = np.empty((max(16, self.triangle_count // 2), 3), dtype=np.float32)
+        self.vertex_count = 0
+        self.tri_indices = np.empty((self.triangle_count, 3), dtype=np.int32)
+        self.normals = np.empty((self.triangle_count, 3), dtype=np.float32)
+        # The keys of the vertices welded so far, sorted, and the index of each in vertices
+        self.sorted_keys = np.empty(0, dtype=np.uint64)
+        self.sorted_ids = np.empty(0, dtype=np.int32)
+
+        for start, triangles, normals in self.blocks():
+            end = start + len(triangles)
+            self.normals[start:end] = normals
+            self.tri_indices[start:end] = self.weld(triangles)
+            yield start, self.tri_indices[start:end]
+
+        self.sorted_keys = self.sorted_ids = None
+        if self.vertex_count < len(self.vertices):
+            # Shrinks in place rather than copying, so the vertices are never held twice
+            self.vertices.resize((self.vertex_count, 3), refcheck=False)
+
+    def weld(self, triangles):
+        """
+        Merges the corners of a (n, 3, 3) block with the vertices seen so far, appending new ones.
+        Returns the (n, 3) indices of the corners.
+        Two different vertices with the same key are told apart by their coordinates and left unwelded,
+        so every index always points at exactly its corner's position.
+        """
+        points = triangles.reshape(-1, 3) + np.float32(0)  # Adding 0 turns -0.0 into 0.0, so they weld
+        block_keys, first, inverse = np.unique(vertex_keys(points), return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+
+        # Look the block's unique vertices up among the ones already seen
+        pos = np.searchsorted(self.sorted_keys, block_keys)
+        found = pos < len(self.sorted_keys)
+        found[found] = self.sorted_keys[pos[found]] == block_keys[found]
+        ids = np.empty(len(block_keys), dtype=np.int32)
+        ids[found] = self.sorted_ids[pos[found]]
+        matches = (self.vertices[ids[found]] == points[first[found]]).all(axis=1)
+        found[np.flatnonzero(found)[~matches]] = False
+
+        # New vertices are numbered in the order they appear in the file
+        new = np.flatnonzero(~found)
+        new = new[np.argsort(first[new])]
+        ids[new] = self.append_vertices(points[first[new]])
+
+        inserted = np.sort(new)  # Inserting in sorted order keeps the keys sorted
+        self.sorted_keys = np.insert(self.sorted_keys, pos[inserted], block_keys[inserted])
+        self.sorted_ids = np.insert(self.sorted_ids, pos[inserted], ids[inserted])
+
+        corners = ids[inverse]
+        # Corners that share a key with a different corner of the block get vertices of their own
+        clashes = np.flatnonzero((self.vertices[corners] != points).any(axis=1))
+        if len(clashes):
+            corners[clashes] = self.append_vertices(points[clashes])
+        return corners.reshape(-1, 3)
+
+    def append_vertices(self, points):
+        """
+        Appends points to the welded vertices, growing the array if needed. Returns their indices.
+        """
+        count = self.vertex_count + len(points)
+        if count > len(self.vertices):
+            # Nothing else holds a view of the vertices while welding, so they can be reallocated in place
+            self.vertices.resize((max(count, len(self.vertices) * 3 // 2), 3), refcheck=False)
+        self.vertices[self.vertex_count:count] = points
+        ids = np.arange(self.vertex_count, count, dtype=np.int32)
+        self.vertex_count = count
+        return ids
+
+    def read(self):
+        """
+        Reads and welds the whole file. Returns the (V, 3) float32 unique vertices, the (T, 3) int32
+        indices of each triangle's corners and the (T, 3) float32 normals.
+        """
+        for block in self.welded_blocks():
+            pass
+        return self.vertices, self.tri_indices, self.normals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Read an STL file in blocks and report the time and peak memory it took.')
+    parser.add_argument('file', help='STL file to read')
+    parser.add_argument('--block-size', type=int, default=BLOCK_TRIANGLES, help='triangles per block')
+    args = parser.parse_args(argv)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    reader = StlReader(args.file, args.block_size)
+    vertices, tri_indices, normals = reader.read()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    geometry = vertices.nbytes + tri_indices.nbytes + normals.nbytes
+    print("{}: {} {} triangles, {} vertices in {:.3f} s".format(args.file, 'binary' if reader.binary else 'ASCII',
+                                                              len(tri_indices), len(vertices), elapsed))
+    print("geometry {:.1f} MB, peak {:.1f} MB".format(geometry / 2**20, peak / 2**20))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
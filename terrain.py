@@ -0,0 +1,334 @@
+"""
+Procedurally generated terrain. The ground is split into square heightfield chunks on a grid,
+generated from seeded fractal value noise only when the camera comes near them. Chunks are built
+on a background worker, nearest first and ahead of the direction the camera is moving in, kept
+in a size-bounded least recently used cache and dropped once the camera is far away.
+
+Heights only depend on world coordinates and the seed, so the edges of neighbouring chunks
+line up exactly and a chunk that was evicted comes back identical.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from math import floor
+import numpy as np
+
+
+def lattice_values(ix, iz, seed):
+    """
+    Returns a pseudo random value in [-1, 1] for every integer lattice point (ix, iz), the same every time for a seed.
+    """
+    h = (ix.astype(np.int64) * 374761393 + iz.astype(np.int64) * 668265263 + seed * 1442695041) & 0xffffffff
+    h = ((h ^ (h >> 13)) * 1274126177) & 0xffffffff
+    h ^= h >> 16
+    return h * (2 / 0xffffffff) - 1
+
+
+def value_noise(x, z, seed):
+    """
+    Smoothly interpolates lattice_values between the integer points around each (x, z).
+    """
+    ix, iz = np.floor(x), np.floor(z)
+    tx, tz = x - ix, z - iz
+    tx, tz = tx * tx * (3 - 2 * tx), tz * tz * (3 - 2 * tz)  # Smoothstep, so there are no creases at the lattice
+    ix, iz = ix.astype(np.int64), iz.astype(np.int64)
+
+    top = lattice_values(ix, iz, seed) * (1 - tx) + lattice_values(ix + 1, iz, seed) * tx
+    bottom = lattice_values(ix, iz + 1, seed) * (1 - tx) + lattice_values(ix + 1, iz + 1, seed) * tx
+    return top * (1 - tz) + bottom * tz
+
+
+def fractal_noise(x, z, seed=0, octaves=4, scale=100.0, persistence=.5):
+    """
+    Sums octaves of value_noise at doubling frequencies and shrinking amplitudes.
+    x and z are arrays of world coordinates, and scale is the size of the largest features in world units.
+    Returns values in [-1, 1] with the shape of x.
+    """
+    x = np.asarray(x, dtype=float) / scale
+    z = np.asarray(z, dtype=float) / scale
+    total = np.zeros(np.broadcast(x, z).shape)
+    amplitude, weight = 1.0, 0.0
+    for octave in range(octaves):
+        frequency = 2 ** octave
+        total += amplitude * value_noise(x * frequency, z * frequency, seed + octave)
+        weight += amplitude
+        amplitude *= persistence
+    return total / weight
+
+
+@lru_cache(maxsize=None)
+def grid_edges(cells):
+    """
+    Returns the (E, 2) edges of a grid of cells x cells squares, whose (cells + 1)**2 vertices are numbered row by row.
+    The array is shared by every chunk of the same size, so it is read only.
+    """
+    idx = np.arange((cells + 1) ** 2, dtype=np.int32).reshape(cells + 1, cells + 1)
+    along_x = np.stack((idx[:, :-1].ravel(), idx[:, 1:].ravel()), axis=1)
+    along_z = np.stack((idx[:-1].ravel(), idx[1:].ravel()), axis=1)
+    edges = np.concatenate((along_x, along_z))
+    edges.setflags(write=False)
+    return edges
+
+
+def upsample_error(heights, stride):
+    """
+    Returns how far the heights are, at most, from the surface bilinearly interpolated between every stride-th sample.
+    """
+    idx = np.arange(len(heights))
+    low = np.minimum(idx // stride * stride, len(heights) - 1 - stride)
+    t = (idx - low) / stride
+    coarse = heights[low][:, low] * (1 - t)[np.newaxis] + heights[low][:, low + stride] * t[np.newaxis]
+    coarse_next = heights[low + stride][:, low] * (1 - t)[np.newaxis] + heights[low + stride][:, low + stride] * t[np.newaxis]
+    surface = coarse * (1 - t)[:, np.newaxis] + coarse_next * t[:, np.newaxis]
+    return float(np.max(np.abs(surface - heights)))
+
+
+class TerrainChunk:
+    """
+    One square of terrain, drawn by the renderer like an Item: a grid of vertices joined by edges,
+    with bounding volumes for culling and coarser grids (every 2nd, 4th, ... sample) as its levels of detail.
+    """
+
+    def __init__(self, coord, heights, cell_size, color):
+        self.coord = coord  # (i, j) position of the chunk on the chunk grid
+        self.heights = heights
+        self.cell_size = cell_size
+        self.color = color
+        self.version = 0  # Chunks never move
+        self.lod_level = 0
+
+        cells = len(heights) - 1
+        x = (coord[0] * cells + np.arange(cells + 1)) * cell_size
+        z = (coord[1] * cells + np.arange(cells + 1)) * cell_size
+        self.world_vertices = np.stack((np.repeat(x, cells + 1), heights.ravel(), np.tile(z, cells + 1)),
+                                       axis=1).astype(np.float32)
+        self.edges = grid_edges(cells)
+
+        # Every level halves the number of samples along each side, down to a single cell
+        self.lods = [(self.world_vertices, self.edges, 0.0)]
+        stride = 2
+        while stride <= cells and cells % stride == 0:
+            vertices = self.world_vertices.reshape(cells + 1, cells + 1, 3)[::stride, ::stride].reshape(-1, 3)
+            self.lods.append((np.ascontiguousarray(vertices), grid_edges(cells // stride),
+                              upsample_error(heights, stride)))
+            stride *= 2
+
+        self.aabb = np.array([self.world_vertices.min(axis=0), self.world_vertices.max(axis=0)], dtype=float)
+        self.bounding_center = self.aabb.mean(axis=0)
+        self.bounding_radius = float(np.linalg.norm(self.aabb[1] - self.aabb[0]) / 2)
+
+    @property
+    def lines(self):
+        """
+        The edges of the full detail chunk as an (E, 2, 3) array of world coordinate endpoints, like Item.lines.
+        """
+        return self.world_vertices[self.edges]
+
+    @property
+    def lod_levels(self):
+        """
+        The number of levels of detail the chunk can be drawn at.
+        """
+        return len(self.lods)
+
+    def get_lod(self, level):
+        """
+        Returns the world space vertices and the edges of a level of detail of the chunk.
+        """
+        return self.lods[level][0], self.lods[level][1]
+
+    def lod_error(self, level):
+        """
+        Returns how far, in world units, the surface of a level of detail can be from the full chunk.
+        """
+        return self.lods[level][2]
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the chunk's heights and vertices. The edges are shared between chunks.
+        """
+        return self.heights.nbytes + sum(vertices.nbytes for vertices, edges, error in self.lods)
+
+
+class Terrain:
+    """
+    Generates and caches the chunks of terrain around the camera.
+    Call update with the camera position once per frame (from one thread only); it hands newly
+    needed chunks to the background workers, picks up the ones that finished and evicts the
+    ones that are too far away. chunks() returns the loaded chunks around the camera.
+    """
+
+    def __init__(self, seed=0, chunk_cells=16, cell_size=8.0, base_height=-10.0, amplitude=8.0, feature_size=120.0,
+                 view_radius=2, lookahead=1, max_bytes=64 * 2**20, workers=1, color=(60, 140, 60)):
+        self.seed = seed
+        self.chunk_cells = chunk_cells  # Cells along each side of a chunk
+        self.cell_size = cell_size  # World units between neighbouring samples
+        self.base_height = base_height
+        self.amplitude = amplitude  # Largest distance of the ground from base_height
+        self.feature_size = feature_size  # World size of the largest hills
+        self.view_radius = view_radius  # Chunks kept loaded in each direction around the camera
+        self.lookahead = lookahead  # Chunks generated ahead of the camera's direction of travel
+        self.max_bytes = max_bytes
+        self.color = color
+        self.executor = ThreadPoolExecutor(workers) if workers > 0 else None
+
+        self.cache = OrderedDict()  # (i, j) -> TerrainChunk, least recently used first
+        self.pending = {}  # (i, j) -> Future of chunks being generated
+        self.nbytes = 0
+        self.center = None  # Chunk the camera was in at the last update
+        self.last_pos = None
+        self.direction = (0, 0)  # Chunk step the camera last moved in
+        self.scheduled_direction = None  # Direction the chunks being generated were picked for
+        self.version = 0  # Bumped every time the set of loaded chunks changes
+        self.generated = 0
+        self.evictions = 0
+
+    @property
+    def chunk_size(self):
+        """
+        The width of a chunk in world units.
+        """
+        return self.chunk_cells * self.cell_size
+
+    def chunk_coord(self, pos):
+        """
+        Returns the (i, j) chunk containing the world position pos.
+        """
+        return int(floor(pos[0] / self.chunk_size)), int(floor(pos[2] / self.chunk_size))
+
+    def height_at(self, x, z):
+        """
+        Returns the height of the ground at world (x, z); works on arrays too.
+        """
+        return self.base_height + self.amplitude * fractal_noise(x, z, self.seed, scale=self.feature_size)
+
+    def generate_chunk(self, coord):
+        """
+        Builds the chunk at coord. Only depends on the terrain settings, so it is safe to run on any thread.
+        """
+        cells = self.chunk_cells
+        x = (coord[0] * cells + np.arange(cells + 1)) * self.cell_size
+        z = (coord[1] * cells + np.arange(cells + 1)) * self.cell_size
+        heights = self.height_at(x[:, np.newaxis], z[np.newaxis, :]).astype(np.float32)
+        return TerrainChunk(coord, heights, self.cell_size, self.color)
+
+    def wanted(self, center):
+        """
+        Returns the chunks that should be loaded with the camera in center, nearest first, followed
+        by those around the point lookahead chunks ahead in the direction of travel.
+        """
+        radius = self.view_radius
+        around = [(center[0] + di, center[1] + dj) for di in range(-radius, radius + 1) for dj in range(-radius, radius + 1)]
+        around.sort(key=lambda coord: (coord[0] - center[0]) ** 2 + (coord[1] - center[1]) ** 2)
+
+        ahead = (center[0] + self.direction[0] * self.lookahead, center[1] + self.direction[1] * self.lookahead)
+        if ahead == center:
+            return around
+        prefetch = [(ahead[0] + di, ahead[1] + dj) for di in range(-radius, radius + 1) for dj in range(-radius, radius + 1)]
+        prefetch.sort(key=lambda coord: (coord[0] - ahead[0]) ** 2 + (coord[1] - ahead[1]) ** 2)
+        return around + [coord for coord in prefetch if coord not in around]
+
+    def update(self, pos):
+        """
+        Brings the cache up to date for a camera at pos: collects finished chunks, starts
+        generating missing ones and evicts the ones that are far away or over the memory budget.
+        """
+        # Chunks that finished in the background since the last update
+        for coord, future in list(self.pending.items()):
+            if future.done():
+                del self.pending[coord]
+                self.store(coord, future.result())
+
+        center = self.chunk_coord(pos)
+        if self.last_pos is not None:
+            moved = (pos[0] - self.last_pos[0], pos[2] - self.last_pos[2])
+            if any(moved):
+                self.direction = tuple(int(np.sign(d)) if abs(d) >= .5 * max(map(abs, moved)) else 0 for d in moved)
+        self.last_pos = tuple(pos)
+
+        if center != self.center or self.direction != self.scheduled_direction:
+            self.center = center
+            self.scheduled_direction = self.direction
+            wanted = self.wanted(center)
+            for coord in wanted:
+                if coord in self.cache or coord in self.pending:
+                    continue
+                if self.executor is None:
+                    self.store(coord, self.generate_chunk(coord))
+                else:
+                    self.pending[coord] = self.executor.submit(self.generate_chunk, coord)
+
+            # Anything past the prefetch area is far away: drop it, and stop generating it if it hasn't started
+            keep = self.view_radius + self.lookahead + 1
+            far = lambda coord: max(abs(coord[0] - center[0]), abs(coord[1] - center[1])) > keep
+            for coord in [coord for coord in self.pending if far(coord)]:
+                if self.pending[coord].cancel():
+                    del self.pending[coord]
+            for coord in [coord for coord in self.cache if far(coord)]:
+                self.evict(coord)
+
+        # The chunks in view are the most recently used
+        for coord in self.visible_coords():
+            if coord in self.cache:
+                self.cache.move_to_end(coord)
+        while self.nbytes > self.max_bytes and len(self.cache) > 1:
+            self.evict(next(iter(self.cache)))
+
+    def store(self, coord, chunk):
+        """
+        Adds a generated chunk to the cache.
+        """
+        self.cache[coord] = chunk
+        self.nbytes += chunk.nbytes
+        self.generated += 1
+        self.version += 1
+
+    def evict(self, coord):
+        """
+        Removes a chunk from the cache.
+        """
+        chunk = self.cache.pop(coord)
+        self.nbytes -= chunk.nbytes
+        self.evictions += 1
+        self.version += 1
+
+    def visible_coords(self):
+        """
+        Returns the coordinates of the chunks within view_radius of the camera.
+        """
+        if self.center is None:
+            return []
+        radius = self.view_radius
+        return [(self.center[0] + di, self.center[1] + dj)
+                for di in range(-radius, radius + 1) for dj in range(-radius, radius + 1)]
+
+    def chunks(self):
+        """
+        Returns the loaded chunks within view_radius of the camera at the last update.
+        """
+        return [self.cache[coord] for coord in self.visible_coords() if coord in self.cache]
+
+    def wait(self):
+        """
+        Blocks until every chunk being generated has finished, then collects them.
+        """
+        for future in list(self.pending.values()):
+            if not future.cancelled():
+                future.result()
+        if self.last_pos is not None:
+            self.update(self.last_pos)
+
+    def stats(self):
+        """
+        Returns the cache's counters and memory use.
+        """
+        return {'chunks': len(self.cache), 'pending': len(self.pending), 'nbytes': self.nbytes,
+                'generated': self.generated, 'evictions': self.evictions}
+
+    def close(self):
+        """
+        Stops the background workers.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,100 @@
+"""
+The matrix math of the renderer and items, kept apart so it can be imported with nothing but
+NumPy: no pygame, no numpy-stl and no models. Renderer and Item call these for their matrices.
+
+Points are row vectors for the view and projection matrices (point . matrix), and column
+vectors for the object transforms (matrix . point), as the renderer and items use them.
+"""
+from math import tan, sin, cos, pi
+import numpy as np
+
+
+def persp_proj_matrix(fov, aspect, znear, zfar):
+    """
+    Returns a perspective projection matrix from the given parameters.
+    This is a rectangular frustum, which remaps world coordinates into a cube between -1 and 1
+    """
+    # Scale of x axis
+    a = aspect * (1 / tan(fov * .5))
+
+    # Scale of y axis
+    b = 1 / tan(fov * .5)
+
+    # Remaps z to [0,1], for z-index
+    c = zfar / (zfar - znear)
+
+    # Sets w to z
+    d = 1
+
+    # Moves z up to fit in znear
+    e = -(znear * zfar) / (zfar - znear)
+
+    return np.array([[a, 0, 0, 0],
+                     [0, b, 0, 0],
+                     [0, 0, c, d],
+                     [0, 0, e, 0]])
+
+
+def view_matrix(pos, angle):
+    """
+    Returns a view matrix for a camera at pos with the given (yaw, pitch, roll) angle.
+    Transforms view coordinates to make the camera located at (0,0,0) and pointed in the positive z direction.
+    """
+    sinYaw = sin(angle[0])
+    cosYaw = cos(angle[0])
+    sinPitch = sin(angle[1])
+    cosPitch = cos(angle[1])
+
+    # The axis vectors to point in the direction of the camera
+    xaxis = (cosYaw, 0, -sinYaw)
+    yaxis = (sinYaw * sinPitch, cosPitch, cosYaw * sinPitch)
+    zaxis = (sinYaw * cosPitch, -sinPitch, cosPitch * cosYaw)
+
+    # First 3 rows do rotation, the 4th row (which gets multiplied by 1) does translation
+    arr =  np.array([[xaxis[0],              yaxis[0],              zaxis[0],              0],
+                     [xaxis[1],              yaxis[1],              zaxis[1],              0],
+                     [xaxis[2],              yaxis[2],              zaxis[2],              0],
+                     [-np.dot(xaxis, pos),   -np.dot(yaxis, pos),   -np.dot(zaxis, pos),   1]])
+
+    return arr
+
+
+def scale_matrix(scale):
+    """
+    Returns a uniform 4x4 scaling matrix.
+    """
+    ident = np.identity(4)
+    for x in range(3):
+        ident[x, x] = scale
+    return ident
+
+
+def translation_matrix(world_coords):
+    """
+    Returns a 4x4 translation matrix to transform the points.
+    """
+    transform = np.identity(4)  # Generate the identity matrix
+    coords = np.array(world_coords)
+    transform[0:3, 3] = coords  # Fill the values of the transformation matrix
+    return transform
+
+
+def rotation_matrix(orient):
+    """
+    Returns a rotation matrix for a given theta (in degrees) about the x, y, and z axes
+    """
+    x, y, z = orient
+    cosd = lambda theta: cos(theta*(pi/180))  # Lambdas will make this easier
+    sind = lambda theta: sin(theta*(pi/180))
+    # Returns the rotation matrix
+    return np.array([[cosd(y)*cosd(z), -cosd(y)*sind(z), sind(y), 0],
+                    [cosd(x)*sind(y)+sind(x)*sind(y)*cosd(z), cosd(x)*cosd(z)-sind(x)*sind(y)*sind(z), -sind(x)*cosd(y), 0],
+                    [sind(x)*sind(z)-cosd(x)*sind(y)*cosd(z), sind(x)*cosd(z) + cosd(x)*sind(y)*sind(z), cosd(x)*cosd(y), 0],
+                    [0, 0, 0, 1]])
+
+
+def transform_matrix(coords, orientation, scale):
+    """
+    Returns the 4x4 matrix that scales, then rotates, then translates an object.
+    """
+    return translation_matrix(coords).dot(rotation_matrix(orientation).dot(scale_matrix(scale)))
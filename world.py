@@ -1,13 +1,22 @@
+import numpy as np
 from item import Item
-from random import choice, uniform, randint
+from instances import InstanceBatch
+import snapshot
+from random import choice, uniform, randint, Random
 
 class World:
     """
     Holds all objects in the world.
     """
 
-    def __init__(self, items=[]):
-        self.items = items
+    def __init__(self, items=None, terrain=None):
+        self.items = items if items is not None else []
+        self.terrain = terrain  # A Terrain generating the ground around the camera, if any
+        self.instances = {}  # File name -> InstanceBatch of every instance of that model
+        # File name -> InstanceBatch holding the items of a loaded snapshot that haven't been built yet.
+        # The renderer culls them like instances and builds the ones coming into view with materialize
+        self.pending = {}
+        self.version = 0  # Bumped every time an item or instances are added
 
     def add_item(self, item):
         """
@@ -15,19 +24,141 @@ class World:
         """
         if item.__class__.__name__ == "Item":
             self.items.append(item)
+            self.version += 1
+
+    def add_instances(self, file_name, positions, orientations=(0, 0, 0), scales=1, colors=(255, 0, 0)):
+        """
+        Adds many instances of a model at once, without creating an Item for each.
+        positions is an (N, 3) array; orientations, scales and colors are arrays with a row per
+        instance or single values shared by all of them. Returns the InstanceBatch they were
+        added to and their indices in it.
+        """
+        if file_name not in self.instances:
+            self.instances[file_name] = InstanceBatch(file_name)
+        batch = self.instances[file_name]
+        indices = batch.add(positions, orientations, scales, colors)
+        self.version += 1
+        return batch, indices
+
+    @property
+    def instances_version(self):
+        """
+        Changes whenever any instance batch is added to or transformed.
+        """
+        return sum(batch.version for batch in self.instances.values())
+
+    def materialize(self, file_name, indices):
+        """
+        Builds Items for the pending snapshot objects of a model at indices and adds them to the world.
+        """
+        batch = self.pending[file_name]
+        for idx in indices:
+            self.add_item(Item(file_name, tuple(batch.positions[idx].tolist()), tuple(batch.orientations[idx].tolist()),
+                               float(batch.scales[idx]), color=tuple(batch.colors[idx].tolist())))
+        batch.remove(indices)
+        if len(batch) == 0:
+            del self.pending[file_name]
+
+    def save(self, file_name):
+        """
+        Writes the items and instances of the world, including any not yet built from a loaded
+        snapshot, to a snapshot file. Terrain is generated from its seed, so it isn't saved.
+        """
+        models, model, position, orientation, scale, color, kind = [], [], [], [], [], [], []
+
+        def add(name, positions, orientations, scales, colors, object_kind):
+            if name not in models:
+                models.append(name)
+            model.append(np.full(len(positions), models.index(name), dtype=np.uint16))
+            position.append(np.asarray(positions, dtype=float).reshape(-1, 3))
+            orientation.append(np.asarray(orientations, dtype=float).reshape(-1, 3))
+            scale.append(np.asarray(scales, dtype=float).reshape(-1))
+            color.append(np.asarray(colors, dtype=np.uint8).reshape(-1, 3))
+            kind.append(np.full(len(positions), object_kind, dtype=np.uint8))
+
+        for item in self.items:
+            add(item.file_name, [item.location], [item.orientation], [item.scale], [item.color], snapshot.KIND_ITEM)
+        for batches, object_kind in ((self.pending, snapshot.KIND_ITEM), (self.instances, snapshot.KIND_INSTANCE)):
+            for name, batch in batches.items():
+                add(name, batch.positions, batch.orientations, batch.scales, batch.colors, object_kind)
+
+        snapshot.write_snapshot(file_name, models, *(np.concatenate(arrays) if arrays else np.empty(0) for arrays in
+                                                     (model, position, orientation, scale, color, kind)))
+
+    def load(self, file_name):
+        """
+        Adds the objects of a snapshot file to the world. Instances go straight into their batches,
+        while items are only built once they first come into view (see pending).
+        Returns the number of objects loaded.
+        """
+        data = snapshot.read_snapshot(file_name)
+        for idx, name in enumerate(data['models']):
+            of_model = data['model'] == idx
+            for object_kind, batches in ((snapshot.KIND_ITEM, self.pending), (snapshot.KIND_INSTANCE, self.instances)):
+                rows = np.flatnonzero(of_model & (data['kind'] == object_kind))
+                if len(rows) == 0:
+                    continue
+                if name not in batches:
+                    batches[name] = InstanceBatch(name)
+                batches[name].add(data['position'][rows], data['orientation'][rows], data['scale'][rows],
+                                  data['color'][rows])
+        self.version += 1
+        return len(data['model'])
 
     def get_objects(self):
         """
-        Returns all objects in the world
+        Returns all objects in the world, including the terrain chunks loaded around the camera
         """
-        return self.items
+        if self.terrain is None:
+            return self.items
+        return self.items + self.terrain.chunks()
 
     def gen_random_scene(self, min_val, max_val):
         """
         Places objects into the world. Number of objects generated is between min_val and max_val.
         """
+        for file_name, world_coords, orientation, scale, color in self.random_scene_specs(min_val, max_val):
+            self.add_item(Item(file_name, world_coords, orientation, scale, color=color))
+
+    def random_scene_specs(self, min_val, max_val):
+        """
+        Picks the objects gen_random_scene places, without loading them.
+        Returns a list of (file_name, world_coords, orientation, scale, color) tuples, the arguments of an Item.
+        """
         objects = ['cube.stl', 'teapot.stl']
         num_obj = randint(min_val, max_val)
-        for x in range(num_obj):
-            self.add_item(Item(choice(objects), (randint(50, 150), randint(50, 150), randint(60, 150)),
-                               (randint(-90, 90), randint(-90, 90), randint(-90, 90)), uniform(0.5, 10), color=(randint(0, 255), randint(0, 255), randint(0, 255))))
+        return [(choice(objects), (randint(50, 150), randint(50, 150), randint(60, 150)),
+                 (randint(-90, 90), randint(-90, 90), randint(-90, 90)), uniform(0.5, 10),
+                 (randint(0, 255), randint(0, 255), randint(0, 255))) for x in range(num_obj)]
+
+    def gen_scene(self, counts, seed=None, instanced=False):
+        """
+        Places a fixed number of each model into the world, in the same area gen_random_scene uses.
+        counts maps STL file names to how many of each to place. With a seed, the scene is the same every time.
+        An instanced scene is the same, but stored as one InstanceBatch per model instead of Items.
+        """
+        specs = self.scene_specs(counts, seed)
+        if instanced:
+            for file_name in sorted(counts):
+                objects = [spec[1:] for spec in specs if spec[0] == file_name]
+                if objects:
+                    positions, orientations, scales, colors = zip(*objects)
+                    self.add_instances(file_name, positions, orientations, scales, colors)
+        else:
+            for file_name, position, orientation, scale, color in specs:
+                self.add_item(Item(file_name, position, orientation, scale, color=color))
+
+    @staticmethod
+    def scene_specs(counts, seed=None):
+        """
+        Picks the objects gen_scene places, without loading them.
+        Returns a list of (file_name, world_coords, orientation, scale, color) tuples, the arguments of an Item.
+        """
+        rng = Random(seed)
+        specs = []
+        for file_name, count in sorted(counts.items()):
+            for x in range(count):
+                specs.append((file_name, (rng.randint(50, 150), rng.randint(50, 150), rng.randint(60, 150)),
+                              (rng.randint(-90, 90), rng.randint(-90, 90), rng.randint(-90, 90)), rng.uniform(0.5, 10),
+                              (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))))
+        return specs